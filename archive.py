@@ -0,0 +1,211 @@
+import numpy as np
+import calendar
+import json
+import os
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+# Readings are stored as int16 in units of 1/SCALE, which covers the 0.1 resolution of
+# every HKO 1-minute feed. MISSING marks a station that did not report in a minute.
+SCALE = 10
+MISSING = np.iinfo(np.int16).min
+# Archived minutes are the feed's timestamps, Hong Kong time without a UTC offset.
+FEED_TIMEZONE = ZoneInfo('Asia/Hong_Kong')
+
+class ObservationArchive:
+    """
+    Append-only archive of per-minute station readings.
+
+    Each variable has one file per calendar month, holding a (minutes in month x stations)
+    int16 matrix opened memory-mapped. The row of a reading is its minute offset from the
+    start of the month, so the timestamp index is implicit: appending a snapshot writes one
+    row in place, and a range query slices the rows of each month it spans without reading
+    anything else. A month of one-minute data for 40 stations is about 3.5 MB.
+
+    Station columns are assigned in the order stations are first seen and recorded in
+    stations.json, so columns never move. Month files written before a station appeared are
+    narrower and read back as missing for it.
+    """
+
+    def __init__(self, archive_dir):
+        """
+        Parameters:
+        archive_dir (str): The directory holding the archive. Created if it does not exist.
+        """
+        self.archive_dir = archive_dir
+        os.makedirs(archive_dir, exist_ok=True)
+        self._stations_path = os.path.join(archive_dir, 'stations.json')
+        if os.path.exists(self._stations_path):
+            with open(self._stations_path, 'r') as file:
+                self.names = json.load(file)
+        else:
+            self.names = []
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self._open = {}
+
+    def _columns(self, names):
+        new_names = [name for name in names if name not in self.index]
+        if new_names:
+            for name in new_names:
+                self.index[name] = len(self.names)
+                self.names.append(name)
+            with open(self._stations_path + '.tmp', 'w') as file:
+                json.dump(self.names, file)
+            os.replace(self._stations_path + '.tmp', self._stations_path)
+        return np.array([self.index[name] for name in names], dtype=np.intp)
+
+    def _month_path(self, variable, year, month):
+        return os.path.join(self.archive_dir, variable, f'{year:04d}{month:02d}.npy')
+
+    def _month(self, variable, year, month, n_columns=0, create=False):
+        """
+        Opens the matrix of a month, creating or widening it to n_columns when writing.
+        Returns None if the month does not exist and create is False.
+        """
+        path = self._month_path(variable, year, month)
+        data = self._open.get(path)
+        if data is None and os.path.exists(path):
+            data = np.load(path, mmap_mode='r+' if create else 'r')
+        if data is None and not create:
+            return None
+
+        if data is None or data.shape[1] < n_columns:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            n_minutes = calendar.monthrange(year, month)[1] * 24 * 60
+            widened = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.int16, shape=(n_minutes, n_columns))
+            widened[:] = MISSING
+            if data is not None:
+                widened[:, :data.shape[1]] = data
+            widened.flush()
+            del widened
+            os.replace(path + '.tmp', path)
+            data = np.load(path, mmap_mode='r+')
+
+        if create:
+            self._open[path] = data
+        return data
+
+    def append(self, stations, datetime_str, variable='temperature'):
+        """
+        Writes one snapshot into the archive. Writing the same minute again overwrites it.
+
+        Parameters:
+        stations (StationTable): The station table holding the snapshot's readings.
+        datetime_str (str): The observation time, as YYYYMMDDHHMM.
+        variable (str): The variable to archive.
+
+        Returns:
+        None
+        """
+        dt = datetime.strptime(datetime_str, "%Y%m%d%H%M")
+        columns = self._columns(stations.names)
+        values = stations.get(variable)
+        row = np.full(len(self.names), MISSING, dtype=np.int16)
+        valid = np.isfinite(values)
+        row[columns[valid]] = np.round(values[valid] * SCALE).astype(np.int16)
+
+        data = self._month(variable, dt.year, dt.month, len(self.names), create=True)
+        slot = ((dt.day - 1) * 24 + dt.hour) * 60 + dt.minute
+        data[slot, :len(row)] = row
+        data.flush()
+
+    def query(self, start, end, variable='temperature', names=None, dropna=True):
+        """
+        Returns the readings between two times, inclusive.
+
+        Parameters:
+        start (datetime or str): The first minute, as a datetime or YYYYMMDDHHMM.
+        end (datetime or str): The last minute, as a datetime or YYYYMMDDHHMM.
+        variable (str): The variable to read.
+        names (list): The stations to read. All archived stations if None.
+        dropna (bool): Leave out minutes in which no requested station reported.
+
+        Returns:
+        times (numpy.ndarray): The minutes, as datetime64[m].
+        values (numpy.ndarray): A (minutes x stations) matrix, NaN where missing.
+        names (list): The station of each column.
+        """
+        start = datetime.strptime(start, "%Y%m%d%H%M") if isinstance(start, str) else start.replace(second=0, microsecond=0)
+        end = datetime.strptime(end, "%Y%m%d%H%M") if isinstance(end, str) else end.replace(second=0, microsecond=0)
+        names = list(self.names) if names is None else list(names)
+        columns = np.array([self.index.get(name, -1) for name in names], dtype=np.intp)
+
+        times, blocks = [], []
+        year, month = start.year, start.month
+        while start <= end and (year, month) <= (end.year, end.month):
+            month_start = datetime(year, month, 1)
+            first = max(int((start - month_start).total_seconds() // 60), 0)
+            last = min(int((end - month_start).total_seconds() // 60), calendar.monthrange(year, month)[1] * 24 * 60 - 1)
+            data = self._month(variable, year, month)
+            block = np.full((last - first + 1, len(columns)), MISSING, dtype=np.int16)
+            if data is not None:
+                present = (columns >= 0) & (columns < data.shape[1])
+                block[:, present] = data[first:last + 1][:, columns[present]]
+            times.append(np.datetime64(month_start, 'm') + np.arange(first, last + 1))
+            blocks.append(block)
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+        times = np.concatenate(times) if times else np.array([], dtype='datetime64[m]')
+        raw = np.concatenate(blocks) if blocks else np.empty((0, len(columns)), dtype=np.int16)
+        values = np.where(raw == MISSING, np.nan, raw / SCALE)
+        if dropna:
+            keep = np.isfinite(values).any(axis=1)
+            times, values = times[keep], values[keep]
+        return times, values, names
+
+    def last(self, hours=24, variable='temperature', names=None, now=None):
+        """
+        Returns the readings of the last `hours` hours, see query.
+
+        Parameters:
+        hours (float): How far back to read.
+        variable (str): The variable to read.
+        names (list): The stations to read. All archived stations if None.
+        now (datetime): The end of the range, naive in Hong Kong time. Defaults to the current
+            time in Hong Kong, whatever the time zone of the host.
+        """
+        now = datetime.now(FEED_TIMEZONE).replace(tzinfo=None) if now is None else now
+        return self.query(now - timedelta(hours=hours), now, variable, names)
+
+    def latest(self, variable='temperature', names=None):
+        """
+        Returns the readings of the most recent archived minute, see query.
+
+        Parameters:
+        variable (str): The variable to read.
+        names (list): The stations to read. All archived stations if None.
+        """
+        variable_dir = os.path.join(self.archive_dir, variable)
+        months = sorted(f for f in os.listdir(variable_dir) if f.endswith('.npy')) if os.path.isdir(variable_dir) else []
+        for month_file in reversed(months):
+            year, month = int(month_file[:4]), int(month_file[4:6])
+            data = self._month(variable, year, month)
+            reported = np.flatnonzero((data != MISSING).any(axis=1))
+            if len(reported):
+                minute = datetime(year, month, 1) + timedelta(minutes=int(reported[-1]))
+                return self.query(minute, minute, variable, names)
+        names = list(self.names) if names is None else list(names)
+        return np.array([], dtype='datetime64[m]'), np.empty((0, len(names))), names
+
+    def close(self):
+        """
+        Flushes and releases the month files held open for writing.
+        """
+        for data in self._open.values():
+            data.flush()
+        self._open.clear()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Print archived station readings.')
+    parser.add_argument('start', help='first minute, YYYYMMDDHHMM')
+    parser.add_argument('end', help='last minute, YYYYMMDDHHMM')
+    parser.add_argument('--archive', default='input/archive', help='archive directory')
+    parser.add_argument('--variable', default='temperature')
+    parser.add_argument('--station', action='append', help='station name, may be repeated')
+    args = parser.parse_args()
+
+    times, values, names = ObservationArchive(args.archive).query(args.start, args.end, args.variable, args.station)
+    print('Date time,' + ','.join(names))
+    for t, row in zip(times, values):
+        print(t.astype(datetime).strftime("%Y%m%d%H%M") + ',' + ','.join('' if np.isnan(v) else f'{v:.1f}' for v in row))
@@ -0,0 +1,162 @@
+import matplotlib
+matplotlib.use('Agg')
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from data_loader import feed_datetime, parse_temperature_csv
+from archive import ObservationArchive
+from variables import VARIABLES
+import numpy as np
+import argparse
+import glob
+import os
+import time
+
+# Static state of the worker process, loaded once by init_worker.
+_STATE = None
+
+def init_worker(output_dir, product, resolution=None):
+    """
+    Loads the static state (shapefile, ocean mask, renderer) once per worker process.
+    The interpolation weights are cached per process by the interpolator module.
+
+    Parameters:
+    output_dir (str): The directory the frames are written to.
+    product (str): How the renderer fills the field, 'contour' or 'raster'.
+    resolution (int): Grid points per side for the tiled high-resolution mode. None for the default grid.
+    """
+    global _STATE
+    import main
+    _STATE = main.load_static_state(output_dir, product, resolution)
+
+def render_csv(csv_path):
+    """
+    Renders one snapshot from a saved copy of the 1-minute temperature feed.
+
+    Parameters:
+    csv_path (str): The path to the CSV file.
+
+    Returns:
+    str: The observation time of the rendered frame.
+    """
+    import main
+    with open(csv_path, mode='r', encoding='utf-8-sig') as file:
+        stations, datetime = parse_temperature_csv(file.read().splitlines(), _STATE['stations'])
+    main.render_frame(_STATE, stations, datetime)
+    return datetime
+
+def render_values(datetime, names, values):
+    """
+    Renders one snapshot read from the observation archive.
+
+    Parameters:
+    datetime (str): The observation time, as YYYYMMDDHHMM.
+    names (list): The station of each value.
+    values (numpy.ndarray): The temperature readings, NaN where missing.
+
+    Returns:
+    str: The observation time of the rendered frame.
+    """
+    import main
+    stations = _STATE['stations']
+    idx = stations.indices(names)
+    temperature = np.full(len(stations), np.nan)
+    temperature[idx[idx >= 0]] = values[idx >= 0]
+    stations.set_values('temperature', temperature)
+    main.render_frame(_STATE, stations, datetime)
+    return datetime
+
+def frame_path(output_dir, datetime):
+    return os.path.join(output_dir, f"{VARIABLES['temperature'].map_prefix}_{datetime}.png")
+
+def csv_jobs(input_dir, output_dir):
+    """
+    Lists the CSV snapshots in a directory whose frame has not been rendered yet.
+
+    Returns:
+    list: (function, args) pairs for the worker pool.
+    """
+    jobs = []
+    for csv_path in sorted(glob.glob(os.path.join(input_dir, '*.csv'))):
+        with open(csv_path, mode='r', encoding='utf-8-sig') as file:
+            datetime = feed_datetime([file.readline(), file.readline()])
+        if datetime is None:
+            print(f"No readings in {csv_path}. Skipping it.")
+        elif not os.path.exists(frame_path(output_dir, datetime)):
+            jobs.append((render_csv, (csv_path,)))
+    return jobs
+
+def archive_jobs(archive_dir, start, end, step, output_dir):
+    """
+    Lists the archived minutes between start and end whose frame has not been rendered yet.
+
+    Returns:
+    list: (function, args) pairs for the worker pool.
+    """
+    times, values, names = ObservationArchive(archive_dir).query(start, end)
+    jobs = []
+    for t, row in zip(times[::step], values[::step]):
+        datetime = t.astype(object).strftime("%Y%m%d%H%M")
+        if not os.path.exists(frame_path(output_dir, datetime)):
+            jobs.append((render_values, (datetime, names, row)))
+    return jobs
+
+def run_backfill(jobs, output_dir, n_workers=None, product='contour', resolution=None):
+    """
+    Renders frames across a process pool and reports throughput.
+
+    Frames are written atomically, so rerunning an interrupted backfill renders only the
+    frames that are still missing.
+
+    Parameters:
+    jobs (list): (function, args) pairs from csv_jobs or archive_jobs.
+    output_dir (str): The directory the frames are written to.
+    n_workers (int): Number of worker processes. Defaults to the number of CPUs.
+    product (str): How the renderer fills the field, 'contour' or 'raster'.
+    resolution (int): Grid points per side for the tiled high-resolution mode. None for the default grid.
+
+    Returns:
+    int: The number of frames rendered.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if not jobs:
+        print("All frames already rendered.")
+        return 0
+
+    print(f"Rendering {len(jobs)} frames")
+    start = time.perf_counter()
+    done = 0
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(output_dir, product, resolution)) as pool:
+        futures = [pool.submit(function, *args) for function, args in jobs]
+        for future in as_completed(futures):
+            try:
+                future.result()
+                done += 1
+            except Exception as e:
+                print(f"An error occurred while rendering a frame: {e}")
+            elapsed = time.perf_counter() - start
+            print(f"{done}/{len(jobs)} frames, {done / elapsed:.2f} frames/s")
+
+    elapsed = time.perf_counter() - start
+    print(f"Rendered {done} frames in {elapsed:.1f}s ({done / elapsed:.2f} frames/s)")
+    return done
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Re-render historical temperature maps.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--csv-dir', help='directory of saved latest_1min_temperature CSV files')
+    source.add_argument('--archive', help='observation archive directory, used with --start and --end')
+    parser.add_argument('--start', help='first minute to render from the archive, YYYYMMDDHHMM')
+    parser.add_argument('--end', help='last minute to render from the archive, YYYYMMDDHHMM')
+    parser.add_argument('--step', type=int, default=1, help='render every n-th archived minute')
+    parser.add_argument('--output-dir', default='output', help='directory the frames are written to')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--product', choices=('contour', 'raster'), default='contour', help='fill the field with contours or with the faster raster lookup')
+    parser.add_argument('--resolution', type=int, default=None, help='grid points per side, interpolated in tiles')
+    args = parser.parse_args()
+
+    if args.csv_dir:
+        jobs = csv_jobs(args.csv_dir, args.output_dir)
+    else:
+        if not (args.start and args.end):
+            parser.error('--archive requires --start and --end')
+        jobs = archive_jobs(args.archive, args.start, args.end, args.step, args.output_dir)
+    run_backfill(jobs, args.output_dir, args.workers, args.product, args.resolution)
@@ -0,0 +1,446 @@
+import matplotlib
+matplotlib.use('Agg')
+from contextlib import redirect_stdout
+from data_loader import load_station_data, parse_feed_csv
+from station_table import StationTable
+from interpolator import StationInterpolator
+from ocean_mask import generate_ocean_mask, land_indices, land_to_grid
+from districts import district_labels, DistrictStats
+from district_geometry import DistrictGeometry, Outlines, build_outlines, load_district_geometry
+from plotter import make_grid
+from renderer import MapRenderer
+from tiles import TilePyramid
+from grid_product import GridStore
+from variants import SharedField, VariantPool, VARIANTS
+from terrain import TerrainModel
+from scipy.interpolate import griddata
+import cartopy.crs as ccrs
+import geopandas as gpd
+import numpy as np
+import constants as c
+import subprocess
+import tempfile
+import argparse
+import platform
+import shutil
+import json
+import time
+import io
+import os
+import sys
+
+STATION_LOCATION_DATA_PATH = 'input/station_location.csv'
+FEED_PATH = 'input/latest_1min_temperature.csv'
+SHAPEFILE_PATH = 'input/hk_coast_2022/Hong_Kong_18_Districts/reprojected_HKDistrict18.shp'
+BASELINE_PATH = 'benchmark_baseline.json'
+DATETIME = '202503301110'
+
+# The sizes each benchmark is swept over, in full and in --quick runs.
+SWEEPS = {
+    'resolution': ([100, 200, 400, 800], [100, 400]),
+    'stations': ([25, 50, 100, 200], [25, 100]),
+    'feed_rows': ([50, 500, 5000], [50, 5000]),
+    'dpi': ([100, 250, 500], [100, 500]),
+}
+
+class Bench:
+    """
+    Times callables and collects the results of a benchmark run.
+
+    Every case is run once to warm up and then `repeat` times. The best time is the one
+    compared against the baseline, as it is the least disturbed by other work on the machine;
+    the median is reported alongside.
+    """
+
+    def __init__(self, repeat=5, only=None, min_sample=0.02):
+        """
+        Parameters:
+        repeat (int): Timed runs per case.
+        only (str): Run only the cases whose name contains this string.
+        min_sample (float): Seconds each timed run of a fast case is looped for.
+        """
+        self.repeat = repeat
+        self.min_sample = min_sample
+        self.only = only
+        self.results = []
+
+    def wanted(self, name):
+        return self.only is None or self.only in name
+
+    def run(self, name, fn, work=None, unit=None, repeat=None, setup=None, **params):
+        """
+        Times fn and records the result.
+
+        Parameters:
+        name (str): The case name, e.g. 'interpolate.apply'.
+        fn (callable): The code to time. Its output is discarded.
+        work (float): Units of work per call, e.g. grid points, for the throughput.
+        unit (str): What work counts, e.g. 'points'.
+        repeat (int): Timed runs, overriding the default for slow cases.
+        setup (callable): Called before every run, untimed.
+        params: The sweep parameters of the case, e.g. resolution=400.
+
+        Returns:
+        dict: The result, or None if the case was filtered out.
+        """
+        if not self.wanted(name):
+            return None
+        # Fast cases are looped so that each timed sample lasts at least min_sample seconds,
+        # as timeit does; a single sub-millisecond call is mostly timer and scheduler noise.
+        number = 1
+        times = []
+        for i in range((repeat or self.repeat) + 1):
+            if setup is not None:
+                setup()
+            with redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                for _ in range(number):
+                    fn()
+                elapsed = (time.perf_counter() - start) / number
+            if i == 0:
+                if setup is None and elapsed < self.min_sample:
+                    number = min(10000, int(self.min_sample / max(elapsed, 1e-7)) + 1)
+            else:
+                times.append(elapsed)
+
+        result = {'name': name, 'params': params, 'best': min(times), 'median': float(np.median(times))}
+        if work is not None:
+            result['throughput'] = work / result['best']
+            result['unit'] = f'{unit}/s'
+        self.results.append(result)
+        print(format_result(result))
+        return result
+
+def result_key(result):
+    return result['name'] + ''.join(f' {k}={v}' for k, v in sorted(result['params'].items()))
+
+def format_result(result, baseline=None):
+    line = f"{result_key(result):<44} best {result['best'] * 1e3:10.2f} ms  median {result['median'] * 1e3:10.2f} ms"
+    if 'throughput' in result:
+        line += f"  {result['throughput']:12.4g} {result['unit']}"
+    if baseline is not None:
+        line += f"  x{result['best'] / baseline['best']:.2f} vs baseline"
+    return line
+
+def synthetic_stations(n, seed=0):
+    """
+    Builds a station network of n stations spread over the map, with temperatures varying
+    smoothly over it and a little noise, as the real network reports.
+
+    Parameters:
+    n (int): Number of stations.
+    seed (int): Seed of the random positions and noise.
+
+    Returns:
+    StationTable: The stations with temperature readings.
+    """
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(c.MINLON + 0.05, c.MAXLON - 0.05, n)
+    lat = rng.uniform(c.MINLAT + 0.05, c.MAXLAT - 0.05, n)
+    stations = StationTable([f'Station {i}' for i in range(n)], lat, lon)
+    temperature = 20 + 4 * np.sin(8 * lon) * np.cos(8 * lat) + rng.normal(0, 0.5, n)
+    stations.set_values('temperature', np.round(temperature, 1))
+    return stations
+
+def synthetic_feed(n, seed=0):
+    """
+    Returns the lines of a temperature feed CSV with n rows, for the station names of
+    synthetic_stations(n).
+    """
+    stations = synthetic_stations(n, seed)
+    lines = ['Date time,Automatic Weather Station,Air Temperature(degree Celsius)']
+    lines += [f'{DATETIME},{name},{value}' for name, value in zip(stations.names, stations.get('temperature'))]
+    return lines
+
+def bundled_stations():
+    """
+    Returns the bundled station table with the readings of the bundled feed.
+    """
+    stations = load_station_data(STATION_LOCATION_DATA_PATH)
+    with open(FEED_PATH, encoding='utf-8-sig') as file, redirect_stdout(io.StringIO()):
+        parse_feed_csv(file.read().splitlines(), stations, 'temperature', 'Air Temperature(degree Celsius)')
+    return stations
+
+def bench_loading(bench, sweeps):
+    bench.run('load_station_data', lambda: load_station_data(STATION_LOCATION_DATA_PATH))
+
+    stations = load_station_data(STATION_LOCATION_DATA_PATH)
+    with open(FEED_PATH, encoding='utf-8-sig') as file:
+        lines = file.read().splitlines()
+    bench.run('parse_feed', lambda: parse_feed_csv(lines, stations, 'temperature', 'Air Temperature(degree Celsius)'),
+              work=len(lines) - 1, unit='rows', feed_rows='bundled')
+    for n in sweeps['feed_rows']:
+        table, feed = synthetic_stations(n), synthetic_feed(n)
+        bench.run('parse_feed', lambda: parse_feed_csv(feed, table, 'temperature', 'Air Temperature(degree Celsius)'),
+                  work=n, unit='rows', feed_rows=n)
+
+def bench_interpolation(bench, sweeps):
+    stations = bundled_stations()
+
+    def cases(table, **params):
+        X, Y = make_grid(params.get('resolution', 400), params.get('resolution', 400))
+        lon, lat, values, valid = table.with_virtual_stations('temperature')
+        interpolator = StationInterpolator(lon, lat, X, Y, 'benchmark')
+        bench.run('interpolate.build', lambda: interpolator.build_weights(valid), work=X.size, unit='points', **params)
+        interpolator.weights(valid)
+        bench.run('interpolate.apply', lambda: interpolator.interpolate(values, valid), work=X.size, unit='points', **params)
+        if params.get('resolution', 400) <= 400:
+            bench.run('interpolate.griddata', lambda: griddata((lon[valid], lat[valid]), values[valid], (X, Y), method='linear'),
+                      work=X.size, unit='points', **params)
+
+    for resolution in sweeps['resolution']:
+        cases(stations, resolution=resolution)
+    for n in sweeps['stations']:
+        cases(synthetic_stations(n), stations=n)
+
+    # The lapse term on the default grid, over a hill standing in for a DEM: building the
+    # anomaly of a new pattern of valid stations, and adding it to a frame.
+    X, Y = make_grid(400, 400)
+    lon, lat, values, valid = stations.with_virtual_stations('temperature')
+    interpolator = StationInterpolator(lon, lat, X, Y, 'benchmark')
+    hill = lambda x, y: 950 * np.exp(-((x - 114.12) ** 2 + (y - 22.41) ** 2) / 0.002)
+    station_elevation, cell_elevation = hill(stations.lon, stations.lat), hill(X, Y).ravel()
+    bench.run('terrain.anomaly', lambda: TerrainModel(station_elevation, cell_elevation).anomaly(interpolator, valid),
+              work=X.size, unit='points')
+    model, Z = TerrainModel(station_elevation, cell_elevation), interpolator.interpolate(values, valid)
+    model.anomaly(interpolator, valid)
+    bench.run('terrain.apply', lambda: model.apply(Z, interpolator, values[:len(stations)], valid), work=X.size, unit='points')
+
+def bench_geometry(bench, sweeps):
+    gdf = gpd.read_file(SHAPEFILE_PATH)
+    bench.run('read_shapefile', lambda: gpd.read_file(SHAPEFILE_PATH), repeat=3)
+
+    cache_dir = tempfile.mkdtemp(prefix='hk_bench_')
+    try:
+        DistrictGeometry.from_geodataframe(gdf, 'ENAME').save(os.path.join(cache_dir, 'districts.npz'))
+        bench.run('district_geometry.load', lambda: DistrictGeometry.load(os.path.join(cache_dir, 'districts.npz')))
+        geometry = DistrictGeometry.load(os.path.join(cache_dir, 'districts.npz')).geometry
+        for dpi in sweeps['dpi']:
+            # Half an output pixel, on the map axes about 9 inches wide.
+            tolerance = (c.MAXLON - c.MINLON) / (9 * dpi) / 2
+            bench.run('district_geometry.outlines', lambda: build_outlines(geometry, tolerance), repeat=3, dpi=dpi)
+        build_outlines(geometry, 1e-4).save(os.path.join(cache_dir, 'outlines.npz'))
+        bench.run('district_geometry.outlines_load', lambda: Outlines.load(os.path.join(cache_dir, 'outlines.npz')))
+        for resolution in sweeps['resolution']:
+            X, Y = make_grid(resolution, resolution)
+            # A fresh cache every run, so the mask is built rather than loaded.
+            clear = lambda: shutil.rmtree(cache_dir, ignore_errors=True)
+            bench.run('ocean_mask.build', lambda: generate_ocean_mask(gdf, X, Y, SHAPEFILE_PATH, cache_dir),
+                      work=X.size, unit='cells', repeat=3, setup=clear, resolution=resolution)
+            bench.run('ocean_mask.cached', lambda: generate_ocean_mask(gdf, X, Y, SHAPEFILE_PATH, cache_dir),
+                      work=X.size, unit='cells', resolution=resolution)
+
+            with redirect_stdout(io.StringIO()):
+                labels = district_labels(gdf, X[0], Y[:, 0], SHAPEFILE_PATH, cache_dir)
+            districts = DistrictStats(gdf['ENAME'], labels)
+            Z = np.sin(X * 10) * np.cos(Y * 10)
+            bench.run('district_stats', lambda: districts.compute(Z), work=X.size, unit='cells', resolution=resolution)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+def bench_rendering(bench, sweeps):
+    stations = bundled_stations()
+    proj = ccrs.PlateCarree()
+
+    cache_dir = tempfile.mkdtemp(prefix='hk_bench_')
+    output_dir = tempfile.mkdtemp(prefix='hk_bench_')
+    try:
+        X, Y = make_grid()
+        with redirect_stdout(io.StringIO()):
+            districts = load_district_geometry(SHAPEFILE_PATH, cache_dir)
+            land_idx = land_indices(generate_ocean_mask(districts, X, Y, SHAPEFILE_PATH, cache_dir))
+        lon, lat, values, valid = stations.with_virtual_stations('temperature')
+        Z = StationInterpolator(lon, lat, np.ravel(X)[land_idx], np.ravel(Y)[land_idx], 'benchmark').interpolate(values, valid)
+        masked_Z = land_to_grid(Z, land_idx, X.shape)
+
+        # A first frame writes every tile; a repeated one compares them all and writes none.
+        tile_dir = os.path.join(output_dir, 'tiles')
+        pyramids = []
+        def fresh_pyramid():
+            shutil.rmtree(tile_dir, ignore_errors=True)
+            pyramids[:] = [TilePyramid(tile_dir)]
+        fresh_pyramid()
+        bench.run('tiles.render', lambda: pyramids[0].render(X, Y, masked_Z), work=pyramids[0].n_tiles, unit='tiles',
+                  repeat=3, setup=fresh_pyramid)
+        bench.run('tiles.unchanged', lambda: pyramids[0].render(X, Y, masked_Z), work=pyramids[0].n_tiles, unit='tiles')
+
+        store = GridStore(os.path.join(output_dir, 'grid'))
+        bench.run('grid.append', lambda: store.append(X, Y, masked_Z, stations, DATETIME), work=X.size, unit='cells')
+        bench.run('grid.read', lambda: store.read(DATETIME, DATETIME), work=X.size, unit='cells')
+
+        # Handing a field to the variant workers, then every bundled variant of a frame once
+        # the workers have built their renderers.
+        field = SharedField()
+        bench.run('variants.share', lambda: field.write(masked_Z), work=X.size, unit='cells')
+        field.close()
+        pool = VariantPool(VARIANTS.values(), output_dir, [STATION_LOCATION_DATA_PATH], SHAPEFILE_PATH, cache_dir)
+        try:
+            frame = lambda: pool.wait(pool.submit(X, Y, masked_Z, stations, DATETIME))
+            frame()
+            bench.run('variants.frame', frame, work=len(pool.variants), unit='variants', repeat=3, workers=pool.n_workers)
+        finally:
+            pool.close()
+
+        for product in ('contour', 'raster'):
+            for dpi in sweeps['dpi']:
+                bench.run('render.build', lambda: MapRenderer(stations, districts, proj, dpi=dpi, output_dir=output_dir, product=product),
+                          repeat=2, product=product, dpi=dpi)
+                renderer = MapRenderer(stations, districts, proj, dpi=dpi, output_dir=output_dir, product=product)
+                pixels = int(np.prod(renderer.fig.get_size_inches() * dpi))
+                bench.run('render.draw_field', lambda: renderer.draw_field(X, Y, masked_Z), product=product, dpi=dpi)
+                bench.run('render.draw_stations', lambda: renderer.update_stations(stations, DATETIME), product=product, dpi=dpi)
+                bench.run('render.savefig', lambda: renderer.fig.savefig(os.path.join(output_dir, 'frame.png'), dpi=dpi, format='png'),
+                          work=pixels, unit='pixels', repeat=3, product=product, dpi=dpi)
+                # What is left of savefig on the critical path with a background OutputWriter.
+                bench.run('render.rasterize', renderer.rasterize, work=pixels, unit='pixels', repeat=3, product=product, dpi=dpi)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def bench_startup(bench, sweeps):
+    # Each case is a fresh interpreter, so module imports are paid in full. The static state
+    # is loaded from the caches in input/, which the warm-up run fills if they are empty.
+    root = os.path.dirname(os.path.abspath(__file__))
+    scripts = {
+        'startup.import': 'import main',
+        'startup.static_state': 'import main; main.load_static_state()',
+        'startup.static_state_grid': "import main; main.load_static_state(product='grid')",
+    }
+    for name, script in scripts.items():
+        command = [sys.executable, '-c', script]
+        bench.run(name, lambda: subprocess.run(command, cwd=root, check=True, capture_output=True), repeat=3)
+
+    # Report which heavy modules a warm start still pulls in.
+    script = ('import sys, main; main.load_static_state(); '
+              'sys.stderr.write(" ".join(m for m in ("geopandas", "pandas", "scipy.spatial", "scipy.interpolate") if m in sys.modules))')
+    loaded = subprocess.run([sys.executable, '-c', script], cwd=root, check=True, capture_output=True, text=True)
+    print(f"heavy modules imported by a warm start: {loaded.stderr.strip() or 'none'}")
+
+SUITES = {
+    'startup': bench_startup,
+    'loading': bench_loading,
+    'interpolation': bench_interpolation,
+    'geometry': bench_geometry,
+    'rendering': bench_rendering,
+}
+
+def scaling(results):
+    """
+    Fits how the time of each case grows with each swept parameter.
+
+    Returns:
+    list: (name, parameter, exponent, sizes) for every case swept over at least two numeric
+    sizes, where time grows about as size ** exponent. Resolutions are points per side, so
+    an exponent of 2 there means time linear in the number of grid points.
+    """
+    series = {}
+    for result in results:
+        for param, size in result['params'].items():
+            if not isinstance(size, (int, float)):
+                continue
+            others = tuple(sorted((k, v) for k, v in result['params'].items() if k != param))
+            series.setdefault((result['name'], param, others), []).append((size, result['best']))
+
+    curves = []
+    for (name, param, others), points in series.items():
+        if len(points) < 2:
+            continue
+        sizes, times = np.array(sorted(points)).T
+        exponent = np.polyfit(np.log(sizes), np.log(times), 1)[0]
+        label = name + ''.join(f' {k}={v}' for k, v in others)
+        curves.append((label, param, exponent, [int(s) for s in sizes]))
+    return curves
+
+def compare(results, baseline, tolerance):
+    """
+    Compares a run against a baseline.
+
+    Parameters:
+    results (list): The results of this run.
+    baseline (dict): A report written by --save-baseline.
+    tolerance (float): The slowdown factor of the best time above which a case regressed.
+
+    Returns:
+    list: The results that regressed.
+    """
+    previous = {result_key(result): result for result in baseline['results']}
+    regressions = []
+    print(f"\nCompared with the baseline from {baseline.get('created', 'an unknown date')} on {baseline.get('machine', 'an unknown machine')}:")
+    for result in results:
+        before = previous.get(result_key(result))
+        if before is None:
+            continue
+        line = format_result(result, before)
+        if result['best'] > tolerance * before['best']:
+            regressions.append(result)
+            line += '  REGRESSION'
+        print(line)
+    return regressions
+
+def run_benchmarks(suites=tuple(SUITES), quick=False, repeat=5, only=None):
+    """
+    Runs the benchmark suites offline, on the bundled input files and synthetic stations and grids.
+
+    Parameters:
+    suites (tuple): Names of the suites to run, keys of SUITES.
+    quick (bool): Sweep fewer sizes.
+    repeat (int): Timed runs per case.
+    only (str): Run only the cases whose name contains this string.
+
+    Returns:
+    dict: The report, with the machine, date and the list of results.
+    """
+    sweeps = {name: sizes[1] if quick else sizes[0] for name, sizes in SWEEPS.items()}
+    bench = Bench(repeat=repeat, only=only)
+    for name in suites:
+        print(f"\n== {name} ==")
+        SUITES[name](bench, sweeps)
+
+    return {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'machine': f"{platform.machine()} {os.cpu_count()} CPUs, Python {platform.python_version()}",
+        'quick': quick,
+        'results': bench.results,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages offline, on the bundled inputs and synthetic data.')
+    parser.add_argument('suites', nargs='*', help=f"suites to run, from {', '.join(SUITES)}; all by default")
+    parser.add_argument('--quick', action='store_true', help='sweep fewer sizes')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per case')
+    parser.add_argument('--only', default=None, help='run only the cases whose name contains this string')
+    parser.add_argument('--output', default=None, help='write the results as JSON to this path')
+    parser.add_argument('--baseline', default=None, metavar='PATH',
+                        help='compare with a baseline recorded on this machine, exiting 1 on a regression')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help=f'store this run as the baseline, at --baseline or {BASELINE_PATH}, instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='slowdown of the best time that counts as a regression')
+    args = parser.parse_args()
+    for suite in args.suites:
+        if suite not in SUITES:
+            parser.error(f"unknown suite {suite!r}, expected one of {', '.join(SUITES)}")
+
+    report = run_benchmarks(tuple(args.suites) or tuple(SUITES), args.quick, args.repeat, args.only)
+
+    print("\nScaling (time ~ size ** exponent):")
+    for label, param, exponent, sizes in scaling(report['results']):
+        print(f"{label:<44} by {param:<10} exponent {exponent:5.2f} over {sizes}")
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=1)
+        print(f"results written to {args.output}")
+
+    if args.save_baseline:
+        baseline_path = args.baseline or BASELINE_PATH
+        with open(baseline_path, 'w') as file:
+            json.dump(report, file, indent=1)
+        print(f"baseline written to {baseline_path}")
+    elif args.baseline is not None:
+        # Timings only compare on the machine they were recorded on, so no baseline is
+        # shipped and the comparison is opt-in.
+        with open(args.baseline) as file:
+            regressions = compare(report['results'], json.load(file), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} case(s) slower than {args.tolerance}x the baseline.")
+            sys.exit(1)
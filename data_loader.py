@@ -1,67 +1,263 @@
 import csv
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from station_table import StationTable
+import threading
 import os
 
-def download_csv(api_link, output_path, stations:dict):
+class FeedFetcher:
     """
-    Downloads a CSV file from the given API link from data.gov.hk and saves it to the specified output path.
+    Fetches a data.gov.hk CSV feed over a pooled, retrying session.
+
+    The fetcher remembers the ETag and Last-Modified headers of the last response and
+    sends them back as If-None-Match/If-Modified-Since, so an unchanged feed costs a
+    304 with no body. It also remembers the feed's 'Date time', so a body that was
+    re-served with the same observation time is recognised as stale too.
+
+    The headers and time of a new snapshot are only remembered once commit is called, after
+    the snapshot has been rendered: if rendering fails, the next poll downloads and returns
+    the same minute again instead of skipping it as unchanged. When the output is written on
+    another thread, committer hands that thread the commit of the snapshot.
+    """
+
+    def __init__(self, api_link, output_path=None, archive=None, timeout=10, retries=3, pool_size=4, variable='temperature', column='Air Temperature(degree Celsius)'):
+        """
+        Parameters:
+        api_link (str): The URL of the API endpoint to download the CSV from.
+        output_path (str): If given, each new body is also saved to this path.
+        archive (ObservationArchive): If given, each new snapshot is appended to it.
+        timeout (float): Seconds to wait for the server to connect or send data.
+        retries (int): How many times to retry connection errors and 5xx responses.
+        pool_size (int): Number of connections kept alive per host.
+        variable (str): The name the readings are stored under in the station table and archive.
+        column (str): The CSV column holding the readings.
+        """
+        self.api_link = api_link
+        self.variable = variable
+        self.column = column
+        self.output_path = output_path
+        self.archive = archive
+        self.timeout = timeout
+        self.etag = None
+        self.last_modified = None
+        self.last_datetime = None
+        # (etag, last_modified, datetime) of the last snapshot returned, until it is committed.
+        self._pending = None
+        # Held while the remembered headers and time change, as a committer may run on another thread.
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), allowed_methods=('GET',))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def fetch_text(self):
+        """
+        Downloads the feed unless the server reports it unchanged.
+
+        Returns:
+        str: The decoded CSV body, or None if the server answered 304 Not Modified.
+        """
+        headers = {}
+        with self._lock:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+
+        response = self.session.get(self.api_link, headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            return None
+        if response.status_code != 200:
+            raise Exception(f"Failed to download CSV file. Status code: {response.status_code}")
+
+        self._pending = (response.headers.get('ETag'), response.headers.get('Last-Modified'), None)
+        if self.output_path is not None:
+            with open(self.output_path, 'wb') as file:
+                file.write(response.content)
+        return response.content.decode('utf-8-sig')
+
+    def fetch(self, stations:StationTable):
+        """
+        Downloads and parses the feed if it has advanced since the last committed snapshot.
+        Call commit once the snapshot has been rendered.
+
+        Parameters:
+        stations (StationTable): The station table. Its readings of the fetcher's variable are replaced.
+
+        Returns:
+        tuple: (stations, datetime), or None if the feed is unchanged.
+        """
+        return self.ingest(self.fetch_text(), stations)
+
+    def ingest(self, text, stations:StationTable):
+        """
+        Parses a body returned by fetch_text into the station table and archives it, unless
+        it is missing or its observation time has not advanced. Call commit once the snapshot
+        has been rendered.
+
+        Parameters:
+        text (str): The body from fetch_text, or None if the server answered 304.
+        stations (StationTable): The station table. Its readings of the fetcher's variable are replaced.
+
+        Returns:
+        tuple: (stations, datetime), or None if the feed is unchanged.
+        """
+        if text is None:
+            print(f"{self.variable} feed not modified since the last fetch.")
+            return None
+
+        lines = text.splitlines()
+        datetime = feed_datetime(lines)
+        if datetime is not None and datetime == self.last_datetime:
+            print(f"{self.variable} feed still at {datetime}.")
+            # That minute is rendered already, so the new headers can be kept right away.
+            self.commit()
+            return None
+
+        stations, datetime = parse_feed_csv(lines, stations, self.variable, self.column)
+        etag, last_modified = (self.etag, self.last_modified) if self._pending is None else self._pending[:2]
+        self._pending = (etag, last_modified, datetime)
+        if self.archive is not None and datetime is not None:
+            self.archive.append(stations, datetime, self.variable)
+        return stations, datetime
+
+    def commit(self):
+        """
+        Remembers the headers and observation time of the last snapshot returned, so that
+        the next poll skips it as unchanged. Does nothing if there is none pending.
+        """
+        self._commit(self._pending)
+
+    def committer(self):
+        """
+        Returns a function that commits the snapshot pending now, for when its output is in
+        place, which may be after later snapshots were fetched. It does nothing if a later
+        minute was committed meanwhile.
+        """
+        pending = self._pending
+        return lambda: self._commit(pending)
+
+    def _commit(self, pending):
+        if pending is None:
+            return
+        etag, last_modified, datetime = pending
+        with self._lock:
+            if datetime is not None and self.last_datetime is not None and datetime < self.last_datetime:
+                return
+            self.etag, self.last_modified = etag, last_modified
+            if datetime is not None:
+                self.last_datetime = datetime
+            if self._pending is pending:
+                self._pending = None
+
+def feed_datetime(lines):
+    """
+    Reads the observation time from the first data row of a feed, without parsing the rest.
 
     Parameters:
-    api_link (str): The URL of the API endpoint to download the CSV from.
-    output_path (str): The local path where the CSV file will be saved.
+    lines (list): The lines of the CSV body, header first.
+
+    Returns:
+    str: The 'Date time' of the first row, or None if the feed has no rows.
     """
-    response = requests.get(api_link)
-    if response.status_code == 200:
-        with open(output_path, 'wb') as file:
-            file.write(response.content)
-        print(f"CSV file downloaded and saved to {output_path}")
-    else:
-        raise Exception(f"Failed to download CSV file. Status code: {response.status_code}")
+    for row in csv.DictReader(lines[:2]):
+        return row.get('Date time')
+    return None
 
+def to_float(text):
+    """
+    Converts a CSV field to float, returning NaN for missing or malformed readings.
+    """
     try:
-        with open(output_path, mode= 'r', encoding= 'utf-8-sig') as file:
-            csv_reader = csv.DictReader(file)
-            print('Reading CSV')
-            for row in csv_reader:
-                try:
-                        #print(row)
-                        datetime = row.get('Date time')
-                        name = row.get('Automatic Weather Station')
-                        T = float(row.get('Air Temperature(degree Celsius)'))
-
-                        if name in stations:
-                            stations[name]['temperature'] = T
-                        else:
-                            print(f'an error occured. {name} station is not in the list of stations.')
-                except Exception as e:
-                    print(f"An error occurred with station {row}: {e}")
-                    print(f"Ignoring the station")
-                    name = row.get('Automatic Weather Station')
-                    T = 'M'
-                    if name in stations:
-                        stations[name]['temperature'] = T
-                    else:
-                        print(f'an error occured. {name} station is not in the list of stations.')
-    except Exception as e:
-        print(f"An error occurred while opening the file: {e}")
+        return float(text)
+    except (TypeError, ValueError):
+        return np.nan
+
+def parse_temperature_csv(lines, stations:StationTable, variable='temperature', column='Air Temperature(degree Celsius)'):
+    """
+    Parses the rows of the 1-minute temperature feed into the station table, see parse_feed_csv.
+    """
+    return parse_feed_csv(lines, stations, variable, column)
+
+def parse_feed_csv(lines, stations:StationTable, variable, column):
+    """
+    Parses the rows of an HKO regional-weather feed into the station table.
+
+    The readings replace the variable's previous values entirely, so a station missing
+    from this feed is marked missing rather than keeping an older reading.
+
+    Parameters:
+    lines (iterable): The lines of the CSV, header first.
+    stations (StationTable): The station table. Its values for `variable` are replaced.
+    variable (str): The name the readings are stored under.
+    column (str): The CSV column holding the readings.
+
+    Returns:
+    stations (StationTable): The updated stations.
+    datetime (str): The observation time of the feed, as YYYYMMDDHHMM.
+    """
+    print(f'Reading {variable} CSV')
+    rows = list(csv.DictReader(lines))
+    datetime = rows[-1].get('Date time') if rows else None
+    names = [row.get('Automatic Weather Station') for row in rows]
+    readings = np.array([to_float(row.get(column)) for row in rows], dtype=float)
+
+    idx = stations.indices(names)
+    for name in np.asarray(names, dtype=object)[idx < 0]:
+        print(f'an error occured. {name} station is not in the list of stations.')
+    for name in np.asarray(names, dtype=object)[(idx >= 0) & np.isnan(readings)]:
+        print(f"Missing reading for station {name}. Ignoring the station")
+
+    values = np.full(len(stations), np.nan)
+    values[idx[idx >= 0]] = readings[idx >= 0]
+    stations.set_values(variable, values)
     return stations, datetime
-    
-def load_station_data(csv_path):
+
+def download_csv(api_link, output_path, stations:StationTable, archive=None):
+    """
+    Downloads a CSV file from the given API link from data.gov.hk, saves it to the specified output path
+    and parses it from memory.
+
+    Parameters:
+    api_link (str): The URL of the API endpoint to download the CSV from.
+    output_path (str): The local path where the CSV file will be saved.
+    stations (StationTable): The station table. Its readings are replaced.
+    archive (ObservationArchive): If given, the snapshot is appended to it.
+
+    Returns:
+    stations (StationTable): The updated stations.
+    datetime (str): The observation time of the feed, as YYYYMMDDHHMM.
+    """
+    text = FeedFetcher(api_link, output_path).fetch_text()
+    print(f"CSV file downloaded and saved to {output_path}")
+    stations, datetime = parse_temperature_csv(text.splitlines(), stations)
+    if archive is not None and datetime is not None:
+        archive.append(stations, datetime)
+    return stations, datetime
+
+def load_station_data(csv_path, *extra_paths):
     """
-    Loads station data from a CSV file and returns a list of dictionaries.
+    Loads station locations from one or more CSV files into a station table.
 
     Parameters:
     csv_path (str): The path to the CSV file containing station data.
+    extra_paths (str): Further station CSVs, e.g. of stations only in the wind or pressure
+        feeds. A station already listed is not added again.
 
     Returns:
-    list: A list of dictionaries, each representing a station with its attributes.
+    StationTable: The stations with their positions and no readings yet.
     """
-    stations = {}
-    with open(csv_path, mode='r', encoding='utf-8-sig') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            name = row['AutomaticWeatherStation_en']
-            lat = float(row['GeometryLatitude'])
-            long = float(row['GeometryLongitude'])
-            stations[name] = {'lat': lat, 'long': long}
-    return stations
+    rows, names = [], set()
+    for path in (csv_path, *extra_paths):
+        with open(path, mode='r', encoding='utf-8-sig') as file:
+            for row in csv.DictReader(file):
+                if row['AutomaticWeatherStation_en'] not in names:
+                    names.add(row['AutomaticWeatherStation_en'])
+                    rows.append(row)
+    return StationTable([row['AutomaticWeatherStation_en'] for row in rows],
+                        [float(row['GeometryLatitude']) for row in rows],
+                        [float(row['GeometryLongitude']) for row in rows])
@@ -0,0 +1,285 @@
+import numpy as np
+from raster_cache import hash_files, shapefile_parts
+import hashlib
+import os
+
+# matplotlib.path.Path codes, spelled out so that loading the cache imports no plotting code.
+MOVETO, LINETO, CLOSEPOLY = 1, 2, 79
+# Outline tolerances are rounded down to LOD_BASE degrees times a power of two, so output
+# sizes and dpis close to each other share one level of detail.
+LOD_BASE = 1e-6
+
+def lod_level(tolerance):
+    """
+    Returns the level of detail for a simplification tolerance in degrees: the largest
+    level whose tolerance, LOD_BASE * 2 ** level, does not exceed it.
+    """
+    return int(np.floor(np.log2(max(tolerance, LOD_BASE) / LOD_BASE)))
+
+class Outlines:
+    """
+    The district borders at one level of detail, as ready-to-draw path arrays.
+
+    Every border is one arc, however many districts it separates, so it is simplified once
+    and neighbouring districts stay joined at any tolerance; arcs meet only at their end
+    points, which simplification keeps. Arcs are grouped by the number of districts sharing
+    them, one along the coast and two inland, so that inland borders can be drawn as dark as
+    the overlapping strokes of two polygon outlines.
+    """
+
+    def __init__(self, coords, codes, offsets, shared, tolerance):
+        """
+        Parameters:
+        coords (numpy.ndarray): The (n x 2) vertices of all arcs, in lon/lat.
+        codes (numpy.ndarray): The matplotlib path code of every vertex.
+        offsets (numpy.ndarray): Where each group of arcs starts in coords, plus the end.
+        shared (numpy.ndarray): The number of districts sharing the arcs of each group.
+        tolerance (float): The simplification tolerance in degrees.
+        """
+        self.coords = np.asarray(coords, dtype=float)
+        self.codes = np.asarray(codes, dtype=np.uint8)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.shared = np.asarray(shared, dtype=np.int64)
+        self.tolerance = float(tolerance)
+
+    def paths(self):
+        """
+        Returns:
+        list: One compound matplotlib Path per group of arcs, in the order of shared.
+        """
+        from matplotlib.path import Path
+        return [Path(self.coords[start:stop], self.codes[start:stop]) for start, stop in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def save(self, path):
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, coords=self.coords, codes=self.codes, offsets=self.offsets, shared=self.shared, tolerance=self.tolerance)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['coords'], data['codes'], data['offsets'], data['shared'], float(data['tolerance']))
+
+def build_outlines(geometry, tolerance):
+    """
+    Splits district boundaries into arcs that are each drawn once, and simplifies them.
+
+    Parameters:
+    geometry (numpy.ndarray): The district polygons as shapely geometries.
+    tolerance (float): The Douglas-Peucker tolerance in degrees. Closed arcs, i.e. islands,
+        smaller than this are left out.
+
+    Returns:
+    Outlines: The simplified arcs.
+    """
+    import shapely
+    boundaries = shapely.boundary(geometry)
+    # The union nodes the boundaries, so a border between two districts comes out once,
+    # and line_merge joins the pieces between junctions into arcs.
+    arcs = shapely.get_parts(shapely.line_merge(shapely.union_all(boundaries)))
+    midpoints = shapely.line_interpolate_point(arcs, 0.5, normalized=True)
+    arc_idx, _ = shapely.STRtree(boundaries).query(midpoints, predicate='dwithin', distance=1e-9)
+    shared = np.maximum(np.bincount(arc_idx, minlength=len(arcs)), 1)
+
+    xmin, ymin, xmax, ymax = shapely.bounds(arcs).T
+    closed = shapely.is_closed(arcs)
+    keep = ~closed | (np.maximum(xmax - xmin, ymax - ymin) >= tolerance)
+    arcs, shared, closed = arcs[keep], shared[keep], closed[keep]
+    arcs = shapely.simplify(arcs, tolerance, preserve_topology=True)
+
+    order = np.argsort(shared, kind='stable')
+    arcs, shared, closed = arcs[order], shared[order], closed[order]
+    coords = shapely.get_coordinates(arcs)
+    counts = shapely.get_num_coordinates(arcs)
+    ends = np.cumsum(counts)
+    codes = np.full(len(coords), LINETO, dtype=np.uint8)
+    codes[ends - counts] = MOVETO
+    # Islands are closed as cartopy closes polygon rings, so their first corner is joined.
+    codes[(ends - 1)[closed]] = CLOSEPOLY
+
+    groups, first = np.unique(shared, return_index=True)
+    offsets = np.append((ends - counts)[first], len(coords))
+    return Outlines(coords, codes, offsets, groups, tolerance)
+
+class DistrictGeometry:
+    """
+    The district polygons of a shapefile as packed coordinate arrays.
+
+    The polygons are kept in shapely's ragged-array layout: one (n x 2) coordinate array
+    plus offset arrays mapping districts to polygons, polygons to rings and rings to
+    coordinates. That loads from a single .npz without geopandas or pandas, draws directly
+    as matplotlib paths, and is turned back into shapely geometries only when a mask or
+    label raster has to be rebuilt.
+    """
+
+    def __init__(self, names, geometry_type, coords, offsets, crs=None):
+        """
+        Parameters:
+        names (list): One name per district.
+        geometry_type (int): The shapely.GeometryType of the ragged arrays, POLYGON or MULTIPOLYGON.
+        coords (numpy.ndarray): The (n x 2) vertex coordinates of all rings, each ring closed.
+        offsets (tuple): The offset arrays from shapely.to_ragged_array, innermost (rings) first.
+        crs (str): The coordinate reference system of the shapefile, for reference.
+        """
+        self.names = list(names)
+        self.geometry_type = int(geometry_type)
+        self.coords = np.asarray(coords, dtype=float)
+        self.offsets = tuple(np.asarray(o, dtype=np.int64) for o in offsets)
+        self.crs = crs
+        self._geometry = None
+        # Where the geometry is cached, which its levels of detail are cached next to.
+        self.path = None
+        self._outlines = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def geometry(self):
+        """
+        numpy.ndarray: The district geometries as shapely objects, built on first use.
+        """
+        if self._geometry is None:
+            import shapely
+            self._geometry = shapely.from_ragged_array(shapely.GeometryType(self.geometry_type), self.coords, self.offsets)
+        return self._geometry
+
+    def ring_ranges(self, district):
+        """
+        Returns the first and one-past-last coordinate of a district's rings, and its ring offsets.
+        """
+        # Walk down from districts to polygons (if multi) to rings.
+        start, stop = district, district + 1
+        for offsets in reversed(self.offsets[1:]):
+            start, stop = offsets[start], offsets[stop]
+        ring_offsets = self.offsets[0][start:stop + 1]
+        return ring_offsets[0], ring_offsets[-1], ring_offsets
+
+    def codes(self):
+        """
+        Returns:
+        numpy.ndarray: The matplotlib path code of every coordinate: MOVETO at the start of a
+        ring, CLOSEPOLY at its closing vertex and LINETO elsewhere, as cartopy draws polygons.
+        """
+        ring_offsets = self.offsets[0]
+        codes = np.full(len(self.coords), LINETO, dtype=np.uint8)
+        nonempty = ring_offsets[1:] > ring_offsets[:-1]
+        codes[ring_offsets[:-1][nonempty]] = MOVETO
+        codes[ring_offsets[1:][nonempty] - 1] = CLOSEPOLY
+        return codes
+
+    def paths(self):
+        """
+        Returns:
+        list: One compound matplotlib Path per district, in lon/lat.
+        """
+        from matplotlib.path import Path
+        codes = self.codes()
+        paths = []
+        for district in range(len(self)):
+            start, stop, _ = self.ring_ranges(district)
+            paths.append(Path(self.coords[start:stop], codes[start:stop]))
+        return paths
+
+    def outlines(self, tolerance):
+        """
+        Returns the district borders simplified for drawing, at the level of detail of a tolerance.
+
+        Each level is built once and cached in memory and, for a geometry loaded with
+        load_district_geometry, next to its cache entry as <key>.lod<level>.npz.
+
+        Parameters:
+        tolerance (float): The largest error allowed in degrees, e.g. half the size of an output pixel.
+
+        Returns:
+        Outlines: The borders at the nearest level of detail at or below the tolerance.
+        """
+        level = lod_level(tolerance)
+        if level not in self._outlines:
+            lod_path = None if self.path is None else f'{os.path.splitext(self.path)[0]}.lod{level}.npz'
+            if lod_path is not None and os.path.exists(lod_path):
+                self._outlines[level] = Outlines.load(lod_path)
+            else:
+                self._outlines[level] = build_outlines(self.geometry, LOD_BASE * 2 ** level)
+                if lod_path is not None:
+                    self._outlines[level].save(lod_path)
+                    print(f"District outlines at {LOD_BASE * 2 ** level:.2g} degrees saved next to {self.path}")
+        return self._outlines[level]
+
+    def save(self, path):
+        """
+        Writes the geometry to an .npz file, under a temporary name first.
+        """
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        arrays = {f'offsets_{i}': o for i, o in enumerate(self.offsets)}
+        np.savez(tmp_path, names=np.array(self.names, dtype=str), geometry_type=self.geometry_type,
+                 coords=self.coords, crs=np.array('' if self.crs is None else str(self.crs)), **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a geometry written by save.
+        """
+        with np.load(path) as data:
+            offsets = [data[f'offsets_{i}'] for i in range(3) if f'offsets_{i}' in data]
+            crs = str(data['crs']) or None
+            return cls(data['names'].tolist(), int(data['geometry_type']), data['coords'], offsets, crs)
+
+    @classmethod
+    def from_geodataframe(cls, gdf, name_column):
+        """
+        Packs the polygons of a GeoDataFrame.
+
+        Parameters:
+        gdf (GeoDataFrame): One row per district.
+        name_column (str): The column holding the district names.
+
+        Returns:
+        DistrictGeometry: The packed polygons.
+        """
+        import shapely
+        geometry_type, coords, offsets = shapely.to_ragged_array(np.asarray(gdf.geometry))
+        return cls(gdf[name_column].tolist(), geometry_type, coords, offsets, gdf.crs)
+
+def geometry_key(shapefile_path, name_column):
+    """
+    Builds a content-addressed key for the packed geometry of a shapefile.
+    """
+    digest = hashlib.sha256(f'district_geometry:{name_column}'.encode())
+    return hash_files(shapefile_parts(shapefile_path), digest).hexdigest()
+
+def load_district_geometry(shapefile_path, cache_dir, name_column='ENAME'):
+    """
+    Loads the district polygons of a shapefile, from the packed cache when possible.
+
+    The shapefile is read with geopandas only when the cache has no entry for its current
+    contents; the entry is then written for subsequent runs.
+
+    Parameters:
+    shapefile_path (str): The path to the .shp file.
+    cache_dir (str): The directory holding cached geometry and rasters.
+    name_column (str): The column holding the district names.
+
+    Returns:
+    DistrictGeometry: The district polygons.
+    """
+    key = geometry_key(shapefile_path, name_column)
+    path = os.path.join(cache_dir, key + '.npz')
+    if os.path.exists(path):
+        geometry = DistrictGeometry.load(path)
+        geometry.path = path
+        os.utime(path)
+        print(f"District geometry {key[:12]} loaded from {cache_dir}")
+        return geometry
+
+    print("No cached district geometry for this shapefile. Reading it.")
+    import geopandas as gpd
+    gdf = gpd.read_file(shapefile_path)
+    print("CRS of the shapefile:", gdf.crs)
+    geometry = DistrictGeometry.from_geodataframe(gdf, name_column)
+    os.makedirs(cache_dir, exist_ok=True)
+    geometry.save(path)
+    geometry.path = path
+    print(f"District geometry {key[:12]} saved to {cache_dir}")
+    return geometry
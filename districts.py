@@ -0,0 +1,175 @@
+import numpy as np
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+from raster_cache import RasterCache, raster_key, shapefile_parts
+import csv
+import json
+import os
+
+def district_labels(gdf, xi, yi, shapefile_path, cache_dir, n_workers=None):
+    """
+    Builds the district-ID raster of a grid and stores it in the raster cache for subsequent use.
+
+    Uses the same engine and cache as the ocean mask: each district polygon is prepared and
+    tested with shapely's vectorized contains_xy, restricted to the grid block covering its
+    bounding box, with the districts tested concurrently.
+
+    Parameters:
+    gdf (DistrictGeometry or GeoDataFrame): The district polygons, one row per district.
+    xi (numpy.ndarray): The longitudes of the grid columns.
+    yi (numpy.ndarray): The latitudes of the grid rows.
+    shapefile_path (str): The shapefile gdf was read from.
+    cache_dir (str): The directory holding cached rasters.
+    n_workers (int): Number of threads. Defaults to the number of CPUs.
+
+    Returns:
+    numpy.ndarray: A (rows x columns) uint8 raster holding 1 + the gdf row of the district
+    each cell lies in, and 0 for cells outside every district.
+    """
+    nx, ny = len(xi), len(yi)
+    extent = (xi[0], xi[-1], yi[0], yi[-1])
+    cache = RasterCache(cache_dir)
+    key = raster_key('district_labels', extent, nx, ny, shapefile_parts(shapefile_path))
+
+    labels = cache.load(key, (ny, nx))
+    if labels is not None:
+        print(f"District labels {key[:12]} loaded from {cache_dir}")
+        return labels
+
+    print("No cached district labels for this grid and shapefile. Generating them.")
+    geometries = np.asarray(gdf.geometry)
+    if len(geometries) > 255:
+        raise ValueError(f"At most 255 districts fit in a uint8 raster, got {len(geometries)}")
+
+    def test_district(geometry):
+        shapely.prepare(geometry)
+        minx, miny, maxx, maxy = geometry.bounds
+        c0, c1 = np.searchsorted(xi, minx, side='left'), np.searchsorted(xi, maxx, side='right')
+        r0, r1 = np.searchsorted(yi, miny, side='left'), np.searchsorted(yi, maxy, side='right')
+        return r0, r1, c0, c1, shapely.contains_xy(geometry, xi[c0:c1][None, :], yi[r0:r1][:, None])
+
+    with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count() or 1) as pool:
+        blocks = list(pool.map(test_district, geometries))
+
+    labels = np.zeros((ny, nx), dtype=np.uint8)
+    for i, (r0, r1, c0, c1, inside) in enumerate(blocks):
+        labels[r0:r1, c0:c1][inside] = i + 1
+    cache.store(key, labels, kind='district_labels', extent=[float(v) for v in extent], nx=nx, ny=ny)
+    print(f"District labels {key[:12]} saved to {cache_dir}")
+    return labels
+
+class DistrictStats:
+    """
+    Per-district mean/min/max of a gridded field, from a district-ID raster.
+
+    The cells of each district are sorted into contiguous runs once, when the object is
+    built. A frame's statistics are then one gather of the field followed by a bincount for
+    the counts and means and an fmin/fmax reduceat over the runs, with no polygon work.
+    """
+
+    def __init__(self, names, labels):
+        """
+        Parameters:
+        names (list): The district names, in the order of the labels (label i + 1 is names[i]).
+        labels (numpy.ndarray): The raster from district_labels.
+        """
+        self.names = list(names)
+        self._labels = flat = np.ravel(labels)
+        cells = np.flatnonzero(flat)
+        self._order = cells[np.argsort(flat[cells], kind='stable')]
+        self._district = flat[self._order].astype(np.intp) - 1
+        self.cells = np.bincount(self._district, minlength=len(self.names))
+        self._nonempty = np.flatnonzero(self.cells)
+        self._offsets = np.cumsum(self.cells) - self.cells
+        self._starts = self._offsets[self._nonempty]
+
+    def compute(self, Z):
+        """
+        Computes the statistics of one field.
+
+        Parameters:
+        Z (array-like): The field on the grid the labels were built for. Masked and NaN
+            cells are left out.
+
+        Returns:
+        dict: 'district', 'cells' (cells with a value), 'mean', 'min' and 'max', each a list
+        or array aligned with the district names. NaN where a district has no value.
+        """
+        values = np.ravel(np.ma.filled(Z, np.nan)).astype(float)[self._order]
+        valid = np.isfinite(values)
+        count = np.bincount(self._district[valid], minlength=len(self.names))
+        total = np.bincount(self._district[valid], weights=values[valid], minlength=len(self.names))
+
+        minimum = np.full(len(self.names), np.nan)
+        maximum = np.full(len(self.names), np.nan)
+        if len(self._nonempty):
+            # fmin/fmax skip NaN cells unless a whole district is NaN.
+            minimum[self._nonempty] = np.fmin.reduceat(values, self._starts)
+            maximum[self._nonempty] = np.fmax.reduceat(values, self._starts)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+        return {'district': self.names, 'cells': count, 'mean': mean, 'min': minimum, 'max': maximum}
+
+    def update(self, stats, Z, cells):
+        """
+        Updates the statistics of a field in place after some of its cells have changed.
+        Only the districts containing a changed cell are computed again.
+
+        Parameters:
+        stats (dict): The result of compute for the field before the change.
+        Z (array-like): The changed field.
+        cells (array-like): The flat grid indices of the changed cells.
+
+        Returns:
+        dict: stats, updated.
+        """
+        touched = np.unique(self._labels[np.asarray(cells, dtype=np.intp)])
+        flat = np.ravel(Z)
+        for district in touched[touched > 0].astype(np.intp) - 1:
+            start = self._offsets[district]
+            values = np.ma.filled(flat[self._order[start:start + self.cells[district]]], np.nan).astype(float)
+            valid = np.isfinite(values)
+            stats['cells'][district] = valid.sum()
+            stats['mean'][district] = values[valid].mean() if valid.any() else np.nan
+            stats['min'][district] = np.fmin.reduce(values)
+            stats['max'][district] = np.fmax.reduce(values)
+        return stats
+
+    def write(self, stats, csv_path, json_path, datetime_str):
+        """
+        Writes the statistics of one frame as CSV and JSON. Both files are written under
+        temporary names and renamed into place.
+
+        Parameters:
+        stats (dict): The result of compute.
+        csv_path (str): The CSV output path.
+        json_path (str): The JSON output path.
+        datetime_str (str): The observation time, as YYYYMMDDHHMM.
+
+        Returns:
+        None
+        """
+        rows = []
+        for i, name in enumerate(stats['district']):
+            rows.append({
+                'district': name,
+                'cells': int(stats['cells'][i]),
+                'mean': _rounded(stats['mean'][i]),
+                'min': _rounded(stats['min'][i]),
+                'max': _rounded(stats['max'][i]),
+            })
+
+        with open(csv_path + '.tmp', 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=['datetime', 'district', 'cells', 'mean', 'min', 'max'])
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({'datetime': datetime_str, **{k: '' if v is None else v for k, v in row.items()}})
+        os.replace(csv_path + '.tmp', csv_path)
+
+        with open(json_path + '.tmp', 'w') as file:
+            json.dump({'datetime': datetime_str, 'districts': rows}, file, indent=1)
+        os.replace(json_path + '.tmp', json_path)
+
+def _rounded(value):
+    return None if np.isnan(value) else round(float(value), 2)
@@ -0,0 +1,367 @@
+import numpy as np
+from datetime import datetime, timedelta
+from variables import VARIABLES
+import json
+import zlib
+import os
+
+# Frames are stored as int16 in units of 1/SCALE around an offset per variable (see
+# quantization), which keeps 0.01 resolution over +-327 units. MISSING marks cells over the ocean or outside the hull.
+SCALE = 100
+MISSING = np.iinfo(np.int16).min
+# Rows of the grid per compressed chunk, so a window of a large grid is read without
+# decompressing the whole frame.
+CHUNK_ROWS = 256
+MINUTES_PER_DAY = 24 * 60
+# The units of variables.VARIABLES as CF conventions (UDUNITS) spell them.
+CF_UNITS = {'°C': 'degC', '%': 'percent', 'km/h': 'km h-1'}
+
+def quantization(variable):
+    """
+    Returns the scale factor and offset a variable's values are packed with: value =
+    stored * scale_factor + add_offset, as CF conventions define them.
+    """
+    levels = VARIABLES[variable].levels
+    return 1.0 / SCALE, float(np.round((levels[0] + levels[-1]) / 2))
+
+def encode_rows(q, level=6):
+    """
+    Compresses a block of int16 grid rows. Each row is stored as the differences between
+    neighbouring cells, which are small over an interpolated field; that roughly halves
+    the compressed size. The differences wrap around in int16 and are undone exactly.
+    """
+    delta = np.diff(q, axis=1, prepend=np.int16(0)).astype('<i2')
+    return zlib.compress(delta.tobytes(), level)
+
+def decode_rows(data, n_columns):
+    """
+    Decompresses a block written by encode_rows.
+    """
+    delta = np.frombuffer(zlib.decompress(data), dtype='<i2').reshape(-1, n_columns)
+    return np.cumsum(delta, axis=1, dtype=np.int16)
+
+class GridStore:
+    """
+    Append-only store of interpolated fields, one frame per minute, for consumers that need
+    the numbers rather than an image. It imports no plotting code.
+
+    Each variable and grid has a directory <store_dir>/<variable>/<nx>x<ny>/ holding one
+    pair of files per day:
+    - <YYYYMMDD>.grid: the compressed chunks, appended one after the other;
+    - <YYYYMMDD>.index.npy: (minutes in day x (1 + chunks) x 2) offsets and lengths into
+      the .grid file, -1 for a minute without a frame.
+    As in the observation archive, the minute of a frame is its row in the index. Appending
+    a frame adds its chunks to the end of the .grid file and then points its row at them,
+    the header entry last, so a reader that finds the header of a new minute finds all its
+    chunks. Writing the same minute again leaves the old bytes unreferenced; a reader racing
+    that replacement may read the new frame's rows under the old header.
+
+    The first chunk of a frame is its JSON header: time, variable, extent, shape, packing
+    and the station readings it was interpolated from. The others hold CHUNK_ROWS grid rows
+    each, quantized to int16 (see quantization) and compressed with encode_rows, about
+    20 kB per 400x400 temperature frame.
+    """
+
+    def __init__(self, store_dir):
+        """
+        Parameters:
+        store_dir (str): The directory holding the store. Created when the first frame is written.
+        """
+        self.store_dir = store_dir
+        # grid directory -> (path, memmap) of the day last written to, kept open for writing.
+        self._index = {}
+
+    def _grid_dir(self, variable, shape):
+        ny, nx = shape
+        return os.path.join(self.store_dir, variable, f'{nx}x{ny}')
+
+    def grids(self, variable):
+        """
+        Returns:
+        list: The (ny, nx) shapes of the grids the variable has frames on.
+        """
+        try:
+            names = os.listdir(os.path.join(self.store_dir, variable))
+        except FileNotFoundError:
+            return []
+        shapes = []
+        for name in sorted(names):
+            nx, _, ny = name.partition('x')
+            if nx.isdigit() and ny.isdigit():
+                shapes.append((int(ny), int(nx)))
+        return shapes
+
+    def _day_index(self, grid_dir, day, n_chunks, create=False):
+        """
+        Opens the index of a day, creating it when writing. Returns None if the day has no
+        frames and create is False. Only the index of the day last written to stays open.
+        """
+        path = os.path.join(grid_dir, f'{day}.index.npy')
+        cached_path, index = self._index.get(grid_dir, (None, None))
+        if cached_path != path:
+            index = None
+        if index is None and os.path.exists(path):
+            index = np.load(path, mmap_mode='r+' if create else 'r')
+        if index is None and create:
+            os.makedirs(grid_dir, exist_ok=True)
+            index = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.int64, shape=(MINUTES_PER_DAY, 1 + n_chunks, 2))
+            index[:] = -1
+            index.flush()
+            del index
+            os.replace(path + '.tmp', path)
+            index = np.load(path, mmap_mode='r+')
+        if index is not None and create:
+            self._index[grid_dir] = (path, index)
+        return index
+
+    def append(self, X, Y, Z, stations, datetime_str, variable='temperature'):
+        """
+        Writes one frame. Writing the same minute again replaces it.
+
+        Parameters:
+        X (array-like): Longitudes of the grid points, 2-D or the 1-D grid axis.
+        Y (array-like): Latitudes of the grid points, 2-D or the 1-D grid axis.
+        Z (array-like): The field, masked or NaN over the ocean.
+        stations (StationTable): The station table holding the frame's readings.
+        datetime_str (str): The observation time, as YYYYMMDDHHMM.
+        variable (str): The variable of the frame.
+
+        Returns:
+        int: The number of bytes the frame takes on disk.
+        """
+        xi = X[0] if np.ndim(X) == 2 else np.asarray(X)
+        yi = Y[:, 0] if np.ndim(Y) == 2 else np.asarray(Y)
+        Z = np.ma.filled(Z.astype(float), np.nan) if np.ma.isMaskedArray(Z) else np.asarray(Z)
+        dt = datetime.strptime(datetime_str, "%Y%m%d%H%M")
+        scale_factor, add_offset = quantization(variable)
+        values = stations.get(variable)
+        valid = np.isfinite(values)
+        header = {
+            'datetime': datetime_str,
+            'variable': variable,
+            'units': VARIABLES[variable].unit,
+            'shape': list(Z.shape),
+            'lon': [float(xi[0]), float(xi[-1])],
+            'lat': [float(yi[0]), float(yi[-1])],
+            'scale_factor': scale_factor,
+            'add_offset': add_offset,
+            'missing_value': int(MISSING),
+            'chunk_rows': CHUNK_ROWS,
+            'stations': {
+                'names': [stations.names[i] for i in np.flatnonzero(valid)],
+                'lon': stations.lon[valid].tolist(),
+                'lat': stations.lat[valid].tolist(),
+                'values': values[valid].tolist(),
+            },
+        }
+
+        chunks = [zlib.compress(json.dumps(header).encode())]
+        for start in range(0, Z.shape[0], CHUNK_ROWS):
+            block = Z[start:start + CHUNK_ROWS]
+            q = np.full(block.shape, MISSING, dtype=np.int16)
+            finite = np.isfinite(block)
+            q[finite] = np.clip(np.round((block[finite] - add_offset) / scale_factor), MISSING + 1, np.iinfo(np.int16).max)
+            chunks.append(encode_rows(q))
+
+        grid_dir = self._grid_dir(variable, Z.shape)
+        day = dt.strftime('%Y%m%d')
+        index = self._day_index(grid_dir, day, len(chunks) - 1, create=True)
+        with open(os.path.join(grid_dir, f'{day}.grid'), 'ab') as file:
+            offset = file.seek(0, os.SEEK_END)
+            for chunk in chunks:
+                file.write(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+        lengths = np.array([len(chunk) for chunk in chunks], dtype=np.int64)
+        starts = offset + np.concatenate([[0], np.cumsum(lengths[:-1])])
+        row = index[dt.hour * 60 + dt.minute]
+        row[1:] = np.column_stack([starts[1:], lengths[1:]])
+        row[0] = starts[0], lengths[0]
+        index.flush()
+        return int(lengths.sum())
+
+    def frames(self, start, end, variable='temperature', shape=None, rows=None):
+        """
+        Reads the frames between two times, inclusive, one at a time.
+
+        Parameters:
+        start (datetime or str): The first minute, as a datetime or YYYYMMDDHHMM.
+        end (datetime or str): The last minute, as a datetime or YYYYMMDDHHMM.
+        variable (str): The variable to read.
+        shape (tuple): The (ny, nx) grid to read. May be left out if the variable has frames on one grid only.
+        rows (slice): The grid rows to read, south first. Only the chunks holding them are decompressed.
+
+        Yields:
+        tuple: (header, field) per frame, where header is the frame's metadata (see the class
+        docstring) and field a float32 array of the requested rows, NaN where missing.
+        """
+        start = datetime.strptime(start, "%Y%m%d%H%M") if isinstance(start, str) else start.replace(second=0, microsecond=0)
+        end = datetime.strptime(end, "%Y%m%d%H%M") if isinstance(end, str) else end.replace(second=0, microsecond=0)
+        if shape is None:
+            shapes = self.grids(variable)
+            if len(shapes) != 1:
+                raise ValueError(f"{variable} has frames on grids {shapes}; pass the shape to read")
+            shape = shapes[0]
+        ny, nx = shape
+        first_row, last_row, _ = (rows or slice(None)).indices(ny)
+        grid_dir = self._grid_dir(variable, shape)
+
+        day = datetime(start.year, start.month, start.day)
+        while day <= end:
+            name = day.strftime('%Y%m%d')
+            index = self._day_index(grid_dir, name, 0)
+            if index is not None:
+                first = max(int((start - day).total_seconds() // 60), 0)
+                last = min(int((end - day).total_seconds() // 60), MINUTES_PER_DAY - 1)
+                present = first + np.flatnonzero(index[first:last + 1, 0, 1] >= 0)
+                if len(present):
+                    with open(os.path.join(grid_dir, f'{name}.grid'), 'rb') as file:
+                        for minute in present:
+                            yield self._read_frame(file, np.array(index[minute]), nx, first_row, last_row)
+            day += timedelta(days=1)
+
+    def _read_frame(self, file, row, nx, first_row, last_row):
+        file.seek(row[0, 0])
+        header = json.loads(zlib.decompress(file.read(row[0, 1])))
+        chunk_rows = header['chunk_rows']
+        field = np.empty((max(last_row - first_row, 0), nx), dtype=np.float32)
+        for chunk in range(first_row // chunk_rows, -(-last_row // chunk_rows)):
+            file.seek(row[1 + chunk, 0])
+            q = decode_rows(file.read(row[1 + chunk, 1]), nx)
+            lo, hi = max(first_row, chunk * chunk_rows), min(last_row, (chunk + 1) * chunk_rows)
+            block = q[lo - chunk * chunk_rows:hi - chunk * chunk_rows]
+            out = field[lo - first_row:hi - first_row]
+            np.multiply(block, header['scale_factor'], out=out, dtype=np.float32)
+            out += header['add_offset']
+            out[block == MISSING] = np.nan
+        return header, field
+
+    def read(self, start, end, variable='temperature', shape=None, rows=None):
+        """
+        Reads the frames between two times, inclusive, into one array. See frames.
+
+        Returns:
+        times (numpy.ndarray): The minutes with a frame, as datetime64[m].
+        fields (numpy.ndarray): A (frames x rows x columns) float32 array, NaN where missing.
+        headers (list): The metadata of each frame.
+        """
+        headers, fields = [], []
+        for header, field in self.frames(start, end, variable, shape, rows):
+            headers.append(header)
+            fields.append(field)
+        times = np.array([datetime.strptime(h['datetime'], "%Y%m%d%H%M") for h in headers], dtype='datetime64[m]')
+        fields = np.stack(fields) if fields else np.empty((0, 0, 0), dtype=np.float32)
+        return times, fields, headers
+
+def export(store, path, start, end, variable='temperature', shape=None):
+    """
+    Writes the frames between two times to a single file for tools that do not read the
+    store: NetCDF (.nc) or a compressed numpy archive (.npz), chosen by the file extension.
+
+    The NetCDF file follows CF conventions, with an unlimited time dimension and the field
+    packed as int16 with scale_factor and add_offset. It is written in NetCDF-4 with zlib
+    compression when the netCDF4 package is installed, and as uncompressed NetCDF-3 through
+    scipy otherwise.
+
+    Parameters:
+    store (GridStore): The store to read from.
+    path (str): The output file, ending in .nc or .npz.
+    start (datetime or str): The first minute.
+    end (datetime or str): The last minute.
+    variable (str): The variable to export.
+    shape (tuple): The (ny, nx) grid, see GridStore.frames.
+
+    Returns:
+    int: The number of frames written.
+    """
+    times, fields, headers = store.read(start, end, variable, shape)
+    if not headers:
+        return 0
+    header = headers[-1]
+    ny, nx = header['shape']
+    lon = np.linspace(*header['lon'], nx)
+    lat = np.linspace(*header['lat'], ny)
+    minutes = (times - np.datetime64('1970-01-01T00:00', 'm')).astype(np.int64)
+    # Station readings as a (frames x stations) matrix over every station seen in the range.
+    names = sorted({name for h in headers for name in h['stations']['names']})
+    column = {name: i for i, name in enumerate(names)}
+    station_lon, station_lat = np.full(len(names), np.nan), np.full(len(names), np.nan)
+    station_values = np.full((len(headers), len(names)), np.nan, dtype=np.float32)
+    for i, h in enumerate(headers):
+        s = h['stations']
+        idx = [column[name] for name in s['names']]
+        station_lon[idx], station_lat[idx], station_values[i, idx] = s['lon'], s['lat'], s['values']
+
+    if path.endswith('.npz'):
+        np.savez_compressed(path, time=times, lon=lon, lat=lat, **{variable: fields}, station_names=np.array(names, dtype=str),
+                            station_lon=station_lon, station_lat=station_lat, station_values=station_values,
+                            units=np.array(header['units']))
+        return len(headers)
+    if not path.endswith('.nc'):
+        raise ValueError(f"Unknown export format of {path}, expected .nc or .npz")
+
+    packed = np.full(fields.shape, MISSING, dtype=np.int16)
+    finite = np.isfinite(fields)
+    packed[finite] = np.round((fields[finite] - header['add_offset']) / header['scale_factor'])
+    try:
+        import netCDF4
+    except ImportError:
+        netCDF4 = None
+
+    if netCDF4 is not None:
+        dataset = netCDF4.Dataset(path, 'w', format='NETCDF4')
+        dataset.set_auto_maskandscale(False)
+        create = lambda name, dtype, dims, **kw: dataset.createVariable(name, dtype, dims, zlib=True, complevel=4, **kw)
+        field_options = {'chunksizes': (1, min(ny, CHUNK_ROWS), min(nx, CHUNK_ROWS)), 'fill_value': MISSING}
+    else:
+        from scipy.io import netcdf_file
+        dataset = netcdf_file(path, 'w', version=2)
+        create = lambda name, dtype, dims, **kw: dataset.createVariable(name, dtype, dims)
+        field_options = {}
+
+    try:
+        dataset.Conventions = 'CF-1.8'
+        dataset.title = f'Hong Kong interpolated {variable}'
+        dataset.stations = ';'.join(names)
+        dataset.createDimension('time', None)
+        dataset.createDimension('lat', ny)
+        dataset.createDimension('lon', nx)
+        dataset.createDimension('station', len(names))
+        for name, values, units in (('lat', lat, 'degrees_north'), ('lon', lon, 'degrees_east')):
+            var = create(name, 'f8', (name,))
+            var[:] = values
+            var.units = units
+        var = create('time', 'i4', ('time',))
+        var[:len(minutes)] = minutes
+        var.units = 'minutes since 1970-01-01 00:00:00'
+        var = create(variable, 'i2', ('time', 'lat', 'lon'), **field_options)
+        var[:len(packed)] = packed
+        var.units = CF_UNITS.get(header['units'], header['units'])
+        var.scale_factor = header['scale_factor']
+        var.add_offset = header['add_offset']
+        if netCDF4 is None:
+            var._FillValue = np.int16(MISSING)
+        for name, values in (('station_lon', station_lon), ('station_lat', station_lat)):
+            var = create(name, 'f8', ('station',))
+            var[:] = values
+        var = create(f'station_{variable}', 'f4', ('time', 'station'))
+        var[:len(station_values)] = station_values
+        var.units = CF_UNITS.get(header['units'], header['units'])
+    finally:
+        dataset.close()
+    return len(headers)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Export interpolated fields from the grid store to NetCDF or npz.')
+    parser.add_argument('output', help='output file, .nc or .npz')
+    parser.add_argument('--store', default='output/grid', help='grid store directory')
+    parser.add_argument('--variable', default='temperature', choices=list(VARIABLES))
+    parser.add_argument('--start', required=True, help='first minute, YYYYMMDDHHMM')
+    parser.add_argument('--end', required=True, help='last minute, YYYYMMDDHHMM')
+    parser.add_argument('--resolution', type=int, default=None, help='grid points per side, if frames exist on several grids')
+    args = parser.parse_args()
+
+    shape = None if args.resolution is None else (args.resolution, args.resolution)
+    count = export(GridStore(args.store), args.output, args.start, args.end, args.variable, shape)
+    print(f"{count} frames written to {args.output}")
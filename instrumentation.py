@@ -0,0 +1,298 @@
+from contextlib import contextmanager
+import tracemalloc
+import threading
+import cProfile
+import json
+import time
+import os
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# The recorder stages are reported to, set by StageRecorder.activate. Stages run while
+# no recorder is active cost two clock reads and are dropped.
+_ACTIVE = None
+
+def rss_bytes():
+    """
+    Returns the current resident set size of the process in bytes, or None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def peak_rss_bytes():
+    """
+    Returns the highest resident set size the process has reached so far in bytes, or None if unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+class StageRecorder:
+    """
+    Records the wall time and memory of each pipeline stage of a run, and writes the run
+    as a JSON line and as a Prometheus textfile.
+
+    Stages are reported with the module-level stage() context manager, which may be
+    nested and may carry labels such as the variable; a nested stage is reported as
+    parent.child with the parent's labels. Each stage records its wall time,
+    the resident set size at its end and the process's peak resident set size so far. With
+    trace_memory, it also records the peak of memory allocated through Python and numpy
+    during the stage, from tracemalloc; that slows allocations down, so it is opt-in.
+    """
+
+    def __init__(self, trace_memory=False):
+        """
+        Parameters:
+        trace_memory (bool): Whether to record the allocation peak of each stage with tracemalloc.
+        """
+        self.trace_memory = trace_memory
+        self.records = []
+        self.started = None
+        self.finished = None
+        # Gauges set with gauge(), e.g. by background threads. They hold their latest value
+        # and are kept from run to run.
+        self.gauges = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def activate(self):
+        """
+        Makes this the recorder stage() reports to, and starts a run.
+        """
+        global _ACTIVE
+        _ACTIVE = self
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.start_run()
+        return self
+
+    def start_run(self):
+        self.records = []
+        self.started = time.time()
+        self.finished = None
+
+    def finish_run(self):
+        self.finished = time.time()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name, **labels):
+        stack = self._stack()
+        # Nested stages inherit the labels of the enclosing ones.
+        labels = {**(stack[-1][2] if stack else {}), **{k: str(v) for k, v in labels.items()}}
+        # [name, peak of the finished child stages, labels]
+        frame = [name, 0, labels]
+        if self.trace_memory:
+            # The peak of the enclosing stage so far is lost by reset_peak, so keep it first.
+            if stack:
+                stack[-1][1] = max(stack[-1][1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            record = {
+                'stage': '.'.join([f[0] for f in stack] + [name]),
+                'labels': labels,
+                'seconds': seconds,
+                'rss_bytes': rss_bytes(),
+                'peak_rss_bytes': peak_rss_bytes(),
+            }
+            if self.trace_memory:
+                # Children hand their peak up the stack, as reset_peak hides it from the parent.
+                peak = max(tracemalloc.get_traced_memory()[1], frame[1])
+                record['traced_peak_bytes'] = peak
+                if stack:
+                    stack[-1][1] = max(stack[-1][1], peak)
+            with self._lock:
+                self.records.append(record)
+
+    def gauge(self, name, value, help_text='', **labels):
+        labels = {k: str(v) for k, v in labels.items()}
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = {'gauge': name, 'labels': labels, 'value': value, 'help': help_text}
+
+    def summary(self):
+        """
+        Sums the records of the run by stage and labels.
+
+        Returns:
+        list: One dict per stage and label set with 'stage', 'labels', 'calls', 'seconds' and
+        the largest memory figures seen, in the order the stages first finished.
+        """
+        summary = {}
+        for record in self.records:
+            key = (record['stage'], tuple(sorted(record['labels'].items())))
+            if key not in summary:
+                summary[key] = {'stage': record['stage'], 'labels': record['labels'], 'calls': 0, 'seconds': 0.0}
+            entry = summary[key]
+            entry['calls'] += 1
+            entry['seconds'] += record['seconds']
+            for field in ('rss_bytes', 'peak_rss_bytes', 'traced_peak_bytes'):
+                if record.get(field) is not None:
+                    entry[field] = max(entry.get(field, 0), record[field])
+        return list(summary.values())
+
+    def report(self):
+        """
+        Returns:
+        dict: The run as 'started', 'seconds' (wall time of the whole run), 'stages' (the summary)
+        and 'gauges' (the latest value of every gauge).
+        """
+        finished = self.finished if self.finished is not None else time.time()
+        with self._lock:
+            gauges = list(self.gauges.values())
+        return {
+            'started': self.started,
+            'seconds': finished - self.started,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'stages': self.summary(),
+            'gauges': gauges,
+        }
+
+    def write(self, metrics_dir, name='hk_map'):
+        """
+        Appends the run to <metrics_dir>/<name>_runs.jsonl and replaces <metrics_dir>/<name>.prom,
+        a Prometheus textfile for the node exporter's textfile collector.
+
+        Parameters:
+        metrics_dir (str): The directory to write to.
+        name (str): The file name stem and metric prefix.
+
+        Returns:
+        dict: The report that was written.
+        """
+        os.makedirs(metrics_dir, exist_ok=True)
+        report = self.report()
+        with open(os.path.join(metrics_dir, f'{name}_runs.jsonl'), 'a') as file:
+            file.write(json.dumps(report) + '\n')
+
+        prom_path = os.path.join(metrics_dir, f'{name}.prom')
+        with open(prom_path + '.tmp', 'w') as file:
+            file.write(prometheus_text(report, name))
+        os.replace(prom_path + '.tmp', prom_path)
+        return report
+
+def prometheus_text(report, name='hk_map'):
+    """
+    Formats a run report in the Prometheus text exposition format.
+
+    Parameters:
+    report (dict): The result of StageRecorder.report.
+    name (str): The metric prefix.
+
+    Returns:
+    str: The metrics, one gauge family per figure.
+    """
+    families = [
+        ('stage_seconds', 'seconds', 'Wall time of each pipeline stage in the last run.'),
+        ('stage_calls', 'calls', 'Number of times each pipeline stage ran in the last run.'),
+        ('stage_rss_bytes', 'rss_bytes', 'Resident set size at the end of each pipeline stage in the last run.'),
+        ('stage_traced_peak_bytes', 'traced_peak_bytes', 'Peak of the memory allocated through Python and numpy while each pipeline stage ran in the last run.'),
+    ]
+    lines = [
+        f'# HELP {name}_run_seconds Wall time of the last run.',
+        f'# TYPE {name}_run_seconds gauge',
+        f"{name}_run_seconds {report['seconds']:.6f}",
+        f'# HELP {name}_run_timestamp_seconds Start of the last run, in seconds since the epoch.',
+        f'# TYPE {name}_run_timestamp_seconds gauge',
+        f"{name}_run_timestamp_seconds {report['started']:.3f}",
+    ]
+    if report.get('peak_rss_bytes') is not None:
+        lines += [
+            f'# HELP {name}_peak_rss_bytes Peak resident set size of the process.',
+            f'# TYPE {name}_peak_rss_bytes gauge',
+            f"{name}_peak_rss_bytes {report['peak_rss_bytes']}",
+        ]
+    for family, field, help_text in families:
+        entries = [entry for entry in report['stages'] if entry.get(field) is not None]
+        if not entries:
+            continue
+        lines += [f'# HELP {name}_{family} {help_text}', f'# TYPE {name}_{family} gauge']
+        for entry in entries:
+            labels = {'stage': entry['stage'], **entry['labels']}
+            label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            value = entry[field]
+            lines.append(f'{name}_{family}{{{label_text}}} {value:.6f}' if isinstance(value, float) else f'{name}_{family}{{{label_text}}} {value}')
+    families = {}
+    for entry in report.get('gauges', []):
+        families.setdefault(entry['gauge'], []).append(entry)
+    for family, entries in families.items():
+        lines += [f"# HELP {name}_{family} {entries[0]['help']}", f'# TYPE {name}_{family} gauge']
+        for entry in entries:
+            label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in entry['labels'].items())
+            metric = f'{name}_{family}{{{label_text}}}' if label_text else f'{name}_{family}'
+            value = entry['value']
+            lines.append(f'{metric} {value:.6f}' if isinstance(value, float) else f'{metric} {value}')
+    return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+@contextmanager
+def stage(name, **labels):
+    """
+    Times a pipeline stage into the active StageRecorder, if there is one.
+
+    Parameters:
+    name (str): The stage name. Nested stages are reported as parent.child.
+    labels: Extra labels of the stage, e.g. variable='temperature'.
+    """
+    recorder = _ACTIVE
+    if recorder is None:
+        yield
+        return
+    with recorder.stage(name, **labels):
+        yield
+
+def gauge(name, value, help_text='', **labels):
+    """
+    Sets a gauge of the active StageRecorder, if there is one. Unlike stages, gauges may be
+    set from any thread and keep their value until set again.
+
+    Parameters:
+    name (str): The gauge name, e.g. writer_queue_depth.
+    value (float): The current value.
+    help_text (str): What the gauge measures, for the Prometheus HELP line.
+    labels: Extra labels of the gauge.
+    """
+    recorder = _ACTIVE
+    if recorder is not None:
+        recorder.gauge(name, value, help_text, **labels)
+
+@contextmanager
+def profiled(path):
+    """
+    Runs the enclosed code under cProfile and dumps the statistics to path, if a path is given.
+    The file can be read with pstats, or turned into a flame graph with e.g. snakeviz,
+    flameprof or gprof2dot.
+
+    Parameters:
+    path (str): Where to write the profile. Nothing is profiled if None.
+    """
+    if path is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        print(f'profile written to {path}')
@@ -1,54 +1,550 @@
-from data_loader import download_csv, load_station_data
-from ocean_mask import generate_ocean_mask, load_ocean_mask
-from plotter import plot_temperature_map, add_station_markers, interpolate_temperature
-import constants as c
-import matplotlib.pyplot as plt
-import cartopy.crs as ccrs
-import geopandas as gpd
-import numpy as np
-from shapely.geometry import shape, Point, Polygon
-from cartopy.feature import ShapelyFeature
-
-
-def main():
-    # Paths and constants
-    api_link = 'https://data.weather.gov.hk/weatherAPI/hko_data/regional-weather/latest_1min_temperature.csv'
-    station_location_data_path = 'input/station_location.csv'
-    data_input_path = 'input/latest_1min_temperature.csv'
-    mask_file_path = 'input/ocean_mask.npy'
-    shapefile_path = 'input/hk_coast_2022/Hong_Kong_18_Districts/reprojected_HKDistrict18.shp'
-
-    # Step 1: Read Stations location and Download data CSV 
-    stations = load_station_data(station_location_data_path)
-    stations, datetime = download_csv(api_link, data_input_path, stations)
-    
-    # Step 2: Initialise the plot and load the shapefile
-    
-    proj = ccrs.PlateCarree()
-    fig = plt.figure(figsize=(12, 6))
-    main_ax = fig.add_subplot(1, 1, 1, projection=proj)
-    main_ax.set_extent([c.MINLON, c.MAXLON, c.MINLAT, c.MAXLAT], crs=proj)
-
-    # Filter out stations with 'N/A' temperature values
-    valid_stations = {name: data for name, data in stations.items() if isinstance(data.get('temperature'), float)}
-
-    X, Y, Z = interpolate_temperature(valid_stations, method='linear')
-    
-    gdf = gpd.read_file(shapefile_path)
-    print("CRS of the shapefile:", gdf.crs)
-    
-    shapefile_feature = ShapelyFeature(gdf.geometry, proj, edgecolor=(0, 0, 0, 0.5), facecolor='none')
-    main_ax.add_feature(shapefile_feature, linewidth=0.5)
-    
-    # Step 3: Interpolate temperature
-    ocean_mask = generate_ocean_mask(gdf,X, Y, Z, mask_file_path)
-    
-    # Mask the ocean areas with white
-    masked_Z = np.ma.masked_where(ocean_mask == 1, Z)
-    
-    # Step 4: Plot the temperature map
-    con, cbar = plot_temperature_map(X, Y, masked_Z, main_ax, proj)
-    add_station_markers(main_ax, valid_stations, datetime)
-    
+from data_loader import FeedFetcher, load_station_data
+from ocean_mask import generate_ocean_mask, land_indices, land_to_grid
+from plotter import interpolate_land, make_grid
+from tiled_grid import Grid, tiled_ocean_mask, interpolate_tiled
+from districts import district_labels, DistrictStats
+from district_geometry import load_district_geometry
+from interpolator import IncrementalField
+from variables import VARIABLES, station_lists
+from archive import ObservationArchive
+from instrumentation import StageRecorder, stage, profiled
+from grid_product import GridStore
+from output_writer import prune_frames
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import time
+import os
+
+# Paths and constants
+STATION_LOCATION_DATA_PATH = 'input/station_location.csv'
+MASK_CACHE_DIR = 'input/mask_cache'
+ARCHIVE_DIR = 'input/archive'
+METRICS_DIR = 'output/metrics'
+TILES_DIR = 'output/tiles'
+GRID_DIR = 'output/grid'
+
+# How frames are drawn: renderer.PRODUCTS, or 'grid' for the data-only product, which writes
+# the field to the grid store and never imports matplotlib or cartopy.
+PRODUCTS = ('contour', 'raster', 'grid')
+SHAPEFILE_PATH = 'input/hk_coast_2022/Hong_Kong_18_Districts/reprojected_HKDistrict18.shp'
+DISTRICT_NAME_COLUMN = 'ENAME'
+
+# The HKO feed is refreshed every minute, a little after the minute turns.
+FEED_INTERVAL = 60
+FEED_OFFSET = 20
+
+
+def load_static_state(output_dir='output', product='contour', resolution=None, dem_path=None, variables=('temperature',)):
+    """
+    Loads everything that stays the same from one frame to the next: station locations,
+    the district polygons, the grid, the ocean mask with its land cell indices, the
+    district-ID raster and, unless the product is 'grid', the renderer with its static layers.
+
+    With a resolution, the grid is a tiled Grid of that many points per side instead of the
+    default 400x400 meshgrid. Its mask and field are built tile by tile in uint8/float32,
+    so memory stays bounded at street-level sizes such as 4000x4000.
+
+    The district polygons come from the packed geometry cache next to the mask cache, so
+    once the caches are warm neither the shapefile nor geopandas is read.
+
+    With a DEM, the elevation of the land cells and stations is cached next to the mask, and
+    the variables that change with height are interpolated with a lapse rate fitted every
+    minute, see terrain.TerrainModel.
+
+    Parameters:
+    output_dir (str): The directory PNGs and district statistics are written to.
+    product (str): How the renderer fills the field, 'contour' or 'raster', or 'grid' for no renderer.
+    resolution (int): Grid points per side for the tiled high-resolution mode. None for the default grid.
+    dem_path (str): A digital elevation model in lon/lat, see terrain.read_dem. None for plain
+        interpolation. Only supported on the default grid.
+    variables (tuple): The variables to render. The station table also holds the stations
+        only their feeds report, see variables.station_lists.
+
+    Returns:
+    dict: The static state consumed by render_frame.
+    """
+    if dem_path is not None and resolution is not None:
+        raise ValueError("Elevation-aware interpolation is only supported on the default grid")
+    station_paths = [STATION_LOCATION_DATA_PATH, *station_lists(variables)]
+    with stage('load_stations'):
+        stations = load_station_data(*station_paths)
+
+    with stage('read_shapefile'):
+        districts = load_district_geometry(SHAPEFILE_PATH, MASK_CACHE_DIR, DISTRICT_NAME_COLUMN)
+
+    state = {
+        'stations': stations,
+        'station_paths': station_paths,
+        'output_dir': output_dir,
+        # The last field and district statistics of each variable, patched by the next frame.
+        'fields': {},
+        'district_stats': {},
+    }
+    if product != 'grid':
+        # Imported here so that the data-only product loads no plotting code.
+        from renderer import MapRenderer
+        with stage('build_renderer'):
+            state['renderer'] = MapRenderer(stations, districts, output_dir=output_dir, product=product)
+    if resolution is not None:
+        grid = Grid(resolution, resolution)
+        state['grid'] = grid
+        with stage('ocean_mask'):
+            state['ocean_mask'] = tiled_ocean_mask(districts, grid, SHAPEFILE_PATH, MASK_CACHE_DIR)
+        xi, yi = grid.xi, grid.yi
+    else:
+        X, Y = make_grid()
+        state['X'], state['Y'] = X, Y
+        with stage('ocean_mask'):
+            state['ocean_mask'] = generate_ocean_mask(districts, X, Y, SHAPEFILE_PATH, MASK_CACHE_DIR)
+            state['land_idx'] = land_indices(state['ocean_mask'])
+        xi, yi = X[0], Y[:, 0]
+        if dem_path is not None:
+            from terrain import TerrainModel, elevation_layers
+            with stage('elevation'):
+                grid_elevation, station_elevation = elevation_layers(dem_path, X, Y, stations, station_paths, MASK_CACHE_DIR)
+                state['terrain'] = TerrainModel(station_elevation, grid_elevation.ravel()[state['land_idx']])
+                state['lapse_rates'] = {}
+
+    with stage('district_labels'):
+        labels = district_labels(districts, xi, yi, SHAPEFILE_PATH, MASK_CACHE_DIR)
+        state['districts'] = DistrictStats(districts.names, labels)
+    return state
+
+
+def add_outputs(state, tile_dir=None, zooms=None, grid_dir=None, variants=None, variant_workers=None, writer=None):
+    """
+    Adds the optional outputs written next to every frame to the static state.
+
+    Parameters:
+    state (dict): The static state from load_static_state.
+    tile_dir (str): Where to keep an XYZ tile pyramid of every variable up to date. None for no tiles.
+    zooms (iterable): The zoom levels of the tile pyramid. None for tiles.ZOOMS.
+    grid_dir (str): The grid store every field is appended to. None for no grid store.
+    variants (list): Names of variants.VARIANTS, or Variants, rendered from every field in worker
+        processes, each to <output_dir>/<variant name>/. None for none.
+    variant_workers (int): Number of variant worker processes. None for one per variant.
+    writer (OutputWriter): Writes the PNGs in the background, publishes their latest alias and
+        prunes the output directories; with the grid product, its keep and max_age prune the
+        statistics. None to save every PNG before moving on.
+
+    Returns:
+    dict: The state.
+    """
+    if writer is not None:
+        state['writer'] = writer
+        if 'renderer' in state:
+            state['renderer'].writer = writer
+    if tile_dir is not None:
+        from tiles import TilePyramid, ZOOMS
+        state['tiles'] = TilePyramid(tile_dir, ZOOMS if zooms is None else zooms)
+    if grid_dir is not None:
+        state['grid_store'] = GridStore(grid_dir)
+    if variants:
+        from variants import VariantPool, VARIANTS
+        variants = [VARIANTS[v] if isinstance(v, str) else v for v in variants]
+        keep, max_age = (writer.keep, writer.max_age) if writer is not None else (None, None)
+        state['variants'] = VariantPool(variants, state['output_dir'], state['station_paths'], SHAPEFILE_PATH,
+                                        MASK_CACHE_DIR, DISTRICT_NAME_COLUMN, variant_workers, keep, max_age)
+    return state
+
+
+def make_fetcher(variable='temperature', archive=None):
+    """
+    Creates the feed fetcher of one variable. Every new snapshot is archived.
+
+    Parameters:
+    variable (str): A key of variables.VARIABLES.
+    archive (ObservationArchive): The archive to append to. Opens ARCHIVE_DIR if None.
+
+    Returns:
+    FeedFetcher: The fetcher for the variable's live feed.
+    """
+    spec = VARIABLES[variable]
+    archive = ObservationArchive(ARCHIVE_DIR) if archive is None else archive
+    return FeedFetcher(spec.feed_url, spec.input_path, archive=archive, variable=variable, column=spec.column)
+
+
+def make_fetchers(variables=('temperature',)):
+    """
+    Creates one fetcher per variable, all appending to the same archive.
+
+    Returns:
+    dict: variable -> FeedFetcher.
+    """
+    archive = ObservationArchive(ARCHIVE_DIR)
+    return {variable: make_fetcher(variable, archive) for variable in variables}
+
+
+def fetch_stations(state):
+    """
+    Downloads the latest readings of every variable into the station table. Each fetch
+    replaces all readings of its variable, so a station missing from this minute's feed
+    never keeps last minute's reading.
+
+    The feeds are downloaded concurrently on a thread pool; the bodies are then parsed
+    and archived one after the other, since they share the station table and archive.
+
+    Parameters:
+    state (dict): The static state from load_static_state, with 'fetchers' from make_fetchers.
+
+    Returns:
+    list: (variable, stations, datetime) for each feed that has advanced since the last
+    fetch, where stations is the StationTable and datetime is the observation time as
+    YYYYMMDDHHMM. Feeds that failed to download are reported and left out. Each feed's
+    fetcher is committed by render_snapshots once its frame is rendered.
+    """
+    fetchers = state['fetchers']
+    with stage('fetch'), ThreadPoolExecutor(max_workers=len(fetchers)) as pool:
+        futures = {variable: pool.submit(fetcher.fetch_text) for variable, fetcher in fetchers.items()}
+
+    snapshots = []
+    for variable, future in futures.items():
+        try:
+            with stage('parse', variable=variable):
+                snapshot = fetchers[variable].ingest(future.result(), state['stations'])
+        except Exception as e:
+            print(f"An error occurred while fetching the {variable} feed: {e}")
+            continue
+        if snapshot is not None:
+            snapshots.append((variable, *snapshot))
+    return snapshots
+
+
+def render_snapshots(state, snapshots):
+    """
+    Renders the snapshots returned by fetch_stations, committing each variable's fetcher
+    once its frame is rendered and its PNG is in place, which with a background writer is
+    after this returns; a PNG the writer drops or fails to write leaves the minute to be
+    fetched again while the feed still serves it. A variable whose frame fails, e.g. with fewer than three
+    valid stations to triangulate, is reported and skipped without holding up the others,
+    and its minute is fetched and rendered again on the next poll. What the failed frame
+    carried over to the next one is dropped, see forget_frame.
+
+    Parameters:
+    state (dict): The static state from load_static_state, with 'fetchers' from make_fetchers.
+    snapshots (list): (variable, stations, datetime) tuples from fetch_stations.
+
+    Returns:
+    None
+    """
+    for variable, stations, datetime in snapshots:
+        try:
+            render_frame(state, stations, datetime, variable, state['fetchers'][variable].committer())
+        except Exception as e:
+            print(f"An error occurred while rendering the {variable} frame of {datetime}: {e}")
+            forget_frame(state, variable)
+
+
+def forget_frame(state, variable):
+    """
+    Drops the variable's patched field and district statistics after a frame fails part-way,
+    and makes the tile pyramid sample every tile of the next frame. The field may already
+    hold the failed minute, so a retry of that minute would find no changed station and
+    write the statistics and tiles of the frame before it; without them, the next frame is
+    computed in full.
+
+    Parameters:
+    state (dict): The static state from load_static_state.
+    variable (str): The variable whose frame failed.
+
+    Returns:
+    None
+    """
+    state.get('fields', {}).pop(variable, None)
+    state.get('district_stats', {}).pop(variable, None)
+    if 'tiles' in state:
+        state['tiles'].forget(variable)
+
+
+def render_frame(state, stations, datetime, variable='temperature', on_written=None):
+    """
+    Interpolates one snapshot and renders it to the output directory, reusing the static state.
+    Every variable shares the grid, ocean mask, interpolation weights and figure.
+
+    On the default grid, the field and district statistics of the variable's previous frame
+    are patched rather than recomputed: only land cells in triangles with a changed station,
+    and only the districts containing them, are evaluated again.
+
+    Parameters:
+    state (dict): The static state from load_static_state.
+    stations (StationTable): The station table holding the snapshot's readings.
+    datetime (str): The observation time of the snapshot, as YYYYMMDDHHMM.
+    variable (str): The variable to render, a key of variables.VARIABLES.
+    on_written (callable): Called once every output of the frame is in place, see
+        MapRenderer.render. Not called if the frame fails.
+
+    Returns:
+    None
+    """
+    with stage('frame', variable=variable):
+        _render_frame(state, stations, datetime, variable, on_written)
+
+
+def _render_frame(state, stations, datetime, variable, on_written):
+    if 'grid' in state:
+        # Tiled high-resolution mode: interpolate tile by tile into a float32 field with the
+        # ocean left NaN, and hand the renderer the grid axes rather than meshgrids.
+        grid = state['grid']
+        X, Y = grid.xi, grid.yi
+        with stage('interpolate'):
+            masked_Z = interpolate_tiled(stations, grid, state['ocean_mask'], variable)
+        changed = None
+    else:
+        # Step 3: Interpolate temperature at the land cells only, patching the previous
+        # frame's field. Stations without a valid reading are left out.
+        X, Y = state['X'], state['Y']
+        field = state['fields'].setdefault(variable, IncrementalField())
+        with stage('interpolate'):
+            land_Z = interpolate_land(stations, X, Y, state['land_idx'], method='linear', variable=variable, field=field)
+            changed = None if field.changed is None else state['land_idx'][field.changed]
+            if 'terrain' in state and VARIABLES[variable].terrain:
+                # Add the lapse term: one multiply-add over the land cells. A new rate moves
+                # every cell off the station elevations, so nothing can be patched then.
+                land_Z, rate = state['terrain'].apply(land_Z, field.interpolator, stations.get(variable), field.valid)
+                if rate != state['lapse_rates'].get(variable):
+                    changed = None
+                state['lapse_rates'][variable] = rate
+                print(f'{variable} lapse rate {rate * 1000:.2f} {VARIABLES[variable].unit}/km')
+
+            # Scatter the land values back onto the grid, with the ocean masked white
+            masked_Z = land_to_grid(land_Z, state['land_idx'], X.shape)
+
+    # Step 4: Write the district statistics and the other outputs, then plot the temperature
+    # map, last, so that once it is written the whole frame is. The variants are drawn by
+    # their workers meanwhile.
+    pool = state.get('variants')
+    futures = None if pool is None else pool.submit(X, Y, masked_Z, stations, datetime, variable)
+    try:
+        store = state.get('grid_store')
+        if store is not None:
+            with stage('grid'):
+                size = store.append(X, Y, masked_Z, stations, datetime, variable)
+            print(f'{variable} field of {datetime} appended to {store.store_dir} ({size / 1024:.0f} kB)')
+        pyramid = state.get('tiles')
+        if pyramid is not None:
+            # Only the tiles whose colours changed are written, see TilePyramid.
+            with stage('tiles'):
+                written = pyramid.render(X, Y, masked_Z, variable, datetime, changed)
+            print(f'{written} of {pyramid.n_tiles} tiles updated in {os.path.join(pyramid.tile_dir, variable)}')
+        with stage('district_stats'):
+            write_district_stats(state, masked_Z, datetime, variable, changed)
+        if 'renderer' in state:
+            with stage('render'):
+                state['renderer'].render(X, Y, masked_Z, stations, datetime, variable, on_written)
+        else:
+            # Without a map the writer has nothing to prune after, so the statistics are pruned here.
+            writer = state.get('writer')
+            if writer is not None:
+                prune_frames(state['output_dir'], writer.keep, writer.max_age)
+            if on_written is not None:
+                on_written()
+    finally:
+        # The next submit reuses the shared field, so the workers must be done with this one
+        # even when the frame failed.
+        if futures is not None:
+            with stage('variants'):
+                paths = pool.wait(futures)
+    if futures is not None:
+        print(f'{len(paths)} of {len(futures)} variants output')
+
+
+def write_district_stats(state, Z, datetime, variable='temperature', changed=None):
+    """
+    Writes the mean/min/max of a variable for every district to the output directory, next
+    to the rendered frames, as <stats prefix>_<datetime>.csv and .json, e.g.
+    HK_district_temp_<datetime>.csv for temperature.
+
+    Parameters:
+    state (dict): The static state from load_static_state.
+    Z (array-like): The interpolated field of the frame.
+    datetime (str): The observation time of the snapshot, as YYYYMMDDHHMM.
+    variable (str): The variable of the frame.
+    changed (numpy.ndarray): The flat grid indices of the cells changed since the variable's
+        previous frame, whose statistics are then patched. None to compute them all.
+
+    Returns:
+    None
+    """
+    base = os.path.join(state['output_dir'], f'{VARIABLES[variable].stats_prefix}_{datetime}')
+    districts = state['districts']
+    stats = state['district_stats'].get(variable)
+    if stats is None or changed is None:
+        stats = state['district_stats'][variable] = districts.compute(Z)
+    else:
+        districts.update(stats, Z, changed)
+    districts.write(stats, base + '.csv', base + '.json', datetime)
+    print(f'district statistics output to {base}.csv')
+
+
+def main(product='contour', resolution=None, variables=('temperature',), metrics_dir=METRICS_DIR, trace_memory=False,
+         tile_dir=None, zooms=None, grid_dir=None, variants=None, variant_workers=None, writer=None, dem_path=None):
+    recorder = StageRecorder(trace_memory).activate()
+
+    # Step 1: Read Stations location, the shapefile and the ocean mask
+    with stage('static_state'):
+        state = load_static_state(product=product, resolution=resolution, dem_path=dem_path, variables=variables)
+    state['fetchers'] = make_fetchers(variables)
+    add_outputs(state, tile_dir, zooms, grid_dir, variants, variant_workers, writer)
+
+    # Step 2: Download the data CSVs
+    # Step 3 and 4: Interpolate and plot every variable
+    render_snapshots(state, fetch_stations(state))
+    if 'variants' in state:
+        state['variants'].close()
+    if writer is not None:
+        with stage('flush_output'):
+            writer.close()
+
+    recorder.finish_run()
+    write_metrics(recorder, metrics_dir)
+
+
+def write_metrics(recorder, metrics_dir):
+    """
+    Prints the stage timings of the finished run and writes them to metrics_dir, see
+    StageRecorder.write. Nothing is written if metrics_dir is None.
+
+    Returns:
+    None
+    """
+    report = recorder.report()
+    print(f"Run took {report['seconds']:.2f}s: " + ', '.join(
+        f"{entry['stage']} {entry['seconds']:.2f}s" for entry in report['stages'] if '.' not in entry['stage']))
+    if metrics_dir is not None:
+        recorder.write(metrics_dir)
+
+
+def run_daemon(interval=FEED_INTERVAL, offset=FEED_OFFSET, product='contour', resolution=None, variables=('temperature',),
+               metrics_dir=METRICS_DIR, trace_memory=False, tile_dir=None, zooms=None, grid_dir=None, variants=None, variant_workers=None,
+               writer=None, dem_path=None):
+    """
+    Keeps the static state loaded and renders every new snapshot of the feed.
+
+    Cycles start `offset` seconds after each multiple of `interval` on the wall clock,
+    matching the one-minute cadence of the HKO feed. A feed that is unchanged (304 Not
+    Modified, or the same timestamp as the last render) skips all further work.
+    When a cycle overruns into the following slots, those slots are dropped rather than
+    queued, so the service never falls behind. With a writer, PNGs are encoded and written
+    in the background, so a slow disk delays the files rather than the next cycle.
+
+    Parameters:
+    interval (int): Seconds between polls.
+    offset (int): Seconds after the start of each interval at which to poll.
+    product (str): How the renderer fills the field, 'contour' or 'raster', or 'grid' for no images.
+    resolution (int): Grid points per side for the tiled high-resolution mode. None for the default grid.
+    variables (tuple): The variables to render, keys of variables.VARIABLES.
+    metrics_dir (str): Where the stage timings of every cycle are written. None to only print them.
+    trace_memory (bool): Whether to record the allocation peak of every stage with tracemalloc.
+    tile_dir (str): Where to keep an XYZ tile pyramid of every variable up to date. None for no tiles.
+    zooms (iterable): The zoom levels of the tile pyramid. None for tiles.ZOOMS.
+    grid_dir (str): The grid store every field is appended to. None for no grid store.
+    variants (list): Names of variants.VARIANTS rendered from every field in worker processes. None for none.
+    variant_workers (int): Number of variant worker processes. None for one per variant.
+    writer (OutputWriter): Writes the PNGs in the background, see add_outputs. None to save them in the cycle.
+    dem_path (str): A DEM for elevation-aware interpolation, see load_static_state. None for plain interpolation.
+
+    Returns:
+    None
+    """
+    # Loading the static state is reported as a run of its own, then each cycle as one run.
+    recorder = StageRecorder(trace_memory).activate()
+    with stage('static_state'):
+        state = load_static_state(product=product, resolution=resolution, dem_path=dem_path, variables=variables)
+    state['fetchers'] = make_fetchers(variables)
+    add_outputs(state, tile_dir, zooms, grid_dir, variants, variant_workers, writer)
+    recorder.finish_run()
+    write_metrics(recorder, metrics_dir)
+    next_tick = (time.time() // interval + 1) * interval + offset
+
+    while True:
+        time.sleep(max(0.0, next_tick - time.time()))
+        cycle_start = time.perf_counter()
+        recorder.start_run()
+        try:
+            snapshots = fetch_stations(state)
+            if not snapshots:
+                print("Skipping render.")
+            render_snapshots(state, snapshots)
+        except Exception as e:
+            print(f"An error occurred during the cycle: {e}")
+        latency = time.perf_counter() - cycle_start
+        print(f"Cycle finished in {latency:.2f}s")
+        recorder.finish_run()
+        try:
+            write_metrics(recorder, metrics_dir)
+        except OSError as e:
+            print(f"Could not write the metrics: {e}")
+
+        next_tick += interval
+        now = time.time()
+        if now > next_tick:
+            overrun = now - next_tick
+            missed = int(overrun // interval) + 1
+            print(f"Cycle overran the next poll by {overrun:.2f}s. Skipping {missed} poll(s).")
+            next_tick += missed * interval
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Render the Hong Kong temperature (and humidity, wind, pressure) maps.')
+    parser.add_argument('--daemon', action='store_true', help='keep running and render every new snapshot of the feed')
+    parser.add_argument('--interval', type=int, default=FEED_INTERVAL, help='seconds between polls in daemon mode')
+    parser.add_argument('--offset', type=int, default=FEED_OFFSET, help='seconds past each interval at which to poll in daemon mode')
+    parser.add_argument('--product', choices=PRODUCTS, default='contour',
+                        help="fill the field with contours or with the faster raster lookup, or write no images ('grid', implies --grid)")
+    parser.add_argument('--resolution', type=int, default=None, help='grid points per side, interpolated in tiles (e.g. 4000); default 400x400 grid')
+    parser.add_argument('--variables', default='temperature', help=f"comma-separated variables to render, from {', '.join(VARIABLES)}")
+    parser.add_argument('--metrics-dir', default=METRICS_DIR, help='directory for the per-run stage timings (JSON lines and a Prometheus textfile)')
+    parser.add_argument('--trace-memory', action='store_true', help='also record the allocation peak of every stage (slower)')
+    parser.add_argument('--profile', default=None, metavar='PATH', help='write a cProfile profile of the whole run to PATH')
+    parser.add_argument('--tiles', nargs='?', const=TILES_DIR, default=None, metavar='DIR',
+                        help=f'also write an XYZ tile pyramid of every frame, to DIR (default {TILES_DIR}); serve it with tile_server.py')
+    parser.add_argument('--zooms', default=None, help='zoom levels of the tile pyramid, e.g. 8-12 (the default)')
+    parser.add_argument('--grid', nargs='?', const=GRID_DIR, default=None, metavar='DIR',
+                        help=f'also append every interpolated field to the grid store in DIR (default {GRID_DIR}); export it with grid_product.py')
+    parser.add_argument('--variants', default=None,
+                        help='comma-separated map variants also rendered from every field in parallel, each to output/<variant>/ (see variants.py)')
+    parser.add_argument('--variant-workers', type=int, default=None, help='number of variant worker processes; default one per variant')
+    parser.add_argument('--sync-output', action='store_true', help='encode and save every PNG before moving on, instead of on a background writer')
+    parser.add_argument('--output-queue', type=int, default=4, help='most PNGs waiting for the background writer; the oldest is dropped when full')
+    parser.add_argument('--keep', type=int, default=None, help='frames kept per output file group (e.g. temperature PNGs); default all')
+    parser.add_argument('--max-age', type=int, default=None, metavar='MINUTES', help='remove frames this many minutes older than the newest one')
+    parser.add_argument('--dem', default=None, metavar='PATH',
+                        help='elevation model in lon/lat (.asc, .npz, or .tif with rasterio); interpolate temperature with a lapse rate fitted every minute')
+    args = parser.parse_args()
+
+    variables = tuple(v.strip() for v in args.variables.split(',') if v.strip())
+    for variable in variables:
+        if variable not in VARIABLES:
+            parser.error(f"unknown variable {variable!r}, expected one of {', '.join(VARIABLES)}")
+    zooms = None
+    if args.zooms is not None:
+        try:
+            first, _, last = args.zooms.partition('-')
+            zooms = range(int(first), int(last or first) + 1)
+        except ValueError:
+            parser.error(f"expected --zooms as a level or a range such as 8-12, got {args.zooms!r}")
+    grid_dir = GRID_DIR if args.product == 'grid' and args.grid is None else args.grid
+    if args.dem is not None and args.resolution is not None:
+        parser.error('--dem is only supported on the default grid, drop --resolution')
+    variants = None
+    if args.variants is not None:
+        from variants import VARIANTS
+        variants = tuple(v.strip() for v in args.variants.split(',') if v.strip())
+        for variant in variants:
+            if variant not in VARIANTS:
+                parser.error(f"unknown variant {variant!r}, expected one of {', '.join(VARIANTS)}")
+
+    writer = None
+    if not args.sync_output:
+        from output_writer import OutputWriter
+        writer = OutputWriter(args.output_queue, args.keep, args.max_age)
+    elif args.keep is not None or args.max_age is not None:
+        parser.error('--keep and --max-age are applied by the background writer, drop --sync-output')
+
+    with profiled(args.profile):
+        if args.daemon:
+            run_daemon(args.interval, args.offset, args.product, args.resolution, variables, args.metrics_dir, args.trace_memory,
+                       args.tiles, zooms, grid_dir, variants, args.variant_workers, writer, args.dem)
+        else:
+            main(args.product, args.resolution, variables, args.metrics_dir, args.trace_memory, args.tiles, zooms, grid_dir,
+                 variants, args.variant_workers, writer, args.dem)
@@ -1,57 +1,156 @@
 import numpy as np
-from shapely.geometry import shape, Point, Polygon
-from tqdm import tqdm
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+from raster_cache import RasterCache, raster_key, shapefile_parts
 import os
 
-def generate_ocean_mask(gdf,X, Y, Z, mask_file_path):
+# Grids smaller than this are tested in a single call; splitting them across
+# threads costs more than it saves.
+PARALLEL_MIN_CELLS = 250_000
+
+def dissolve_land(gdf):
+    """
+    Dissolves the district polygons into a single prepared land geometry.
+
+    Parameters:
+    gdf (DistrictGeometry or GeoDataFrame): The polygons representing land areas.
+
+    Returns:
+    shapely.Geometry: The union of all polygons, prepared for repeated containment tests.
+    """
+    land = shapely.union_all(np.asarray(gdf.geometry))
+    shapely.prepare(land)
+    return land
+
+def rasterize_land(land, X, Y, n_workers=None):
     """
-    Generates a mask for ocean areas based on the provided GeoDataFrame and saves it to a file for subsequent use.
+    Tests every grid point against the land geometry in bulk.
+
+    Large grids are split into row blocks that are tested concurrently. Shapely
+    releases the GIL inside its vectorized predicates, so threads scale across
+    cores without copying the geometry into worker processes.
 
     Parameters:
-    gdf (GeoDataFrame): The GeoDataFrame containing the polygons representing land areas.
+    land (shapely.Geometry): The prepared land geometry from dissolve_land.
     X (numpy.ndarray): The x-coordinates of the grid points.
     Y (numpy.ndarray): The y-coordinates of the grid points.
-    Z (numpy.ndarray): The z-coordinates of the grid points.
-    mask_file_path (str): The path where the mask file will be saved.
+    n_workers (int): Number of threads to use. Defaults to the number of CPUs.
 
     Returns:
-    numpy.ndarray: A mask array where ocean areas are marked with 1 and land areas with 0.
-    """
-    if not os.path.exists(mask_file_path):
-        print("Ocean mask file does not exist. Generating a new one.")
-        ocean_mask = np.ones_like(Z)
-        total_iterations = len(gdf) * Z.shape[0] * Z.shape[1]
-        
-        with tqdm(total=total_iterations) as pbar:
-            for _, row in gdf.iterrows():
-                polygon = row['geometry']
-                for i in range(Z.shape[0]):
-                    for j in range(Z.shape[1]):
-                        point = Point(X[i, j], Y[i, j])
-                        if polygon.contains(point):
-                            ocean_mask[i, j] = 0
-                        pbar.update(1)
-        
-        np.save(mask_file_path, ocean_mask)
-        print(f"Ocean mask saved to {mask_file_path}")
-        return ocean_mask
-    else:
-        print(f"Ocean mask already exists at {mask_file_path}. Loading from file.")
-        ocean_mask = np.load(mask_file_path)
+    numpy.ndarray: A boolean array, True where the grid point lies on land.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if X.size < PARALLEL_MIN_CELLS or n_workers == 1:
+        return shapely.contains_xy(land, X, Y)
+
+    is_land = np.empty(X.shape, dtype=bool)
+    row_blocks = np.array_split(np.arange(X.shape[0]), n_workers * 4)
+
+    def test_block(rows):
+        if len(rows):
+            is_land[rows[0]:rows[-1] + 1] = shapely.contains_xy(land, X[rows[0]:rows[-1] + 1], Y[rows[0]:rows[-1] + 1])
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        list(pool.map(test_block, row_blocks))
+    return is_land
+
+def grid_extent(X, Y):
+    """
+    Returns the extent and size of a meshgrid as used in raster cache keys.
+
+    Parameters:
+    X (numpy.ndarray): The x-coordinates of the grid points.
+    Y (numpy.ndarray): The y-coordinates of the grid points.
+
+    Returns:
+    tuple: ((minlon, maxlon, minlat, maxlat), nx, ny)
+    """
+    ny, nx = X.shape
+    return (X[0, 0], X[0, -1], Y[0, 0], Y[-1, 0]), nx, ny
+
+def generate_ocean_mask(gdf, X, Y, shapefile_path, cache_dir, n_workers=None):
+    """
+    Generates a mask for ocean areas based on the provided GeoDataFrame and stores it in the raster cache for subsequent use.
+
+    The cache key covers the grid extent, the grid size and the contents of the shapefile,
+    so a mask built for a different grid or coastline is never reused.
+
+    Parameters:
+    gdf (DistrictGeometry or GeoDataFrame): The polygons representing land areas.
+    X (numpy.ndarray): The x-coordinates of the grid points.
+    Y (numpy.ndarray): The y-coordinates of the grid points.
+    shapefile_path (str): The shapefile gdf was read from.
+    cache_dir (str): The directory holding cached masks.
+    n_workers (int): Number of threads used to test the grid. Defaults to the number of CPUs.
+
+    Returns:
+    numpy.ndarray: A uint8 mask array where ocean areas are marked with 1 and land areas with 0.
+    """
+    cache = RasterCache(cache_dir)
+    extent, nx, ny = grid_extent(X, Y)
+    key = raster_key('ocean_mask', extent, nx, ny, shapefile_parts(shapefile_path))
+
+    ocean_mask = cache.load(key, X.shape)
+    if ocean_mask is not None:
+        print(f"Ocean mask {key[:12]} loaded from {cache_dir}")
         return ocean_mask
 
-def load_ocean_mask(mask_file_path):
+    print("No cached ocean mask for this grid and shapefile. Generating a new one.")
+    land = dissolve_land(gdf)
+    ocean_mask = (~rasterize_land(land, X, Y, n_workers)).astype(np.uint8)
+    cache.store(key, ocean_mask, packed=True, kind='ocean_mask', extent=[float(v) for v in extent], nx=nx, ny=ny)
+    print(f"Ocean mask {key[:12]} saved to {cache_dir}")
+    return ocean_mask
+
+def land_indices(ocean_mask):
+    """
+    Lists the grid cells that lie on land.
+
+    Parameters:
+    ocean_mask (numpy.ndarray): The mask from generate_ocean_mask, 1 over the ocean.
+
+    Returns:
+    numpy.ndarray: The flat (row-major) indices of the land cells, in ascending order.
+    """
+    return np.flatnonzero(np.ravel(ocean_mask) == 0)
+
+def land_to_grid(values, land_idx, shape):
     """
-    Loads the created ocean mask from a file.
+    Scatters a field stored as one value per land cell back onto the full grid.
 
     Parameters:
-    mask_file_path (str): The path to the mask file.
+    values (numpy.ndarray): The field at the land cells, in the order of land_idx.
+    land_idx (numpy.ndarray): The flat indices of the land cells, from land_indices.
+    shape (tuple): The shape of the grid.
+
+    Returns:
+    numpy.ma.MaskedArray: The field on the grid, with the ocean masked.
+    """
+    grid = np.full(int(np.prod(shape)), np.nan)
+    grid[land_idx] = values
+    mask = np.ones(grid.shape, dtype=bool)
+    mask[land_idx] = False
+    return np.ma.masked_array(grid.reshape(shape), mask.reshape(shape))
+
+def load_ocean_mask(X, Y, shapefile_path, cache_dir):
+    """
+    Loads the created ocean mask for a grid from the raster cache.
+
+    Parameters:
+    X (numpy.ndarray): The x-coordinates of the grid points.
+    Y (numpy.ndarray): The y-coordinates of the grid points.
+    shapefile_path (str): The shapefile the mask was built from.
+    cache_dir (str): The directory holding cached masks.
 
     Returns:
     numpy.ndarray: The loaded ocean mask.
     """
-    if os.path.exists(mask_file_path):
-        print(f"Loading ocean mask from {mask_file_path}")
-        return np.load(mask_file_path)
+    extent, nx, ny = grid_extent(X, Y)
+    key = raster_key('ocean_mask', extent, nx, ny, shapefile_parts(shapefile_path))
+    ocean_mask = RasterCache(cache_dir).load(key, X.shape)
+    if ocean_mask is not None:
+        print(f"Loading ocean mask {key[:12]} from {cache_dir}")
+        return ocean_mask
     else:
-        raise FileNotFoundError(f"Ocean mask file not found at {mask_file_path}")
\ No newline at end of file
+        raise FileNotFoundError(f"No cached ocean mask for this grid and shapefile in {cache_dir}")
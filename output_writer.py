@@ -0,0 +1,210 @@
+from instrumentation import gauge
+from datetime import datetime, timedelta
+from collections import deque
+import threading
+import atexit
+import time
+import re
+import os
+
+# <prefix>_<YYYYMMDDHHMM>.<ext>, the name of every frame and statistics file.
+FRAME_NAME = re.compile(r'^(?P<prefix>.+)_(?P<datetime>\d{12})\.(?P<ext>\w+)$')
+
+def latest_path(path):
+    """
+    Returns the stable alias of a frame file: <prefix>_latest.<ext> next to <prefix>_<datetime>.<ext>.
+    """
+    directory, name = os.path.split(path)
+    match = FRAME_NAME.match(name)
+    if match is None:
+        raise ValueError(f"{name} is not named <prefix>_<YYYYMMDDHHMM>.<ext>")
+    return os.path.join(directory, f"{match['prefix']}_latest.{match['ext']}")
+
+def publish_latest(path):
+    """
+    Points the latest alias of a frame file at it, atomically: readers of the alias see the
+    previous frame or this one, never a partial file.
+
+    The alias is a hard link, so it survives the frame being pruned; where the file system
+    has no hard links it is a copy.
+    """
+    alias = latest_path(path)
+    tmp_path = alias + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(path, tmp_path)
+    except OSError:
+        import shutil
+        shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, alias)
+    return alias
+
+def prune_frames(directory, keep=None, max_age=None):
+    """
+    Removes old frames from an output directory.
+
+    Files are grouped by prefix and extension, e.g. the temperature PNGs, the temperature
+    statistics CSVs and JSONs, and each group is pruned on its own, by the datetime in the
+    file names, so re-rendered old minutes are not mistaken for new ones.
+
+    Parameters:
+    directory (str): The output directory.
+    keep (int): The number of newest frames kept per group. None for no limit.
+    max_age (int): Frames more than this many minutes older than the newest of their group
+        are removed. None for no limit.
+
+    Returns:
+    list: The names of the removed files.
+    """
+    if keep is None and max_age is None:
+        return []
+    groups = {}
+    for name in os.listdir(directory):
+        match = FRAME_NAME.match(name)
+        if match is not None:
+            groups.setdefault((match['prefix'], match['ext']), []).append((match['datetime'], name))
+
+    removed = []
+    for frames in groups.values():
+        frames.sort(reverse=True)
+        newest = datetime.strptime(frames[0][0], '%Y%m%d%H%M')
+        for i, (stamp, name) in enumerate(frames):
+            too_many = keep is not None and i >= keep
+            too_old = max_age is not None and newest - datetime.strptime(stamp, '%Y%m%d%H%M') > timedelta(minutes=max_age)
+            if too_many or too_old:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue
+                removed.append(name)
+    return removed
+
+class OutputWriter:
+    """
+    Writes output files on a background thread, so that PNG encoding and disk I/O do not
+    hold up the next frame.
+
+    Jobs wait in a bounded queue. When a slow disk lets it fill up, the oldest waiting job
+    is dropped for the new one: a live map would rather skip a stale minute than fall
+    behind. Every file is written under a temporary name and renamed into place, then its
+    latest alias is moved to it and its directory pruned, see publish_latest and prune_frames.
+
+    The queue depth, the latency from submitting a job to its file being in place, and the
+    numbers of files written and dropped are reported as gauges of the active StageRecorder.
+    """
+
+    def __init__(self, max_queue=4, keep=None, max_age=None, latest=True):
+        """
+        Parameters:
+        max_queue (int): The most jobs waiting at once. A 500 dpi frame holds about 70 MB
+            of pixels while it waits.
+        keep (int): The number of newest frames kept per file group, see prune_frames. None for all.
+        max_age (int): Minutes of frames kept per file group, see prune_frames. None for all.
+        latest (bool): Whether to keep a <prefix>_latest.<ext> alias of the newest file.
+        """
+        self.max_queue = max_queue
+        self.keep = keep
+        self.max_age = max_age
+        self.latest = latest
+        self.written = 0
+        self.dropped = 0
+        self._jobs = deque()
+        self._busy = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='output-writer', daemon=True)
+        self._thread.start()
+        # Files still queued when the daemon is stopped are written before it exits.
+        atexit.register(self.close)
+
+    @property
+    def depth(self):
+        """
+        int: The number of jobs waiting or being written.
+        """
+        with self._condition:
+            return self._depth()
+
+    def _depth(self):
+        # Called with the condition held.
+        return len(self._jobs) + self._busy
+
+    def _report_depth(self):
+        gauge('writer_queue_depth', self._depth(), 'Files waiting to be written, including the one being written.')
+
+    def submit(self, path, write, on_written=None):
+        """
+        Queues a file to be written. Returns at once.
+
+        Parameters:
+        path (str): Where the file is published, named <prefix>_<YYYYMMDDHHMM>.<ext>.
+        write (callable): Called with a temporary path on the writer thread, writes the file there.
+        on_written (callable): Called on the writer thread once the file is in place. Not
+            called if the file is dropped or cannot be written.
+
+        Returns:
+        None
+        """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The output writer is closed")
+            if len(self._jobs) >= self.max_queue:
+                dropped_path = self._jobs.popleft()[0]
+                self.dropped += 1
+                print(f"Output queue full, dropping {dropped_path}")
+                gauge('writer_dropped', self.dropped, 'Files dropped because the output queue was full.')
+            self._jobs.append((path, write, on_written, time.perf_counter()))
+            self._report_depth()
+            self._condition.notify()
+
+    def flush(self):
+        """
+        Waits until every queued file is written.
+        """
+        with self._condition:
+            while self._jobs or self._busy:
+                self._condition.wait()
+
+    def close(self):
+        """
+        Writes the files still queued and stops the thread. Safe to call more than once.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._jobs and not self._closed:
+                    self._condition.wait()
+                if not self._jobs:
+                    return
+                path, write, on_written, submitted = self._jobs.popleft()
+                self._busy = True
+            try:
+                self._write(path, write)
+                latency = time.perf_counter() - submitted
+                self.written += 1
+                gauge('writer_latency_seconds', latency, 'Seconds from queueing the last file to it being in place.')
+                gauge('writer_written', self.written, 'Files written by the output writer.')
+                print(f'output written to {path} ({latency:.2f}s after queueing)')
+                if on_written is not None:
+                    on_written()
+            except Exception as e:
+                print(f"An error occurred while writing {path}: {e}")
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._report_depth()
+                    self._condition.notify_all()
+
+    def _write(self, path, write):
+        tmp_path = path + '.tmp'
+        write(tmp_path)
+        os.replace(tmp_path, path)
+        if self.latest:
+            publish_latest(path)
+        prune_frames(os.path.dirname(path) or '.', self.keep, self.max_age)
@@ -1,19 +1,42 @@
-import matplotlib.pyplot as plt
-from cartopy.feature import ShapelyFeature
 import numpy as np
-from scipy.interpolate import griddata
+from interpolator import grid_interpolator
 import constants as c
-import cmweather
 from datetime import datetime
 
-def interpolate_temperature(valid_stations, method='linear'):
+# matplotlib and scipy.interpolate are imported by the functions that use them:
+# the service only interpolates through here, and importing them costs over a second of
+# start-up.
+
+def make_grid(nx=400, ny=400):
     """
-    Interpolates temperature data using griddata from scipy.
+    Builds the longitude/latitude meshgrid the temperature field is interpolated onto.
+
+    Parameters:
+    nx (int): Number of grid points along longitude.
+    ny (int): Number of grid points along latitude.
+
+    Returns:
+    X (array-like): Longitudes of the grid points.
+    Y (array-like): Latitudes of the grid points.
+    """
+    xi = np.linspace(c.MINLON, c.MAXLON, nx)
+    yi = np.linspace(c.MINLAT, c.MAXLAT, ny)
+    return np.meshgrid(xi, yi)
+
+def interpolate_temperature(stations, method='linear', cache_dir='input/interp_cache', variable='temperature'):
+    """
+    Interpolates temperature data onto the map grid.
+
+    Four virtual stations at the corners of the map carry the mean of all valid readings.
+    Linear interpolation goes through a cached StationInterpolator, which reuses the
+    triangulation and weights for each pattern of missing stations across calls and runs.
+    Other methods fall back to griddata from scipy.
     
     Parameters:
-    valid_stations (dict): Dictionary containing station names and their attributes.
-    T (array-like): Temperature values at the stations.
+    stations (StationTable): The station table with readings for `variable`.
     method (str): Interpolation method to use. Default is 'linear'.
+    cache_dir (str): The directory where interpolation weights are persisted.
+    variable (str): The variable to interpolate.
     
     Returns:
     X (array-like): Longitudes of the grid points.
@@ -21,38 +44,48 @@ def interpolate_temperature(valid_stations, method='linear'):
     Z (array-like): Interpolated temperature values on the grid.
     
     """
-    # Extract longitude, latitude, and temperature data for interpolation
-    lon = np.array([data['long'] for data in valid_stations.values()])
-    lat = np.array([data['lat'] for data in valid_stations.values()])
-    T = np.array([data['temperature'] for data in valid_stations.values() if isinstance(data.get('temperature'), float)])
-
-    # Generate interpolated temperature data
-    xi = np.linspace(c.MINLON, c.MAXLON, 400)
-    yi = np.linspace(c.MINLAT, c.MAXLAT, 400)
-    X, Y = np.meshgrid(xi, yi)
-    
-    # Calculate the average temperature value from all existing stations
-    avg_temperature = np.mean([data['temperature'] for data in valid_stations.values()])
-
-    # Define the coordinates for the four virtual stations at the edges of the map
-    virtual_stations = {
-    'Station 1': {'lat': c.MINLAT, 'long': c.MINLON, 'temperature': avg_temperature},
-    'Station 2': {'lat': c.MINLAT, 'long': c.MAXLON, 'temperature': avg_temperature},
-    'Station 3': {'lat': c.MAXLAT, 'long': c.MINLON, 'temperature': avg_temperature},
-    'Station 4': {'lat': c.MAXLAT, 'long': c.MAXLON, 'temperature': avg_temperature}
-    }
-    
-    # Add the virtual stations to the station data
-    valid_stations.update(virtual_stations)
-        
-    # Generate interpolated temperature data with the virtual stations included
-    lon = np.array([station_data['long'] for station_data in valid_stations.values()])
-    lat = np.array([station_data['lat'] for station_data in valid_stations.values()])
-    T = np.array([data['temperature'] for data in valid_stations.values() if isinstance(data.get('temperature'), float)])
-
-    Z = griddata((lon, lat), T, (X, Y), method=method)
+    X, Y = make_grid()
+    lon, lat, T, valid = stations.with_virtual_stations(variable)
+
+    if method == 'linear':
+        Z = grid_interpolator(lon, lat, X, Y, cache_dir).interpolate(T, valid).reshape(X.shape)
+    else:
+        from scipy.interpolate import griddata
+        Z = griddata((lon[valid], lat[valid]), T[valid], (X, Y), method=method)
     return X, Y, Z
 
+def interpolate_land(stations, X, Y, land_idx, method='linear', cache_dir='input/interp_cache', variable='temperature', field=None):
+    """
+    Interpolates temperature data at the land cells of the map grid only.
+
+    Same as interpolate_temperature, but the field is evaluated and returned as one value
+    per land cell, so the cost grows with the land area rather than with the whole
+    rectangle, most of which is sea. Use ocean_mask.land_to_grid to put it back on the grid.
+
+    Parameters:
+    stations (StationTable): The station table with readings for `variable`.
+    X (array-like): Longitudes of the grid points.
+    Y (array-like): Latitudes of the grid points.
+    land_idx (numpy.ndarray): The flat indices of the land cells, from ocean_mask.land_indices.
+    method (str): Interpolation method to use. Default is 'linear'.
+    cache_dir (str): The directory where interpolation weights are persisted.
+    variable (str): The variable to interpolate.
+    field (IncrementalField): If given, the field of the previous snapshot, patched only where
+        a changed station affects it. Only used with linear interpolation.
+
+    Returns:
+    numpy.ndarray: Interpolated temperature values at the land cells, in the order of land_idx.
+    """
+    lon, lat, T, valid = stations.with_virtual_stations(variable)
+
+    if method == 'linear':
+        interpolator = grid_interpolator(lon, lat, X, Y, cache_dir, land_idx=land_idx)
+        if field is not None:
+            return field.update(interpolator, T, valid)
+        return interpolator.interpolate(T, valid)
+    from scipy.interpolate import griddata
+    return griddata((lon[valid], lat[valid]), T[valid], (np.ravel(X)[land_idx], np.ravel(Y)[land_idx]), method=method)
+
 def plot_temperature_map(X, Y, masked_Z, main_ax, proj, label:str = '2m Temperature (°C)'):
     """
     Plots the temperature map using contourf.
@@ -70,6 +103,8 @@ def plot_temperature_map(X, Y, masked_Z, main_ax, proj, label:str = '2m Temperat
     matplotlib.contour.QuadContourSet: The contour set created by contourf.
     
     """
+    import matplotlib.pyplot as plt
+    import cmweather  # Registers the ChaseSpectral colormap
     con = main_ax.contourf(X, Y, masked_Z, cmap='ChaseSpectral', levels=np.linspace(c.MINTEMP, c.MAXTEMP, (c.MAXTEMP - c.MINTEMP + 1)), alpha=0.8)
     
     # Add contour lines for specific temperature levels
@@ -90,35 +125,29 @@ def plot_temperature_map(X, Y, masked_Z, main_ax, proj, label:str = '2m Temperat
     
     return con, cbar
 
-def add_station_markers(main_ax, valid_stations, datetime_str):
+def add_station_markers(main_ax, stations, datetime_str, variable='temperature'):
     """
     Adds markers for valid stations on the map.
     
     Parameters:
     main_ax (matplotlib.axes.Axes): The axes on which to plot the station markers.
-    valid_stations (dict): Dictionary containing station names and their attributes.
+    stations (StationTable): The station table with readings for `variable`.
+    datetime_str (str): The observation time, as YYYYMMDDHHMM.
+    variable (str): The variable whose readings are labelled.
     
     Returns:
     None
     
     """
-    for station_name, station_data in valid_stations.items():
-        if station_name in c.VIRTUAL_STATIONS:
-            lat = station_data['lat']
-            lon = station_data['long']
-            T = station_data['temperature']
-        elif station_name in ['The Peak', 'Tai Mo Shan', 'Ngong Ping', "Tate's Cairn"]:
-            lat = station_data['lat']
-            lon = station_data['long']
-            T = station_data['temperature']
-            main_ax.plot(lon, lat, '^', c= 'green', markersize= 2, zorder= 101)
-            main_ax.text(lon, lat, f'{station_name}\n{T}°C', color='black', fontsize=7, ha='left', zorder = 102)#, weight = 'bold')
-        else:
-            lat = station_data['lat']
-            lon = station_data['long']
-            T = station_data['temperature']
-            main_ax.plot(lon, lat, 'o', c= 'black', markersize= 2, zorder= 101)
-            main_ax.text(lon, lat, f'{station_name}\n{T}°C', color='black', fontsize=7, ha='left', zorder = 102)#, weight = 'bold')
+    import matplotlib.pyplot as plt
+    values = stations.get(variable)
+    valid = np.isfinite(values)
+    highland = valid & stations.highland
+    lowland = valid & ~stations.highland
+    main_ax.plot(stations.lon[highland], stations.lat[highland], '^', c= 'green', markersize= 2, linestyle='none', zorder= 101)
+    main_ax.plot(stations.lon[lowland], stations.lat[lowland], 'o', c= 'black', markersize= 2, linestyle='none', zorder= 101)
+    for i in np.flatnonzero(valid):
+        main_ax.text(stations.lon[i], stations.lat[i], f'{stations.names[i]}\n{values[i]}°C', color='black', fontsize=7, ha='left', zorder = 102)#, weight = 'bold')
     
     time_str_filename = datetime_str
     # Parse the datetime string
@@ -128,19 +157,14 @@ def add_station_markers(main_ax, valid_stations, datetime_str):
     
     plt.text(.01, .01, f'datetime {datetime_str} HKT', ha='left', va='bottom', transform=main_ax.transAxes, zorder = 103)
 
-    # Find the station with the lowest temperature
-    min_station = min(valid_stations.items(), key=lambda x: x[1]['temperature'])[0]
-    min_temp = valid_stations[min_station]['temperature']
-
-    # Find the station with the highest temperature
-    max_station = max(valid_stations.items(), key=lambda x: x[1]['temperature'])[0]
-    max_temp = valid_stations[max_station]['temperature']
+    # Find the stations with the lowest and highest temperature
+    min_idx, max_idx = stations.extremes(variable)
 
     # Output the station names and temperatures
-    plt.text(.99, .03, f'maximum: {max_temp}°C {max_station}', ha='right', va='bottom', transform=main_ax.transAxes, zorder = 103, fontsize=7, color = 'red')
-    plt.text(.99, .01, f'minimum: {min_temp}°C {min_station}', ha='right', va='bottom', transform=main_ax.transAxes, zorder = 103, fontsize=7, color = 'blue')
+    plt.text(.99, .03, f'maximum: {values[max_idx]}°C {stations.names[max_idx]}', ha='right', va='bottom', transform=main_ax.transAxes, zorder = 103, fontsize=7, color = 'red')
+    plt.text(.99, .01, f'minimum: {values[min_idx]}°C {stations.names[min_idx]}', ha='right', va='bottom', transform=main_ax.transAxes, zorder = 103, fontsize=7, color = 'blue')
 
     plt.tight_layout()
     plt.savefig(f'output/HK_temp_map_newcolor_{time_str_filename}.png', dpi=500)
     plt.clf()
-    print(f'figure output to output/HK_temp_map_newcolor_{time_str_filename}.png')
\ No newline at end of file
+    print(f'figure output to output/HK_temp_map_newcolor_{time_str_filename}.png')
@@ -0,0 +1,285 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.spatial import Delaunay
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import threading
+import hashlib
+import json
+
+class Triangulation:
+    """
+    Delaunay triangulation of the valid stations with a precomputed point-location raster.
+
+    The raster holds the triangle under the centre of each of its cells. A query point
+    takes the triangle of its cell as a candidate, and its barycentric coordinates confirm
+    it; only points whose candidate fails, near triangle edges, go through the regular
+    Delaunay walk. With a 256x256 raster that is about 2% of the points.
+    """
+
+    def __init__(self, points, lookup_size=256):
+        """
+        Parameters:
+        points (numpy.ndarray): A (n x 2) array of station positions.
+        lookup_size (int): Cells per side of the location raster.
+        """
+        self.tri = Delaunay(points)
+        self.lookup_size = lookup_size
+        self.lo = points.min(axis=0)
+        self.cell = (points.max(axis=0) - self.lo) / lookup_size
+        centres = [self.lo[i] + (np.arange(lookup_size) + 0.5) * self.cell[i] for i in range(2)]
+        cx, cy = np.meshgrid(*centres)
+        self.lookup = self.tri.find_simplex(np.column_stack([cx.ravel(), cy.ravel()]))
+
+    def locate(self, points):
+        """
+        Locates points and computes their barycentric coordinates, like interpolator.barycentric.
+
+        Parameters:
+        points (numpy.ndarray): A (n x 2) array of points.
+
+        Returns:
+        inside (numpy.ndarray): Indices of the points that fall inside the triangulation.
+        vertices (numpy.ndarray): A (len(inside) x 3) array of the triangle vertices of each of those points.
+        bary (numpy.ndarray): A (len(inside) x 3) array of the weight of each vertex.
+        """
+        offset = points - self.lo
+        in_raster = ((offset >= 0) & (offset <= self.cell * self.lookup_size)).all(axis=1)
+        ij = np.clip(np.floor(offset / self.cell), 0, self.lookup_size - 1).astype(np.int64)
+        simplex = np.full(len(points), -1, dtype=np.int64)
+        simplex[in_raster] = self.lookup[ij[in_raster, 1] * self.lookup_size + ij[in_raster, 0]]
+
+        bary = self._barycentric(simplex, points)
+        miss = (simplex < 0) | (bary.min(axis=1) < -1e-12)
+        miss &= in_raster
+        if miss.any():
+            simplex[miss] = self.tri.find_simplex(points[miss])
+            bary[miss] = self._barycentric(simplex[miss], points[miss])
+
+        inside = np.flatnonzero(simplex >= 0)
+        return inside, self.tri.simplices[simplex[inside]], bary[inside]
+
+    def _barycentric(self, simplex, points):
+        transform = self.tri.transform[simplex]
+        bary = np.einsum('ijk,ik->ij', transform[:, :2, :], points - transform[:, 2, :])
+        return np.column_stack([bary, 1 - bary.sum(axis=1)])
+
+class PointQuery:
+    """
+    Interpolates station readings at arbitrary batches of points, e.g. every building
+    address or bus stop, with the same linear interpolation and virtual corner stations
+    as the map.
+
+    Three in-memory LRU caches make repeated work cheap: the triangulation of each pattern
+    of valid stations, the sparse weight matrix of each (pattern, point batch), and the
+    result of each (timestamp, variable, point batch). A batch seen before therefore costs
+    a sparse matrix-vector product, or nothing if the timestamp has already been queried.
+    """
+
+    def __init__(self, stations, max_triangulations=8, max_weights=16, max_results=256):
+        """
+        Parameters:
+        stations (StationTable): The station table. Its readings are read at query time.
+        max_triangulations (int): Number of valid-station patterns kept triangulated.
+        max_weights (int): Number of (pattern, point batch) weight matrices kept.
+        max_results (int): Number of (timestamp, variable, point batch) results kept.
+        """
+        self.stations = stations
+        self.max_triangulations = max_triangulations
+        self.max_weights = max_weights
+        self.max_results = max_results
+        self._triangulations = OrderedDict()
+        self._weights = OrderedDict()
+        self._results = OrderedDict()
+        # Held while the station table is filled and queried, see QueryHandler.
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _remember(cache, key, value, max_entries):
+        cache[key] = value
+        if len(cache) > max_entries:
+            cache.popitem(last=False)
+        return value
+
+    @staticmethod
+    def _recall(cache, key):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        return None
+
+    def weights(self, points, points_key, station_points, valid):
+        """
+        Returns the (points x stations) weight matrix for a batch and a valid-station pattern.
+        """
+        pattern = np.packbits(valid).tobytes()
+        W = self._recall(self._weights, (pattern, points_key))
+        if W is not None:
+            return W
+
+        station_idx = np.flatnonzero(valid)
+        if len(station_idx) < 3:
+            raise ValueError(f"At least 3 valid stations are needed to triangulate, got {len(station_idx)}")
+        tri = self._recall(self._triangulations, pattern)
+        if tri is None:
+            tri = self._remember(self._triangulations, pattern, Triangulation(station_points[station_idx]), self.max_triangulations)
+
+        inside, vertices, bary = tri.locate(points)
+        counts = np.zeros(len(points), dtype=np.int64)
+        counts[inside] = 3
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        W = sp.csr_matrix((bary.ravel(), station_idx[vertices].ravel(), indptr), shape=(len(points), len(station_points)))
+        return self._remember(self._weights, (pattern, points_key), W, self.max_weights)
+
+    def query(self, lon, lat, datetime_str=None, variable='temperature'):
+        """
+        Interpolates the current readings of a variable at a batch of points.
+
+        Parameters:
+        lon (array-like): Longitudes of the points.
+        lat (array-like): Latitudes of the points.
+        datetime_str (str): The observation time of the readings in the station table. Results
+            are cached per timestamp when it is given, so the table must not change without it changing.
+        variable (str): The variable to interpolate.
+
+        Returns:
+        numpy.ndarray: The value at every point, NaN outside the map or where it cannot be interpolated.
+        """
+        points = np.column_stack([np.ravel(lon), np.ravel(lat)]).astype(float)
+        points_key = hashlib.sha256(points.tobytes()).hexdigest()
+        with self.lock:
+            if datetime_str is not None:
+                result = self._recall(self._results, (datetime_str, variable, points_key))
+                if result is not None:
+                    return result.copy()
+
+            station_lon, station_lat, values, valid = self.stations.with_virtual_stations(variable)
+            W = self.weights(points, points_key, np.column_stack([station_lon, station_lat]), valid)
+            result = W @ np.where(valid, values, 0.0)
+            result[np.diff(W.indptr) == 0] = np.nan
+
+            if datetime_str is not None:
+                self._remember(self._results, (datetime_str, variable, points_key), result.copy(), self.max_results)
+            return result
+
+def is_number_list(value):
+    """
+    Returns whether a decoded JSON value is a list of numbers.
+    """
+    return isinstance(value, list) and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value)
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    HTTP front end of a PointQuery, reading the readings of each request's minute from an
+    ObservationArchive.
+
+    GET  /query?lat=22.3,22.4&lon=114.1,114.2[&datetime=YYYYMMDDHHMM][&variable=temperature]
+    POST /query with a JSON body {"lat": [...], "lon": [...], "datetime": ..., "variable": ...}
+
+    Without a datetime, the latest archived minute is used. The response is
+    {"datetime": ..., "variable": ..., "values": [...]}, with null where there is no value.
+    """
+
+    # Set by serve.
+    point_query = None
+    archive = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/query':
+            return self._send(404, {'error': f'unknown path {url.path}'})
+        params = parse_qs(url.query)
+        try:
+            lat = [float(v) for v in params.get('lat', [''])[0].split(',') if v]
+            lon = [float(v) for v in params.get('lon', [''])[0].split(',') if v]
+        except ValueError as e:
+            return self._send(400, {'error': str(e)})
+        self._answer(lat, lon, params.get('datetime', [None])[0], params.get('variable', ['temperature'])[0])
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/query':
+            return self._send(404, {'error': f'unknown path {self.path}'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            lat, lon = body['lat'], body['lon']
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send(400, {'error': f'expected a JSON body with lat and lon lists: {e}'})
+        if not (is_number_list(lat) and is_number_list(lon)):
+            return self._send(400, {'error': 'expected lat and lon as lists of numbers'})
+        self._answer(lat, lon, body.get('datetime'), body.get('variable', 'temperature'))
+
+    def _answer(self, lat, lon, datetime_str, variable):
+        if len(lat) != len(lon):
+            return self._send(400, {'error': f'got {len(lat)} latitudes and {len(lon)} longitudes'})
+        with self.point_query.lock:
+            try:
+                datetime_str = self._load_readings(datetime_str, variable)
+            except ValueError as e:
+                return self._send(400, {'error': str(e)})
+            if datetime_str is None:
+                return self._send(404, {'error': 'no archived readings for that time'})
+            try:
+                values = self.point_query.query(lon, lat, datetime_str, variable)
+            except ValueError as e:
+                return self._send(422, {'error': str(e)})
+        self._send(200, {'datetime': datetime_str, 'variable': variable,
+                         'values': [None if np.isnan(v) else round(float(v), 3) for v in values]})
+
+    def _load_readings(self, datetime_str, variable):
+        # Fills the station table with the readings of one archived minute and returns the minute.
+        stations = self.point_query.stations
+        if datetime_str is None:
+            times, rows, names = self.archive.latest(variable, stations.names)
+        else:
+            times, rows, names = self.archive.query(datetime_str, datetime_str, variable, stations.names)
+        if len(times) == 0:
+            return None
+        stations.set_values(variable, rows[-1])
+        return times[-1].astype(object).strftime("%Y%m%d%H%M")
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(stations, archive, host='127.0.0.1', port=8080):
+    """
+    Serves point queries over HTTP until interrupted.
+
+    Parameters:
+    stations (StationTable): The station table.
+    archive (ObservationArchive): The archive the readings are read from.
+    host (str): The address to listen on.
+    port (int): The port to listen on.
+
+    Returns:
+    None
+    """
+    QueryHandler.point_query = PointQuery(stations)
+    QueryHandler.archive = archive
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    print(f"Serving point queries on http://{host}:{port}/query")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    import argparse
+    from data_loader import load_station_data
+    from archive import ObservationArchive
+    parser = argparse.ArgumentParser(description='Serve interpolated temperatures at arbitrary points.')
+    parser.add_argument('--archive', default='input/archive', help='archive directory')
+    parser.add_argument('--stations', default='input/station_location.csv',
+                        help='comma-separated station location CSVs, covering the stations of every archived feed')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    serve(load_station_data(*args.stations.split(',')), ObservationArchive(args.archive), args.host, args.port)
@@ -0,0 +1,216 @@
+import numpy as np
+import hashlib
+import json
+import os
+
+# Sidecar files that make up an ESRI shapefile. Any of them changing (geometry,
+# index, attributes or projection) produces a new cache key.
+SHAPEFILE_PARTS = ('.shp', '.shx', '.dbf', '.prj')
+
+def hash_files(paths, digest=None):
+    """
+    Feeds the contents of the given files into a SHA-256 digest.
+
+    Parameters:
+    paths (list): Paths of the files to hash, in a stable order.
+    digest (hashlib._Hash): An existing digest to update. A new one is created if None.
+
+    Returns:
+    hashlib._Hash: The updated digest.
+    """
+    if digest is None:
+        digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+    return digest
+
+def stat_files(paths, digest=None):
+    """
+    Feeds the absolute path, size and modification time of the given files into a SHA-256
+    digest, for files too large to hash on every start. Touching a file changes the digest
+    as replacing it does.
+
+    Parameters:
+    paths (list): Paths of the files, in a stable order.
+    digest (hashlib._Hash): An existing digest to update. A new one is created if None.
+
+    Returns:
+    hashlib._Hash: The updated digest.
+    """
+    if digest is None:
+        digest = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns]).encode())
+    return digest
+
+def shapefile_parts(shapefile_path):
+    """
+    Lists the sidecar files of a shapefile that exist on disk.
+
+    Parameters:
+    shapefile_path (str): The path to the .shp file.
+
+    Returns:
+    list: Paths of the .shp/.shx/.dbf/.prj files that exist.
+    """
+    stem = os.path.splitext(shapefile_path)[0]
+    return [stem + ext for ext in SHAPEFILE_PARTS if os.path.exists(stem + ext)]
+
+def raster_key(kind, extent, nx, ny, source_paths, stat_paths=()):
+    """
+    Builds a content-addressed key for a raster aligned to an interpolation grid.
+
+    Parameters:
+    kind (str): What the raster holds, e.g. 'ocean_mask'.
+    extent (tuple): (minlon, maxlon, minlat, maxlat) of the grid.
+    nx (int): Number of grid points along longitude.
+    ny (int): Number of grid points along latitude.
+    source_paths (list): Files the raster was derived from. Their contents are hashed.
+    stat_paths (list): Large files the raster was derived from, identified by path, size and
+        modification time instead, see stat_files.
+
+    Returns:
+    str: A hex digest identifying the raster.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'kind': kind, 'extent': [float(v) for v in extent], 'nx': int(nx), 'ny': int(ny)}, sort_keys=True).encode())
+    return stat_files(stat_paths, hash_files(source_paths, digest)).hexdigest()
+
+def prune_directory(directory, max_entries, max_bytes, keep=None):
+    """
+    Removes the least-recently-used entries of an on-disk cache until it is within its limits.
+
+    An entry is every file sharing a key, i.e. the part of the name before the first dot.
+    Its age is the newest modification time among those files.
+
+    Parameters:
+    directory (str): The cache directory.
+    max_entries (int): The maximum number of entries to keep.
+    max_bytes (int): The maximum total size of the entries to keep.
+    keep (str): A key that must not be evicted, typically the one just stored.
+
+    Returns:
+    list: The keys that were removed.
+    """
+    entries = {}
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if '.tmp' in name or not os.path.isfile(path):
+            continue
+        key = name.split('.', 1)[0]
+        mtime, size, paths = entries.get(key, (0.0, 0, []))
+        entries[key] = (max(mtime, os.path.getmtime(path)), size + os.path.getsize(path), paths + [path])
+
+    total_bytes = sum(size for _, size, _ in entries.values())
+    count = len(entries)
+    removed = []
+    for key, (_, size, paths) in sorted(entries.items(), key=lambda item: item[1][0]):
+        if count <= max_entries and total_bytes <= max_bytes:
+            break
+        if key == keep:
+            continue
+        print(f"Evicting cache entry {key} from {directory}")
+        for path in paths:
+            os.remove(path)
+        removed.append(key)
+        count -= 1
+        total_bytes -= size
+    return removed
+
+class RasterCache:
+    """
+    Size-bounded on-disk cache of grid rasters, keyed by raster_key.
+
+    Each entry is a .npy file plus a .json header recording its shape and dtype.
+    Binary masks are bit-packed, other rasters are stored as-is; both are opened
+    memory-mapped. Entries are evicted least-recently-used once the cache holds
+    more than max_entries files or max_bytes of data.
+    """
+
+    def __init__(self, cache_dir, max_entries=16, max_bytes=64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.npy', base + '.json'
+
+    def load(self, key, shape):
+        """
+        Loads a cached raster.
+
+        Parameters:
+        key (str): The key from raster_key.
+        shape (tuple): The expected shape of the raster.
+
+        Returns:
+        numpy.ndarray: The cached raster, or None if it is missing or does not match the shape.
+        """
+        data_path, header_path = self._paths(key)
+        if not (os.path.exists(data_path) and os.path.exists(header_path)):
+            return None
+        with open(header_path, 'r') as file:
+            header = json.load(file)
+        if tuple(header['shape']) != tuple(shape):
+            print(f"Cached raster {key} has shape {tuple(header['shape'])}, expected {tuple(shape)}. Discarding it.")
+            self._remove(key)
+            return None
+
+        data = np.load(data_path, mmap_mode='r')
+        if header['packed']:
+            data = np.unpackbits(data, count=int(np.prod(shape))).reshape(shape)
+        else:
+            data = data.reshape(shape)
+        os.utime(header_path)
+        return data
+
+    def store(self, key, array, packed=False, **metadata):
+        """
+        Stores a raster and evicts old entries if the cache is over budget.
+
+        Parameters:
+        key (str): The key from raster_key.
+        array (numpy.ndarray): The raster to store.
+        packed (bool): Bit-pack the raster. Only valid for arrays of 0/1 values.
+        **metadata: Extra JSON-serializable fields written to the header.
+
+        Returns:
+        None
+        """
+        data_path, header_path = self._paths(key)
+        data = np.packbits(np.asarray(array, dtype=bool)) if packed else np.asarray(array)
+        header = dict(metadata, shape=list(array.shape), dtype=str(data.dtype), packed=packed)
+
+        # Write to per-process temporary names first, so a crash never leaves a half-written
+        # entry and processes filling the same entry concurrently do not clobber each other.
+        tmp_suffix = f'.{os.getpid()}.tmp'
+        with open(data_path + tmp_suffix, 'wb') as file:
+            np.save(file, data)
+        with open(header_path + tmp_suffix, 'w') as file:
+            json.dump(header, file)
+        os.replace(data_path + tmp_suffix, data_path)
+        os.replace(header_path + tmp_suffix, header_path)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Removes least-recently-used entries until the cache is within its limits.
+
+        Parameters:
+        keep (str): A key that must not be evicted, typically the one just stored.
+
+        Returns:
+        None
+        """
+        prune_directory(self.cache_dir, self.max_entries, self.max_bytes, keep=keep)
+
+    def _remove(self, key):
+        for path in self._paths(key):
+            if os.path.exists(path):
+                os.remove(path)
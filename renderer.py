@@ -0,0 +1,475 @@
+import matplotlib
+from matplotlib.figure import Figure
+import matplotlib.colors as mcolors
+import matplotlib.cm as cm
+import matplotlib.artist as martist
+import matplotlib.image as mimage
+from matplotlib.collections import PathCollection
+import cartopy.crs as ccrs
+import numpy as np
+import constants as c
+import cmweather
+from variables import VARIABLES
+from instrumentation import stage
+from datetime import datetime
+import os
+
+# Ways of drawing the filled field, see MapRenderer.
+PRODUCTS = ('contour', 'raster')
+
+def contour_colormap(levels, cmap='ChaseSpectral', alpha=1.0):
+    """
+    Builds the discrete colormap and norm that contourf produces for the given levels.
+
+    contourf colours each band with the colormap evaluated at the band's midpoint, scaled
+    between the first and last level. Reproducing that here lets the colorbar be drawn once
+    without a contour set.
+
+    Parameters:
+    levels (array-like): The contour levels.
+    cmap (str): The name of the colormap.
+    alpha (float): Opacity baked into the colours.
+
+    Returns:
+    matplotlib.colors.ListedColormap: One colour per band.
+    matplotlib.colors.BoundaryNorm: Maps values to their band.
+    """
+    levels = np.asarray(levels, dtype=float)
+    midpoints = 0.5 * (levels[:-1] + levels[1:])
+    colors = matplotlib.colormaps[cmap](mcolors.Normalize(levels[0], levels[-1])(midpoints))
+    colors[:, 3] = alpha
+    return mcolors.ListedColormap(colors), mcolors.BoundaryNorm(levels, len(colors))
+
+def colorize(Z, levels, lut):
+    """
+    Maps a field to an RGBA image through a per-band colour lookup table.
+
+    Values in levels[i]..levels[i+1] take the colour of band i, as contourf fills them.
+    Masked, NaN and out-of-range values are fully transparent.
+
+    Parameters:
+    Z (array-like): The field, optionally a masked array.
+    levels (numpy.ndarray): The band boundaries.
+    lut (numpy.ndarray): A (bands + 1, 4) uint8 table; the last row is the transparent colour.
+
+    Returns:
+    numpy.ndarray: A uint8 RGBA image with the shape of Z.
+    """
+    data = np.ma.getdata(Z)
+    band = np.searchsorted(levels, data, side='left') - 1
+    band[data == levels[0]] = 0
+    outside = np.ma.getmaskarray(Z) | ~np.isfinite(data) | (band < 0) | (band >= len(levels) - 1)
+    band[outside] = len(lut) - 1
+    return lut[band]
+
+def band_lut(levels, cmap='ChaseSpectral', alpha=1.0):
+    """
+    Builds the uint8 lookup table used by colorize, with the colours of contour_colormap.
+    """
+    colors, _ = contour_colormap(levels, cmap, alpha)
+    lut = np.zeros((len(levels), 4), dtype=np.uint8)
+    lut[:-1] = np.round(colors(np.arange(len(levels) - 1)) * 255)
+    return lut
+
+def thin_grid(X, Y, Z, max_points):
+    """
+    Takes every n-th grid point along both axes so that neither side exceeds max_points.
+
+    Parameters:
+    X (array-like): Longitudes of the grid points, 2-D or the 1-D grid axis.
+    Y (array-like): Latitudes of the grid points, 2-D or the 1-D grid axis.
+    Z (array-like): The field on the grid.
+    max_points (int): The largest number of points kept per side.
+
+    Returns:
+    tuple: (X, Y, Z), thinned views of the inputs. Returned as is if the grid is small enough.
+    """
+    step = -(-max(np.shape(Z)) // max_points)
+    if step <= 1:
+        return X, Y, Z
+    X = X[::step, ::step] if np.ndim(X) == 2 else X[::step]
+    Y = Y[::step, ::step] if np.ndim(Y) == 2 else Y[::step]
+    return X, Y, Z[::step, ::step]
+
+class PixelImage(martist.Artist):
+    """
+    An RGBA image that is already at output resolution, blitted to the canvas as is.
+
+    FigureImage resamples and re-normalises its data on every draw even at a scale of one,
+    which at 500 dpi costs more than contouring the field.
+    """
+
+    def __init__(self, rgba, x0, y0):
+        """
+        Parameters:
+        rgba (numpy.ndarray): A (rows x columns x 4) uint8 image, bottom row first.
+        x0 (int): The x offset of the image in figure pixels.
+        y0 (int): The y offset of the image in figure pixels.
+        """
+        super().__init__()
+        self.set_zorder(-1)
+        self.x0, self.y0 = x0, y0
+        self.set_data(rgba)
+
+    def set_data(self, rgba):
+        self._rgba = rgba
+        self.stale = True
+
+    def draw(self, renderer):
+        if not self.get_visible():
+            return
+        gc = renderer.new_gc()
+        renderer.draw_image(gc, self.x0, self.y0, self._rgba)
+        gc.restore()
+        self.stale = False
+
+class MapRenderer:
+    """
+    Renders frames onto a figure whose static layers are built once.
+
+    The GeoAxes with its extent, the district outlines, the colorbar and its threshold
+    lines, and a marker and label for every known station are created in the constructor.
+    Each call to render only swaps the filled field and isolines, updates the station
+    labels and the timestamp/min/max annotations, and saves the figure.
+
+    One renderer serves every variable in variables.VARIABLES. Switching variable redraws
+    only the colorbar; the map, outlines, markers and raster pixel map are shared.
+
+    The 'contour' product fills the field with contourf. The 'raster' product instead maps
+    the grid through a precomputed colour lookup table, with the ocean made transparent in
+    the array itself, and gathers the colours straight into an image at the output
+    resolution through a pixel -> grid cell map built on the first frame. A single figure
+    image is updated in place and never resampled. Only the threshold isolines are still
+    contoured. Band edges follow grid cells, so they are as smooth as the grid is fine.
+    """
+
+    def __init__(self, stations, shapefile_feature, proj=None, figsize=(12, 6), dpi=500, output_dir='output', product='contour', contour_max_points=1000, variable='temperature',
+                 extent=None, labels=True, cmap=None, writer=None):
+        """
+        Parameters:
+        stations (StationTable): Every station that may report. One marker and label is created per row.
+        shapefile_feature (DistrictGeometry): The district outlines. A cartopy Feature is drawn as-is.
+        proj (cartopy.crs.Projection): The map projection. Defaults to PlateCarree.
+        figsize (tuple): Figure size in inches.
+        dpi (int): Resolution of the saved PNG.
+        output_dir (str): The directory the PNGs are written to.
+        product (str): 'contour' or 'raster', see the class docstring.
+        contour_max_points (int): Contours are traced on the grid thinned to at most this many
+            points per side. Tracing a 4000x4000 field costs over a GB and adds nothing visible at 500 dpi.
+        variable (str): The variable shown first, a key of variables.VARIABLES.
+        extent (tuple): (minlon, maxlon, minlat, maxlat) shown. Defaults to the whole map.
+        labels (bool): Whether stations are labelled with their name and reading, and the
+            extremes annotated. Off for thumbnails, where they would cover the map.
+        cmap (str): A colormap used for every variable instead of its own.
+        writer (OutputWriter): Encodes and writes the PNGs on a background thread. None to
+            save them before render returns.
+        """
+        if product not in PRODUCTS:
+            raise ValueError(f"Unknown product {product!r}, expected one of {PRODUCTS}")
+        self.product = product
+        self.contour_max_points = contour_max_points
+        self.proj = proj if proj is not None else ccrs.PlateCarree()
+        self.dpi = dpi
+        self.output_dir = output_dir
+        self.variable = VARIABLES[variable]
+        self.levels = self.variable.levels
+        self.extent = extent if extent is not None else (c.MINLON, c.MAXLON, c.MINLAT, c.MAXLAT)
+        self.labels = labels
+        self._cmap = cmap
+        self.writer = writer
+        self._canvas = None
+
+        # The raster product is composited at the output resolution, so the figure is laid
+        # out at the save dpi from the start. The figure is not registered with pyplot,
+        # which the renderer never needs and which takes a third of a second to import.
+        self.fig = Figure(figsize=figsize, dpi=dpi if product == 'raster' else None)
+        self.ax = self.fig.add_subplot(1, 1, 1, projection=self.proj)
+        self.ax.set_extent(list(self.extent), crs=self.proj)
+
+        cmap, norm = contour_colormap(self.levels, self.cmap, alpha=0.8)
+        self.cbar = self.fig.colorbar(cm.ScalarMappable(norm=norm, cmap=cmap), ax=self.ax, label=self.variable.label)
+        for level, color in self.variable.isolines:
+            self.cbar.ax.axhline(level, color=color, linewidth=1)
+
+        # Stations off a cropped map are never shown; their labels would spill past the axes.
+        minlon, maxlon, minlat, maxlat = self.extent
+        self._shown = (stations.lon >= minlon) & (stations.lon <= maxlon) & (stations.lat >= minlat) & (stations.lat <= maxlat)
+        self.station_artists = []
+        for i, station_name in enumerate(stations.names):
+            lat = stations.lat[i]
+            lon = stations.lon[i]
+            if stations.highland[i]:
+                marker, = self.ax.plot(lon, lat, '^', c='green', markersize=2, zorder=101)
+            else:
+                marker, = self.ax.plot(lon, lat, 'o', c='black', markersize=2, zorder=101)
+            text = self.ax.text(lon, lat, '', color='black', fontsize=7, ha='left', zorder=102)
+            marker.set_visible(False)
+            text.set_visible(False)
+            self.station_artists.append((marker, text))
+
+        self.datetime_text = self.ax.text(.01, .01, '', ha='left', va='bottom', transform=self.ax.transAxes, zorder=103)
+        self.max_text = self.ax.text(.99, .03, '', ha='right', va='bottom', transform=self.ax.transAxes, zorder=103, fontsize=7, color='red')
+        self.min_text = self.ax.text(.99, .01, '', ha='right', va='bottom', transform=self.ax.transAxes, zorder=103, fontsize=7, color='blue')
+
+        self.fig.tight_layout()
+        # Keep that layout. Leaving the engine set would make every savefig run a dry draw
+        # and redo the layout, and would move the axes under the raster product's pixel map.
+        self.fig.set_layout_engine('none')
+        # Drawn once the axes have their final size, which sets the outlines' level of detail.
+        self.add_outlines(shapefile_feature)
+        self._field_artists = []
+        self._image = None
+        self._pixel_cells = None
+        self._luts = {self.variable.name: band_lut(self.levels, self.cmap, alpha=0.8)}
+        self._lut = self._luts[self.variable.name]
+
+    def add_outlines(self, outlines):
+        """
+        Draws the district outlines.
+
+        A DistrictGeometry on a PlateCarree map is drawn straight from packed coordinates,
+        in the style and zorder cartopy would draw it, without building shapely geometries or
+        reprojecting them on every savefig. It is drawn at the level of detail of half an
+        output pixel: each border once, simplified, and with a border between two districts as
+        dark as the two overlapping strokes of their polygons. Anything else goes through cartopy.
+
+        Parameters:
+        outlines (DistrictGeometry or cartopy.feature.Feature): The outlines, in lon/lat.
+
+        Returns:
+        None
+        """
+        if not hasattr(outlines, 'paths'):
+            self.ax.add_feature(outlines, linewidth=0.5)
+        elif self.proj == ccrs.PlateCarree():
+            lod = outlines.outlines(self.pixel_size() / 2) if hasattr(outlines, 'outlines') else None
+            paths = outlines.paths() if lod is None else lod.paths()
+            # k strokes of alpha 0.5 on top of each other cover 1 - 0.5 ** k.
+            alphas = [0.5] if lod is None else [1 - 0.5 ** k for k in lod.shared]
+            collection = PathCollection(paths, facecolors='none', edgecolors=[(0, 0, 0, a) for a in alphas], linewidths=0.5, zorder=1.5)
+            self.ax.add_collection(collection, autolim=False)
+        else:
+            from cartopy.feature import ShapelyFeature
+            feature = ShapelyFeature(outlines.geometry, ccrs.PlateCarree(), edgecolor=(0, 0, 0, 0.5), facecolor='none')
+            self.ax.add_feature(feature, linewidth=0.5)
+
+    def pixel_size(self):
+        """
+        Returns:
+        float: The width of an output pixel in degrees of longitude, at the save dpi and the
+        current size of the axes.
+        """
+        width = self.ax.get_window_extent().width * self.dpi / self.fig.dpi
+        return (self.extent[1] - self.extent[0]) / width
+
+    @property
+    def cmap(self):
+        """
+        str: The colormap the current variable is drawn with.
+        """
+        return self._cmap or self.variable.cmap
+
+    def set_variable(self, variable):
+        """
+        Switches the levels, colours, isolines and colorbar to another variable.
+
+        Parameters:
+        variable (str): A key of variables.VARIABLES.
+
+        Returns:
+        None
+        """
+        if variable == self.variable.name:
+            return
+        self.variable = VARIABLES[variable]
+        self.levels = self.variable.levels
+        if variable not in self._luts:
+            self._luts[variable] = band_lut(self.levels, self.cmap, alpha=0.8)
+        self._lut = self._luts[variable]
+
+        # Redraw the colorbar in the axes it already occupies, so the layout does not move.
+        cax = self.cbar.ax
+        cax.clear()
+        cmap, norm = contour_colormap(self.levels, self.cmap, alpha=0.8)
+        self.cbar = self.fig.colorbar(cm.ScalarMappable(norm=norm, cmap=cmap), cax=cax, label=self.variable.label)
+        for level, color in self.variable.isolines:
+            cax.axhline(level, color=color, linewidth=1)
+
+    def pixel_cells(self, X, Y):
+        """
+        Maps every output pixel inside the map axes to the grid cell it shows.
+
+        Parameters:
+        X (array-like): Longitudes of the grid points on a regular grid, 2-D or the 1-D axis.
+        Y (array-like): Latitudes of the grid points on a regular grid, 2-D or the 1-D axis.
+
+        Returns:
+        numpy.ndarray: A (rows x columns, 1) int32 array of flat grid indices, bottom row first.
+        Pixels outside the grid hold the number of grid cells.
+        int: The x offset of the array in figure pixels.
+        int: The y offset of the array in figure pixels.
+        """
+        self.ax.apply_aspect()
+        bbox = self.ax.get_window_extent()
+        x0, y0 = int(np.ceil(bbox.x0)), int(np.ceil(bbox.y0))
+        width, height = int(np.floor(bbox.x1)) - x0, int(np.floor(bbox.y1)) - y0
+
+        # PlateCarree axes map lon and lat independently, so one row and one column of
+        # pixel centres are enough to find every pixel's cell.
+        to_data = self.ax.transData.inverted()
+        lon = to_data.transform(np.column_stack([x0 + np.arange(width) + 0.5, np.full(width, y0 + 0.5)]))[:, 0]
+        lat = to_data.transform(np.column_stack([np.full(height, x0 + 0.5), y0 + np.arange(height) + 0.5]))[:, 1]
+        xi = X[0] if np.ndim(X) == 2 else X
+        yi = Y[:, 0] if np.ndim(Y) == 2 else Y
+        nx, ny = len(xi), len(yi)
+        col = np.round((lon - xi[0]) / (xi[-1] - xi[0]) * (nx - 1)).astype(np.int64)
+        row = np.round((lat - yi[0]) / (yi[-1] - yi[0]) * (ny - 1)).astype(np.int64)
+
+        cells = (row[:, None] * nx + col[None, :]).astype(np.int32)
+        outside = ((row < 0) | (row >= ny))[:, None] | ((col < 0) | (col >= nx))[None, :]
+        cells[outside] = nx * ny
+        return cells[:, :, None], x0, y0
+
+    def draw_field(self, X, Y, masked_Z):
+        """
+        Replaces the filled field and threshold isolines of the previous frame.
+
+        Parameters:
+        X (array-like): Longitudes of the grid points, 2-D or the 1-D grid axis.
+        Y (array-like): Latitudes of the grid points, 2-D or the 1-D grid axis.
+        masked_Z (array-like): Interpolated values on the grid, with the ocean masked or NaN.
+
+        Returns:
+        None
+        """
+        for artist in self._field_artists:
+            artist.remove()
+        self._field_artists = []
+
+        if self.product == 'raster':
+            if self._pixel_cells is None:
+                self._pixel_cells, x0, y0 = self.pixel_cells(X, Y)
+            # Colour the grid once, then gather those colours into output pixels; the image
+            # is already at its final size, so matplotlib does not resample it.
+            # Each RGBA pixel is gathered as one uint32.
+            colors = np.concatenate([colorize(masked_Z, self.levels, self._lut).reshape(-1, 4), self._lut[-1:]])
+            rgba = colors.view(np.uint32)[:, 0][self._pixel_cells].view(np.uint8)
+            if self._image is None:
+                # Drawn below the axes, whose background is cleared so the raster shows through.
+                self.ax.patch.set_visible(False)
+                self._image = self.fig.add_artist(PixelImage(rgba, x0, y0))
+            else:
+                self._image.set_data(rgba)
+
+        X, Y, masked_Z = thin_grid(X, Y, masked_Z, self.contour_max_points)
+        if self.product != 'raster':
+            self._field_artists.append(self.ax.contourf(X, Y, masked_Z, cmap=self.cmap, levels=self.levels, alpha=0.8))
+
+        # One pass for all thresholds instead of one contour call per level.
+        isolines = self.variable.isolines
+        if isolines:
+            lines = self.ax.contour(X, Y, masked_Z, levels=[level for level, _ in isolines], colors=[color for _, color in isolines], linewidths=0.5, transform=self.proj)
+            self._field_artists.append(lines)
+
+    def update_stations(self, stations, datetime_str, variable=None):
+        """
+        Updates the station labels and the timestamp and min/max annotations.
+
+        Parameters:
+        stations (StationTable): The station table the renderer was built with, holding this frame's readings.
+        datetime_str (str): The observation time, as YYYYMMDDHHMM.
+        variable (str): The variable whose readings are labelled. Defaults to the current variable.
+
+        Returns:
+        None
+        """
+        variable = self.variable.name if variable is None else variable
+        unit = VARIABLES[variable].unit
+        values = stations.get(variable)
+        valid = np.isfinite(values) & self._shown
+        for i, (marker, text) in enumerate(self.station_artists):
+            marker.set_visible(valid[i])
+            text.set_visible(valid[i] and self.labels)
+            if valid[i]:
+                text.set_text(f"{stations.names[i]}\n{values[i]}{unit}")
+
+        dt = datetime.strptime(datetime_str, "%Y%m%d%H%M")
+        self.datetime_text.set_text(f'datetime {dt.strftime("%B %d, %Y, %H:%M")} HKT')
+
+        if not valid.any() or not self.labels:
+            self.max_text.set_text('')
+            self.min_text.set_text('')
+            return
+        min_idx, max_idx = stations.extremes(variable)
+        self.max_text.set_text(f"maximum: {values[max_idx]}{unit} {stations.names[max_idx]}")
+        self.min_text.set_text(f"minimum: {values[min_idx]}{unit} {stations.names[min_idx]}")
+
+    def output_path(self, datetime_str):
+        """
+        Returns the path the frame of the current variable for an observation time is saved to.
+        """
+        return f'{self.output_dir}/{self.variable.map_prefix}_{datetime_str}.png'
+
+    def rasterize(self):
+        """
+        Draws the figure at the save dpi, as savefig does before encoding the PNG.
+
+        Returns:
+        numpy.ndarray: A (rows x columns x 4) uint8 RGBA copy of the canvas, top row first.
+        """
+        if self._canvas is None:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self._canvas = FigureCanvasAgg(self.fig)
+        figure_dpi = self.fig.dpi
+        self.fig.dpi = self.dpi
+        try:
+            self._canvas.draw()
+            return np.array(self._canvas.buffer_rgba())
+        finally:
+            self.fig.dpi = figure_dpi
+
+    def render(self, X, Y, masked_Z, stations, datetime_str, variable=None, on_written=None):
+        """
+        Draws one frame and saves it as <output_dir>/<map prefix>_<datetime>.png, e.g.
+        HK_temp_map_newcolor_<datetime>.png for temperature.
+
+        The PNG is written under a temporary name and renamed into place, so an interrupted
+        render never leaves a truncated file behind. With a writer, only the rasterization
+        happens here: the pixels are handed to the writer, which encodes and publishes the
+        PNG on its thread while the next frame is computed.
+
+        Parameters:
+        X (array-like): Longitudes of the grid points, 2-D or the 1-D grid axis.
+        Y (array-like): Latitudes of the grid points, 2-D or the 1-D grid axis.
+        masked_Z (array-like): Interpolated values on the grid, with the ocean masked or NaN.
+        stations (StationTable): The station table the renderer was built with, holding this frame's readings.
+        datetime_str (str): The observation time, as YYYYMMDDHHMM.
+        variable (str): The variable of the frame. Defaults to the current variable.
+        on_written (callable): Called once the PNG is in place: before render returns, or with
+            a writer, on its thread; not at all if the writer drops or fails to write it.
+
+        Returns:
+        str: The path of the saved PNG.
+        """
+        if variable is not None:
+            self.set_variable(variable)
+        with stage('draw_field'):
+            self.draw_field(X, Y, masked_Z)
+        with stage('draw_stations'):
+            self.update_stations(stations, datetime_str)
+        output_path = self.output_path(datetime_str)
+        if self.writer is not None:
+            with stage('rasterize'):
+                rgba = self.rasterize()
+            # The same encoder and metadata as savefig, so the PNG is byte-identical.
+            dpi = self.dpi
+            self.writer.submit(output_path, lambda path: mimage.imsave(path, rgba, format='png', dpi=dpi), on_written)
+            print(f'figure queued for {output_path}')
+            return output_path
+        with stage('savefig'):
+            self.fig.savefig(output_path + '.tmp', dpi=self.dpi, format='png')
+            os.replace(output_path + '.tmp', output_path)
+        print(f'figure output to {output_path}')
+        if on_written is not None:
+            on_written()
+        return output_path
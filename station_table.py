@@ -0,0 +1,108 @@
+import numpy as np
+import constants as c
+
+class StationTable:
+    """
+    Columnar table of weather stations.
+
+    Station positions are stored once as NumPy arrays, with a name -> row index map.
+    Readings are stored per variable as a float array aligned with the rows, with NaN
+    marking a station that did not report, so filtering, interpolation, labelling and
+    min/max searches are array operations rather than loops over dictionaries.
+    """
+
+    def __init__(self, names, lat, lon):
+        """
+        Parameters:
+        names (list): Station names.
+        lat (array-like): Station latitudes.
+        lon (array-like): Station longitudes.
+        """
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.values = {}
+        self.highland = np.isin(self.names, c.HIGHLAND_STATIONS)
+
+    def __len__(self):
+        return len(self.names)
+
+    def indices(self, names):
+        """
+        Maps station names to row indices.
+
+        Parameters:
+        names (iterable): Station names.
+
+        Returns:
+        numpy.ndarray: The row index of each name, -1 for names not in the table.
+        """
+        return np.fromiter((self.index.get(name, -1) for name in names), dtype=np.intp)
+
+    def set_values(self, variable, values):
+        """
+        Replaces the readings of a variable.
+
+        Parameters:
+        variable (str): The variable name, e.g. 'temperature'.
+        values (array-like): One reading per station, NaN where missing.
+
+        Returns:
+        None
+        """
+        values = np.asarray(values, dtype=float)
+        if values.shape != (len(self),):
+            raise ValueError(f"Expected {len(self)} values for {variable}, got shape {values.shape}")
+        self.values[variable] = values
+
+    def get(self, variable):
+        """
+        Returns the readings of a variable, all NaN if it has not been set.
+        """
+        if variable not in self.values:
+            return np.full(len(self), np.nan)
+        return self.values[variable]
+
+    def valid(self, variable):
+        """
+        Returns a boolean array marking the stations with a reading for a variable.
+        """
+        return np.isfinite(self.get(variable))
+
+    def extremes(self, variable):
+        """
+        Finds the stations with the lowest and highest reading of a variable.
+
+        Parameters:
+        variable (str): The variable name.
+
+        Returns:
+        tuple: (min_index, max_index) into the table rows.
+        """
+        values = self.get(variable)
+        return int(np.nanargmin(values)), int(np.nanargmax(values))
+
+    def with_virtual_stations(self, variable):
+        """
+        Appends the four virtual stations at the corners of the map to the position and
+        reading arrays. They carry the mean reading of all valid stations. The table itself
+        is not modified.
+
+        Parameters:
+        variable (str): The variable name.
+
+        Returns:
+        lon (numpy.ndarray): Longitudes of all stations followed by the virtual stations.
+        lat (numpy.ndarray): Latitudes of all stations followed by the virtual stations.
+        values (numpy.ndarray): Readings of all stations followed by the virtual stations.
+        valid (numpy.ndarray): Which of those have a reading.
+        """
+        values = self.get(variable)
+        valid = np.isfinite(values)
+        mean = values[valid].mean() if valid.any() else np.nan
+        lon = np.concatenate([self.lon, [c.MINLON, c.MAXLON, c.MINLON, c.MAXLON]])
+        lat = np.concatenate([self.lat, [c.MINLAT, c.MINLAT, c.MAXLAT, c.MAXLAT]])
+        values = np.concatenate([values, np.full(4, mean)])
+        valid = np.concatenate([valid, np.full(4, valid.any())])
+        return lon, lat, values, valid
@@ -0,0 +1,214 @@
+import numpy as np
+from collections import OrderedDict
+from raster_cache import RasterCache, raster_key
+from ocean_mask import grid_extent
+import os
+
+# Temperature change with height in °C per metre: the standard atmosphere, used when the
+# stations of a minute cannot pin a rate down, and the range a fitted rate is held to, from
+# the dry adiabatic rate to a strong inversion.
+STANDARD_LAPSE_RATE = -0.0065
+LAPSE_RATE_LIMITS = (-0.0098, 0.01)
+
+def read_dem(path):
+    """
+    Reads a digital elevation model in longitude/latitude (EPSG:4326).
+
+    Supported are ESRI ASCII grids (.asc), .npz files holding 'elevation', 'lon' and 'lat'
+    arrays, and GeoTIFFs (.tif) when rasterio is installed. Reproject other DEMs first,
+    e.g. gdalwarp -t_srs EPSG:4326 dem_hk1980.tif dem.tif.
+
+    Parameters:
+    path (str): The DEM file.
+
+    Returns:
+    numpy.ndarray: The (rows x columns) elevation in metres, south row first, NaN where unknown.
+    numpy.ndarray: The longitude of each column's cell centres.
+    numpy.ndarray: The latitude of each row's cell centres, ascending.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npz':
+        with np.load(path) as data:
+            elevation, lon, lat = data['elevation'].astype(float), data['lon'].astype(float), data['lat'].astype(float)
+    elif ext == '.asc':
+        header = {}
+        with open(path) as file:
+            for line in file:
+                key, _, value = line.strip().partition(' ')
+                if key[:1].isdigit() or key[:1] == '-':
+                    break
+                header[key.lower()] = float(value)
+        elevation = np.loadtxt(path, skiprows=len(header), dtype=float)[::-1]
+        nrows, ncols, size = int(header['nrows']), int(header['ncols']), header['cellsize']
+        # Corners give the outer edge of the lower-left cell, centres its middle.
+        x0 = header['xllcenter'] if 'xllcenter' in header else header['xllcorner'] + size / 2
+        y0 = header['yllcenter'] if 'yllcenter' in header else header['yllcorner'] + size / 2
+        lon, lat = x0 + size * np.arange(ncols), y0 + size * np.arange(nrows)
+        if 'nodata_value' in header:
+            elevation[elevation == header['nodata_value']] = np.nan
+    elif ext in ('.tif', '.tiff'):
+        try:
+            import rasterio
+        except ImportError:
+            raise ImportError("Reading a GeoTIFF DEM needs rasterio; convert it to an ESRI ASCII grid (.asc) otherwise")
+        with rasterio.open(path) as dataset:
+            elevation = dataset.read(1, masked=True).filled(np.nan).astype(float)[::-1]
+            rows, cols = np.arange(dataset.height)[::-1], np.arange(dataset.width)
+            lon = np.array([dataset.xy(0, col)[0] for col in cols])
+            lat = np.array([dataset.xy(row, 0)[1] for row in rows])
+    else:
+        raise ValueError(f"Unsupported DEM format {ext!r}, expected .asc, .npz or .tif")
+    if lat[0] > lat[-1]:
+        elevation, lat = elevation[::-1], lat[::-1]
+    return elevation, lon, lat
+
+def sample_dem(elevation, lon, lat, px, py):
+    """
+    Interpolates a DEM bilinearly at points. Points off the DEM or on unknown cells get 0,
+    i.e. sea level.
+
+    Returns:
+    numpy.ndarray: The elevation at every point in metres.
+    """
+    from scipy.interpolate import RegularGridInterpolator
+    sampler = RegularGridInterpolator((lat, lon), elevation, bounds_error=False, fill_value=np.nan)
+    values = sampler(np.column_stack([np.ravel(py), np.ravel(px)]))
+    return np.nan_to_num(values, nan=0.0)
+
+def elevation_layers(dem_path, X, Y, stations, station_paths, cache_dir):
+    """
+    Returns the elevation of every grid cell and every station, from the raster cache when
+    possible. The DEM is read only when the grid, the DEM file or the station list has changed.
+
+    Parameters:
+    dem_path (str): The DEM, see read_dem.
+    X (numpy.ndarray): The x-coordinates of the grid points.
+    Y (numpy.ndarray): The y-coordinates of the grid points.
+    stations (StationTable): The stations.
+    station_paths (list): The station location CSVs the table was read from.
+    cache_dir (str): The directory holding cached rasters, e.g. next to the ocean mask.
+
+    Returns:
+    numpy.ndarray: The float32 elevation of the grid in metres, with the shape of X.
+    numpy.ndarray: The elevation of each station in metres.
+    """
+    cache = RasterCache(cache_dir)
+    extent, nx, ny = grid_extent(X, Y)
+    # A DEM may be hundreds of MB, so it is keyed by its size and modification time rather than hashed.
+    grid_key = raster_key('elevation', extent, nx, ny, [], [dem_path])
+    station_key = raster_key('station_elevation', extent, len(stations), 1, station_paths, [dem_path])
+    grid_elevation = cache.load(grid_key, X.shape)
+    station_elevation = cache.load(station_key, (len(stations),))
+    if grid_elevation is not None and station_elevation is not None:
+        print(f"Elevation layer {grid_key[:12]} loaded from {cache_dir}")
+        return grid_elevation, np.asarray(station_elevation, dtype=float)
+
+    print(f"No cached elevation layer for this grid and DEM. Sampling {dem_path}.")
+    dem = read_dem(dem_path)
+    grid_elevation = sample_dem(*dem, X, Y).reshape(X.shape).astype(np.float32)
+    station_elevation = sample_dem(*dem, stations.lon, stations.lat)
+    cache.store(grid_key, grid_elevation, kind='elevation', extent=[float(v) for v in extent], nx=nx, ny=ny)
+    cache.store(station_key, station_elevation, kind='station_elevation', stations=len(stations))
+    print(f"Elevation layer {grid_key[:12]} saved to {cache_dir}")
+    return grid_elevation, station_elevation
+
+def fit_lapse_rate(elevation, values, valid, min_stations=5, min_spread=100.0, limits=LAPSE_RATE_LIMITS):
+    """
+    Fits the change of a reading with height across the stations by least squares.
+
+    Parameters:
+    elevation (numpy.ndarray): The elevation of each station in metres.
+    values (numpy.ndarray): One reading per station.
+    valid (numpy.ndarray): Boolean array marking the stations with a reading.
+    min_stations (int): Fewer valid stations than this give STANDARD_LAPSE_RATE.
+    min_spread (float): So does a standard deviation of their elevations below this many metres.
+    limits (tuple): The smallest and largest rate returned.
+
+    Returns:
+    float: The rate in units of the reading per metre.
+    """
+    z, v = elevation[valid], values[valid]
+    if len(z) < min_stations or z.std() < min_spread:
+        return STANDARD_LAPSE_RATE
+    dz = z - z.mean()
+    rate = float(dz @ (v - v.mean()) / (dz @ dz))
+    return min(max(rate, limits[0]), limits[1])
+
+class TerrainModel:
+    """
+    Elevation-aware interpolation: readings are detrended by a lapse rate fitted every
+    minute, the residuals interpolated, and the lapse term added back from the elevation
+    of each cell.
+
+    Interpolation is linear in the readings, and the barycentric weights W of every cell sum
+    to one, so interpolating the residuals v - rate * z_stations and adding rate * z_cells
+    is the plain field plus rate * (z_cells - W z_stations). That terrain anomaly only
+    changes with the pattern of valid stations, so it is built once per pattern and kept,
+    and each frame costs a fit over the stations and one multiply-add over the land cells,
+    on top of the plain interpolation, which keeps its incremental patching.
+
+    The virtual corner stations carry the mean reading, so they are placed at the mean
+    elevation of the valid stations: their residual is then the mean residual, as their
+    reading is the mean reading in the plain field.
+    """
+
+    def __init__(self, station_elevation, cell_elevation, max_patterns=32):
+        """
+        Parameters:
+        station_elevation (numpy.ndarray): The elevation of each station of the table in metres.
+        cell_elevation (numpy.ndarray): The elevation of each target point of the interpolator, e.g. the land cells.
+        max_patterns (int): Number of valid-station patterns whose anomaly is kept in memory.
+        """
+        self.station_elevation = np.asarray(station_elevation, dtype=float)
+        self.cell_elevation = np.asarray(cell_elevation, dtype=float)
+        self.max_patterns = max_patterns
+        # The interpolator the anomalies below were built with.
+        self._interpolator = None
+        self._anomalies = OrderedDict()
+
+    def anomaly(self, interpolator, valid):
+        """
+        Returns how much higher every target point is than its interpolated station elevation.
+
+        Parameters:
+        interpolator (StationInterpolator): The interpolator onto the target points, over the
+            stations of the table followed by the virtual stations.
+        valid (numpy.ndarray): Boolean array marking the stations with a reading, virtual ones included.
+
+        Returns:
+        numpy.ndarray: z_cells - W z_stations at every target point, NaN outside the convex hull.
+        """
+        if interpolator is not self._interpolator:
+            self._interpolator = interpolator
+            self._anomalies.clear()
+        key = np.packbits(valid).tobytes()
+        if key in self._anomalies:
+            self._anomalies.move_to_end(key)
+            return self._anomalies[key]
+
+        n = len(self.station_elevation)
+        real = valid[:n]
+        mean = self.station_elevation[real].mean() if real.any() else 0.0
+        elevation = np.concatenate([self.station_elevation, np.full(len(valid) - n, mean)])
+        anomaly = self._anomalies[key] = self.cell_elevation - interpolator.interpolate(elevation, valid)
+        if len(self._anomalies) > self.max_patterns:
+            self._anomalies.popitem(last=False)
+        return anomaly
+
+    def apply(self, Z, interpolator, values, valid):
+        """
+        Adds the lapse term to a field interpolated from the raw readings.
+
+        Parameters:
+        Z (numpy.ndarray): The plain interpolated field at the target points.
+        interpolator (StationInterpolator): The interpolator Z came from.
+        values (numpy.ndarray): The readings of the stations of the table.
+        valid (numpy.ndarray): The pattern of valid stations Z was interpolated with, virtual ones included.
+
+        Returns:
+        numpy.ndarray: The elevation-aware field, a new array.
+        float: The fitted lapse rate.
+        """
+        n = len(self.station_elevation)
+        rate = fit_lapse_rate(self.station_elevation, np.asarray(values, dtype=float)[:n], np.asarray(valid[:n], dtype=bool))
+        return Z + rate * self.anomaly(interpolator, valid), rate
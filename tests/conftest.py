@@ -0,0 +1,30 @@
+import os
+import sys
+
+import matplotlib
+import numpy as np
+import pytest
+
+matplotlib.use('Agg')
+
+# The modules live at the top of the repository and read their inputs relative to it.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+
+@pytest.fixture
+def station_network():
+    """
+    Returns a factory of random station networks over the map: station_network(n, seed) gives
+    a StationTable of n stations with temperature readings around 20 °C.
+    """
+    from station_table import StationTable
+
+    def make(n, seed, spread=2.0):
+        rng = np.random.default_rng(seed)
+        lon, lat = rng.uniform(113.8, 114.4, n), rng.uniform(22.15, 22.55, n)
+        stations = StationTable([f'Station {i}' for i in range(n)], lat, lon)
+        stations.set_values('temperature', np.round(20 + rng.normal(0, spread, n), 1))
+        return stations
+    return make
@@ -0,0 +1,31 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import archive
+from archive import FEED_TIMEZONE, ObservationArchive
+from station_table import StationTable
+
+
+class UTCHostDatetime(datetime):
+    """
+    A datetime whose local time is UTC, as on a server clock, eight hours behind the feed.
+    """
+
+    @classmethod
+    def now(cls, tz=None):
+        if tz is None:
+            return datetime.now(timezone.utc).replace(tzinfo=None)
+        return datetime.now(tz)
+
+
+def test_last_reads_hong_kong_time_on_a_utc_host(tmp_path, monkeypatch):
+    store = ObservationArchive(str(tmp_path))
+    stations = StationTable(['Alpha'], [22.3], [114.1])
+    stations.set_values('temperature', np.array([21.5]))
+    minute = datetime.now(FEED_TIMEZONE).replace(tzinfo=None) - timedelta(minutes=5)
+    store.append(stations, minute.strftime('%Y%m%d%H%M'))
+
+    monkeypatch.setattr(archive, 'datetime', UTCHostDatetime)
+    times, values, names = store.last(hours=1)
+    assert len(times) == 1 and values[0, 0] == 21.5
@@ -0,0 +1,176 @@
+import main
+from data_loader import FeedFetcher
+from station_table import StationTable
+
+FEED = ('Date time,Automatic Weather Station,Air Temperature(degree Celsius)\n'
+        '{datetime},Alpha,21.5\n'
+        '{datetime},Beta,22.0\n')
+
+
+class Response:
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.content = text.encode('utf-8')
+        self.headers = headers or {}
+
+
+class Server:
+    """
+    Serves one feed body with an ETag, answering 304 to a matching If-None-Match.
+    """
+
+    def __init__(self, datetime, etag):
+        self.body, self.etag = FEED.format(datetime=datetime), etag
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests.append(dict(headers or {}))
+        if (headers or {}).get('If-None-Match') == self.etag:
+            return Response(304)
+        return Response(200, self.body, {'ETag': self.etag})
+
+
+def make_fetcher(server):
+    fetcher = FeedFetcher('http://feed.invalid/temperature.csv')
+    fetcher.session.get = server.get
+    return fetcher
+
+
+def stations():
+    return StationTable(['Alpha', 'Beta'], [22.3, 22.4], [114.1, 114.2])
+
+
+def test_committed_snapshot_is_not_fetched_again():
+    server = Server('202503301110', '"a"')
+    fetcher = make_fetcher(server)
+    table = stations()
+
+    assert fetcher.fetch(table)[1] == '202503301110'
+    fetcher.commit()
+    assert fetcher.last_datetime == '202503301110'
+    assert fetcher.fetch(table) is None
+    assert server.requests[-1]['If-None-Match'] == '"a"'
+
+
+def test_failed_render_retries_the_same_minute(monkeypatch):
+    server = Server('202503301110', '"a"')
+    fetcher = make_fetcher(server)
+    state = {'fetchers': {'temperature': fetcher}, 'stations': stations()}
+    rendered = []
+
+    def failing_render(state, stations, datetime, variable='temperature', on_written=None):
+        raise RuntimeError('render failed')
+
+    monkeypatch.setattr(main, 'render_frame', failing_render)
+    snapshots = main.fetch_stations(state)
+    assert [(v, d) for v, _, d in snapshots] == [('temperature', '202503301110')]
+    main.render_snapshots(state, snapshots)
+    assert fetcher.etag is None and fetcher.last_datetime is None
+
+    # The next poll must not send the ETag of the minute that failed, nor skip it as unchanged.
+    def render(state, stations, datetime, variable='temperature', on_written=None):
+        rendered.append(datetime)
+        on_written()
+
+    monkeypatch.setattr(main, 'render_frame', render)
+    snapshots = main.fetch_stations(state)
+    assert 'If-None-Match' not in server.requests[-1]
+    main.render_snapshots(state, snapshots)
+    assert rendered == ['202503301110']
+    assert fetcher.last_datetime == '202503301110'
+    assert main.fetch_stations(state) == []
+
+
+def test_same_minute_under_a_new_etag_is_skipped():
+    server = Server('202503301110', '"a"')
+    fetcher = make_fetcher(server)
+    table = stations()
+    fetcher.fetch(table)
+    fetcher.commit()
+
+    server.etag = '"b"'
+    assert fetcher.fetch(table) is None
+    assert fetcher.etag == '"b"'
+
+
+def test_commit_waits_for_the_output_to_be_written(monkeypatch):
+    server = Server('202503301110', '"a"')
+    fetcher = make_fetcher(server)
+    state = {'fetchers': {'temperature': fetcher}, 'stations': stations()}
+    queued = []
+
+    def render(state, stations, datetime, variable='temperature', on_written=None):
+        queued.append(on_written)
+
+    # The PNG of 11:10 is still queued when the next poll finds the same minute.
+    monkeypatch.setattr(main, 'render_frame', render)
+    main.render_snapshots(state, main.fetch_stations(state))
+    assert fetcher.last_datetime is None
+    main.render_snapshots(state, main.fetch_stations(state))
+    assert 'If-None-Match' not in server.requests[-1]
+
+    # The second render of 11:10 is written, then 11:11, then the first one, which was dropped
+    # by the writer and never reports in; a stale commit must not move the fetcher back.
+    queued[1]()
+    assert fetcher.last_datetime == '202503301110' and fetcher.etag == '"a"'
+    server.body, server.etag = FEED.format(datetime='202503301111'), '"b"'
+    main.render_snapshots(state, main.fetch_stations(state))
+    queued[2]()
+    queued[1]()
+    assert fetcher.last_datetime == '202503301111' and fetcher.etag == '"b"'
+
+
+def test_failing_variable_does_not_stop_the_others(monkeypatch):
+    fetchers = {'wind': make_fetcher(Server('202503301110', '"w"')),
+                'temperature': make_fetcher(Server('202503301110', '"t"'))}
+    state = {'fetchers': fetchers, 'stations': stations()}
+    rendered = []
+
+    def render(state, stations, datetime, variable='temperature', on_written=None):
+        if variable == 'wind':
+            raise ValueError('At least 3 valid stations are needed to triangulate, got 2')
+        rendered.append(variable)
+        on_written()
+
+    monkeypatch.setattr(main, 'render_frame', render)
+    main.render_snapshots(state, main.fetch_stations(state))
+    assert rendered == ['temperature']
+    assert fetchers['temperature'].last_datetime == '202503301110'
+    assert fetchers['wind'].last_datetime is None
+
+
+def test_failed_frame_drops_the_state_it_carried_over(monkeypatch):
+    fetchers = {'wind': make_fetcher(Server('202503301110', '"w"')),
+                'temperature': make_fetcher(Server('202503301110', '"t"'))}
+    state = {'fetchers': fetchers, 'stations': stations(),
+             'fields': {'wind': 'wind field', 'temperature': 'temperature field'},
+             'district_stats': {'wind': 'wind stats', 'temperature': 'temperature stats'}}
+
+    def render(state, stations, datetime, variable='temperature', on_written=None):
+        if variable == 'wind':
+            raise OSError('No space left on device')
+        on_written()
+
+    monkeypatch.setattr(main, 'render_frame', render)
+    main.render_snapshots(state, main.fetch_stations(state))
+    assert state['fields'] == {'temperature': 'temperature field'}
+    assert state['district_stats'] == {'temperature': 'temperature stats'}
+
+
+def test_station_lists_extend_the_station_table(tmp_path, monkeypatch):
+    from variables import VARIABLES, station_lists
+    from data_loader import load_station_data
+
+    extra = tmp_path / 'wind_stations.csv'
+    extra.write_text('AutomaticWeatherStation_en,GeometryLongitude,GeometryLatitude\n'
+                     'Chek Lap Kok,113.9219,22.3094\n'
+                     'Gamma,114.1,22.3\n', encoding='utf-8')
+    monkeypatch.setattr(VARIABLES['wind'], 'station_list', str(extra))
+    monkeypatch.setattr(VARIABLES['pressure'], 'station_list', str(extra))
+
+    assert station_lists(['temperature']) == []
+    paths = [main.STATION_LOCATION_DATA_PATH, *station_lists(VARIABLES)]
+    assert paths == [main.STATION_LOCATION_DATA_PATH, str(extra)]
+    table = load_station_data(*paths)
+    temperature_only = load_station_data(main.STATION_LOCATION_DATA_PATH)
+    assert list(table.names) == [*temperature_only.names, 'Gamma']
@@ -0,0 +1,124 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from grid_product import CHUNK_ROWS, MISSING, GridStore, decode_rows, encode_rows, export, quantization
+from station_table import StationTable
+
+NY, NX = 2 * CHUNK_ROWS + 10, 7
+
+
+def test_encode_rows_round_trips_with_wraparound():
+    rng = np.random.default_rng(3)
+    q = rng.integers(np.iinfo(np.int16).min, np.iinfo(np.int16).max, size=(5, 40), dtype=np.int16, endpoint=True)
+    # Neighbours at opposite ends of the range make the differences wrap around in int16.
+    q[0, :4] = [MISSING, np.iinfo(np.int16).max, MISSING, -1]
+    np.testing.assert_array_equal(decode_rows(encode_rows(q), q.shape[1]), q)
+
+
+def make_stations(values):
+    stations = StationTable(['Alpha', 'Beta', 'Gamma'], [22.3, 22.4, 22.5], [114.0, 114.1, 114.2])
+    stations.set_values('temperature', np.asarray(values, dtype=float))
+    return stations
+
+
+def make_field(seed=0):
+    rng = np.random.default_rng(seed)
+    Z = 15 + 10 * rng.random((NY, NX))
+    Z[3, :] = np.nan
+    Z[CHUNK_ROWS - 1:CHUNK_ROWS + 1, 2] = np.nan
+    return Z
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = GridStore(str(tmp_path / 'grid'))
+    xi, yi = np.linspace(113.7, 114.5, NX), np.linspace(22.1, 22.6, NY)
+    store.append(xi, yi, make_field(0), make_stations([20.1, np.nan, 22.3]), '202503302359')
+    store.append(xi, yi, make_field(1), make_stations([20.5, 21.0, 22.0]), '202503310000')
+    return store
+
+
+def test_frames_round_trip_within_the_quantization_step(store):
+    scale_factor, _ = quantization('temperature')
+    times, fields, headers = store.read('202503300000', '202503312359')
+    assert times.astype(str).tolist() == ['2025-03-30T23:59', '2025-03-31T00:00']
+    for field, seed in zip(fields, (0, 1)):
+        expected = make_field(seed)
+        np.testing.assert_array_equal(np.isnan(field), np.isnan(expected))
+        np.testing.assert_allclose(field, expected, rtol=0, atol=scale_factor / 2 + 1e-5, equal_nan=True)
+    assert headers[0]['stations']['names'] == ['Alpha', 'Gamma']
+    assert headers[1]['stations']['values'] == [20.5, 21.0, 22.0]
+
+
+def test_out_of_range_values_are_clipped_not_missing(tmp_path):
+    store = GridStore(str(tmp_path))
+    scale_factor, add_offset = quantization('temperature')
+    Z = np.full((4, 3), add_offset + 1000.0)
+    store.append(np.arange(3.0), np.arange(4.0), Z, make_stations([1, 2, 3]), '202503301110')
+    _, fields, _ = store.read('202503301110', '202503301110')
+    np.testing.assert_allclose(fields[0], add_offset + np.iinfo(np.int16).max * scale_factor, rtol=1e-6)
+
+
+@pytest.mark.parametrize('rows', [slice(0, 5), slice(CHUNK_ROWS - 3, CHUNK_ROWS + 3),
+                                  slice(CHUNK_ROWS - 1, 2 * CHUNK_ROWS + 1), slice(2 * CHUNK_ROWS, NY), slice(None)])
+def test_partial_rows_match_the_whole_frame(store, rows):
+    _, whole, _ = store.read('202503302359', '202503302359')
+    _, part, _ = store.read('202503302359', '202503302359', rows=rows)
+    np.testing.assert_array_equal(part[0], whole[0][rows])
+
+
+def test_appending_the_same_minute_replaces_it(store):
+    xi, yi = np.linspace(113.7, 114.5, NX), np.linspace(22.1, 22.6, NY)
+    store.append(xi, yi, make_field(5), make_stations([1, 2, 3]), '202503310000')
+    times, fields, headers = store.read('202503310000', '202503310000')
+    assert len(times) == 1 and headers[0]['stations']['values'] == [1, 2, 3]
+    _, reread, _ = store.read('202503310000', '202503310000')
+    np.testing.assert_array_equal(fields, reread)
+    np.testing.assert_allclose(fields[0], make_field(5), rtol=0, atol=0.006, equal_nan=True)
+
+
+def test_only_the_last_day_written_stays_open(store):
+    # The fixture wrote to two days of the same grid.
+    assert [os.path.basename(path) for path, _ in store._index.values()] == ['20250331.index.npy']
+
+
+def test_export_npz(store, tmp_path):
+    path = str(tmp_path / 'frames.npz')
+    assert export(store, path, '202503300000', '202503312359') == 2
+    _, fields, _ = store.read('202503300000', '202503312359')
+    with np.load(path) as data:
+        np.testing.assert_array_equal(data['temperature'], fields)
+        assert data['station_names'].tolist() == ['Alpha', 'Beta', 'Gamma']
+        assert np.isnan(data['station_values'][0, 1]) and data['station_values'][1, 1] == 21.0
+        assert len(data['lat']) == NY and len(data['lon']) == NX
+
+
+def test_export_netcdf3(store, tmp_path, monkeypatch):
+    from scipy.io import netcdf_file
+    # Without netCDF4 the export falls back to NetCDF-3 through scipy.
+    monkeypatch.setitem(sys.modules, 'netCDF4', None)
+    path = str(tmp_path / 'frames.nc')
+    assert export(store, path, '202503300000', '202503312359') == 2
+    _, fields, _ = store.read('202503300000', '202503312359')
+    with netcdf_file(path, 'r', mmap=False) as dataset:
+        var = dataset.variables['temperature']
+        packed = var[:].copy()
+        assert var.units == b'degC'
+        assert var._FillValue == MISSING
+        unpacked = packed * var.scale_factor + var.add_offset
+        unpacked[packed == MISSING] = np.nan
+        np.testing.assert_allclose(unpacked, fields, rtol=0, atol=1e-5, equal_nan=True)
+        assert dataset.variables['time'][:].tolist()[1] - dataset.variables['time'][:].tolist()[0] == 1
+
+
+def test_export_netcdf4(store, tmp_path):
+    netCDF4 = pytest.importorskip('netCDF4')
+    path = str(tmp_path / 'frames.nc')
+    assert export(store, path, '202503300000', '202503312359') == 2
+    _, fields, _ = store.read('202503300000', '202503312359')
+    with netCDF4.Dataset(path) as dataset:
+        np.testing.assert_allclose(np.ma.filled(dataset.variables['temperature'][:], np.nan), fields,
+                                   rtol=0, atol=1e-5, equal_nan=True)
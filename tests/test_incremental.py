@@ -0,0 +1,149 @@
+import numpy as np
+import pytest
+
+from districts import DistrictStats
+from interpolator import IncrementalField, StationInterpolator
+from plotter import make_grid
+
+NX, NY = 80, 60
+
+
+@pytest.fixture
+def network(station_network):
+    X, Y = make_grid(NX, NY)
+    return station_network(30, seed=1), X, Y
+
+
+def make_interpolator(stations, X, Y):
+    lon, lat, _, _ = stations.with_virtual_stations('temperature')
+    return StationInterpolator(lon, lat, X, Y, f'test {NX}x{NY}')
+
+
+def readings(stations):
+    _, _, values, valid = stations.with_virtual_stations('temperature')
+    return values, valid
+
+
+def change(stations, idx, delta):
+    values = stations.get('temperature').copy()
+    values[idx] += delta
+    stations.set_values('temperature', values)
+
+
+def district_stats():
+    # Four districts in the quadrants of the grid, with a strip outside every district.
+    labels = np.zeros((NY, NX), dtype=np.uint8)
+    labels[:NY // 2, :NX // 2], labels[:NY // 2, NX // 2:] = 1, 2
+    labels[NY // 2:, :NX // 2], labels[NY // 2:, NX // 2:-5] = 3, 4
+    return DistrictStats(['A', 'B', 'C', 'D'], labels)
+
+
+def on_grid(field):
+    # Leave a block of cells out, as the ocean is, so that the statistics see NaN.
+    Z = field.reshape(NY, NX).copy()
+    Z[:10, :15] = np.nan
+    return Z
+
+
+def assert_stats_equal(patched, full):
+    np.testing.assert_array_equal(patched['cells'], full['cells'])
+    for key in ('mean', 'min', 'max'):
+        np.testing.assert_allclose(patched[key], full[key], rtol=0, atol=1e-9)
+
+
+def test_patched_field_and_statistics_equal_a_full_recompute(network):
+    stations, X, Y = network
+    interpolator = make_interpolator(stations, X, Y)
+    field = IncrementalField(max_fraction=1.0)
+    districts = district_stats()
+    stats = districts.compute(on_grid(field.update(interpolator, *readings(stations))))
+    assert field.changed is None
+
+    for step, idx in enumerate([[3], [5, 17], [29]]):
+        change(stations, idx, 0.3 * (step + 1))
+        before = field.field.copy()
+        Z = field.update(interpolator, *readings(stations))
+        assert field.changed is not None
+        full = interpolator.interpolate(*readings(stations))
+        np.testing.assert_allclose(Z, full, rtol=0, atol=1e-9)
+        # Every cell that moved is reported as changed.
+        moved = np.flatnonzero(np.abs(Z - before) > 0)
+        assert np.isin(moved, field.changed).all()
+
+        districts.update(stats, on_grid(Z), field.changed)
+        assert_stats_equal(stats, districts.compute(on_grid(full)))
+
+
+def test_default_settings_patch_a_few_changed_stations(network):
+    # Any change shifts the mean reading of the corner stations, which hold about a third
+    # of the weights; only the real stations count against max_fraction.
+    stations, X, Y = network
+    interpolator = make_interpolator(stations, X, Y)
+    field = IncrementalField()
+    field.update(interpolator, *readings(stations))
+    for idx in ([3], [12, 20]):
+        change(stations, idx, 0.4)
+        Z = field.update(interpolator, *readings(stations))
+        assert field.changed is not None
+        np.testing.assert_allclose(Z, interpolator.interpolate(*readings(stations)), rtol=0, atol=1e-9)
+    assert field.updates == 2
+
+
+def test_unchanged_readings_patch_nothing(network):
+    stations, X, Y = network
+    interpolator = make_interpolator(stations, X, Y)
+    field = IncrementalField()
+    first = field.update(interpolator, *readings(stations)).copy()
+    np.testing.assert_array_equal(field.update(interpolator, *readings(stations)), first)
+    assert len(field.changed) == 0
+
+
+def test_recomputes_after_max_updates(network):
+    stations, X, Y = network
+    interpolator = make_interpolator(stations, X, Y)
+    field = IncrementalField(max_fraction=1.0, max_updates=2)
+    field.update(interpolator, *readings(stations))
+    for expect_patch in (True, True, False, True):
+        change(stations, [7], 0.1)
+        Z = field.update(interpolator, *readings(stations))
+        assert (field.changed is not None) == expect_patch
+        np.testing.assert_allclose(Z, interpolator.interpolate(*readings(stations)), rtol=0, atol=1e-9)
+    assert field.updates == 1
+
+
+def test_recomputes_when_a_station_drops_out(network):
+    stations, X, Y = network
+    interpolator = make_interpolator(stations, X, Y)
+    field = IncrementalField(max_fraction=1.0)
+    districts = district_stats()
+    field.update(interpolator, *readings(stations))
+
+    values = stations.get('temperature').copy()
+    values[11] = np.nan
+    stations.set_values('temperature', values)
+    Z = field.update(interpolator, *readings(stations))
+    assert field.changed is None
+    np.testing.assert_array_equal(Z, interpolator.interpolate(*readings(stations)))
+    assert_stats_equal(districts.compute(on_grid(Z)), districts.compute(on_grid(interpolator.interpolate(*readings(stations)))))
+
+
+def test_recomputes_for_a_different_interpolator(network):
+    stations, X, Y = network
+    field = IncrementalField(max_fraction=1.0)
+    field.update(make_interpolator(stations, X, Y), *readings(stations))
+    change(stations, [2], 0.5)
+    other = make_interpolator(stations, X, Y)
+    Z = field.update(other, *readings(stations))
+    assert field.changed is None and field.interpolator is other
+    np.testing.assert_array_equal(Z, other.interpolate(*readings(stations)))
+
+
+def test_recomputes_when_the_change_is_too_wide(network):
+    stations, X, Y = network
+    interpolator = make_interpolator(stations, X, Y)
+    field = IncrementalField(max_fraction=0.01)
+    field.update(interpolator, *readings(stations))
+    change(stations, np.arange(30), 1.0)
+    Z = field.update(interpolator, *readings(stations))
+    assert field.changed is None
+    np.testing.assert_array_equal(Z, interpolator.interpolate(*readings(stations)))
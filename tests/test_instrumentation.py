@@ -0,0 +1,26 @@
+import tracemalloc
+
+from instrumentation import StageRecorder
+
+MB = 1 << 20
+
+
+def test_parent_peak_survives_a_child_stage():
+    recorder = StageRecorder(trace_memory=True)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        with recorder.stage('frame'):
+            block = bytearray(32 * MB)
+            del block
+            with recorder.stage('render'):
+                small = bytearray(MB)
+                del small
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    peaks = {record['stage']: record['traced_peak_bytes'] for record in recorder.records}
+    assert peaks['frame.render'] < 8 * MB
+    assert peaks['frame'] >= 32 * MB
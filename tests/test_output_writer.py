@@ -0,0 +1,149 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import instrumentation
+import main
+from districts import DistrictStats
+from instrumentation import StageRecorder
+from output_writer import OutputWriter, latest_path, prune_frames, publish_latest
+from plotter import make_grid
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    monkeypatch.setattr(instrumentation, '_ACTIVE', None)
+    return StageRecorder().activate()
+
+
+def gauge_value(recorder, name):
+    return recorder.gauges[(name, ())]['value']
+
+
+def write_text(text, started=None, release=None):
+    def write(path):
+        if started is not None:
+            started.set()
+            release.wait(10)
+        with open(path, 'w') as file:
+            file.write(text)
+    return write
+
+
+def frame(directory, minute, ext='png', prefix='HK_temp_map'):
+    return os.path.join(directory, f'{prefix}_2025033011{minute:02d}.{ext}')
+
+
+def test_full_queue_drops_the_oldest_waiting_job(tmp_path, recorder):
+    writer = OutputWriter(max_queue=2)
+    started, release = threading.Event(), threading.Event()
+    writer.submit(frame(tmp_path, 0), write_text('0', started, release))
+    assert started.wait(10)
+    # The first job is being written, so three more overflow the queue of two by one.
+    for minute in (1, 2, 3):
+        writer.submit(frame(tmp_path, minute), write_text(str(minute)))
+    assert writer.dropped == 1
+    assert writer.depth == 3
+    assert gauge_value(recorder, 'writer_queue_depth') == 3
+    assert gauge_value(recorder, 'writer_dropped') == 1
+
+    release.set()
+    writer.close()
+    assert sorted(os.listdir(tmp_path)) == [os.path.basename(frame(tmp_path, m)) for m in (0, 2, 3)] + ['HK_temp_map_latest.png']
+    assert writer.written == 3
+    assert writer.depth == 0 and gauge_value(recorder, 'writer_queue_depth') == 0
+    assert gauge_value(recorder, 'writer_written') == 3
+
+
+def test_only_files_in_place_are_reported_written(tmp_path):
+    writer = OutputWriter(max_queue=1)
+    started, release = threading.Event(), threading.Event()
+    written = []
+
+    def failing_write(path):
+        raise OSError('No space left on device')
+
+    writer.submit(frame(tmp_path, 0), write_text('0', started, release), lambda: written.append(0))
+    assert started.wait(10)
+    writer.submit(frame(tmp_path, 1), write_text('1'), lambda: written.append(1))
+    writer.submit(frame(tmp_path, 2), failing_write, lambda: written.append(2))
+    release.set()
+    writer.flush()
+    writer.submit(frame(tmp_path, 3), write_text('3'), lambda: written.append(3))
+    writer.close()
+    # 1 was dropped for 2, which failed.
+    assert written == [0, 3]
+
+
+def test_submit_after_close_raises(tmp_path):
+    writer = OutputWriter()
+    writer.close()
+    writer.close()
+    with pytest.raises(RuntimeError):
+        writer.submit(frame(tmp_path, 0), write_text('0'))
+
+
+def test_latest_alias_follows_the_newest_frame_and_survives_pruning(tmp_path):
+    writer = OutputWriter(keep=1)
+    for minute in (0, 1):
+        writer.submit(frame(tmp_path, minute), write_text(f'frame {minute}'))
+        writer.flush()
+        with open(tmp_path / 'HK_temp_map_latest.png') as file:
+            assert file.read() == f'frame {minute}'
+    writer.close()
+    assert sorted(os.listdir(tmp_path)) == ['HK_temp_map_202503301101.png', 'HK_temp_map_latest.png']
+    assert not any(name.endswith('.tmp') for name in os.listdir(tmp_path))
+
+    # The alias is a link of its own, so removing the frame leaves it readable.
+    os.remove(frame(tmp_path, 1))
+    with open(tmp_path / 'HK_temp_map_latest.png') as file:
+        assert file.read() == 'frame 1'
+
+
+def test_latest_path_needs_a_frame_name(tmp_path):
+    assert latest_path(str(tmp_path / 'HK_district_temp_202503301110.csv')) == str(tmp_path / 'HK_district_temp_latest.csv')
+    with pytest.raises(ValueError):
+        latest_path(str(tmp_path / 'notes.txt'))
+    path = frame(tmp_path, 5)
+    with open(path, 'w') as file:
+        file.write('5')
+    assert publish_latest(path) == str(tmp_path / 'HK_temp_map_latest.png')
+
+
+def test_prune_frames_keeps_each_group_by_the_time_in_its_names(tmp_path):
+    names = []
+    for minute in range(6):
+        for prefix, ext in (('HK_temp_map', 'png'), ('HK_district_temp', 'csv')):
+            names.append(os.path.basename(frame(tmp_path, minute, ext, prefix)))
+    # A re-rendered old minute is newer on disk but not in its name.
+    names += ['HK_temp_map_latest.png', 'README.txt', 'HK_district_temp_202503301030.json']
+    for name in reversed(names):
+        (tmp_path / name).write_text(name)
+
+    assert prune_frames(str(tmp_path)) == []
+    removed = prune_frames(str(tmp_path), keep=4)
+    assert sorted(removed) == sorted(os.path.basename(frame(tmp_path, m, e, p)) for m in (0, 1)
+                                     for p, e in (('HK_temp_map', 'png'), ('HK_district_temp', 'csv')))
+    removed = prune_frames(str(tmp_path), max_age=2)
+    assert sorted(removed) == sorted(os.path.basename(frame(tmp_path, 2, e, p))
+                                     for p, e in (('HK_temp_map', 'png'), ('HK_district_temp', 'csv')))
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        [os.path.basename(frame(tmp_path, m, e, p)) for m in (3, 4, 5) for p, e in (('HK_temp_map', 'png'), ('HK_district_temp', 'csv'))]
+        + ['HK_temp_map_latest.png', 'README.txt', 'HK_district_temp_202503301030.json'])
+
+
+def test_statistics_are_pruned_without_a_map(tmp_path, station_network):
+    X, Y = make_grid(40, 30)
+    labels = np.zeros(X.shape, dtype=np.uint8)
+    labels[:, :20], labels[:, 20:] = 1, 2
+    writer = OutputWriter(keep=2)
+    state = {'X': X, 'Y': Y, 'land_idx': np.arange(X.size), 'fields': {}, 'district_stats': {},
+             'districts': DistrictStats(['West', 'East'], labels), 'output_dir': str(tmp_path)}
+    main.add_outputs(state, writer=writer)
+    stations = station_network(20, seed=4)
+    for minute in (10, 11, 12):
+        main.render_frame(state, stations, f'2025033011{minute}')
+    writer.close()
+    assert sorted(os.listdir(tmp_path)) == [f'HK_district_temp_2025033011{m}.{ext}' for m in (11, 12) for ext in ('csv', 'json')]
@@ -0,0 +1,60 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from archive import ObservationArchive
+from data_loader import load_station_data
+from point_query import PointQuery, QueryHandler
+
+STATION_LOCATION_DATA_PATH = 'input/station_location.csv'
+
+
+@pytest.fixture
+def server(tmp_path):
+    stations = load_station_data(STATION_LOCATION_DATA_PATH)
+    stations.set_values('temperature', np.linspace(18, 24, len(stations)))
+    store = ObservationArchive(str(tmp_path))
+    store.append(stations, '202503301110')
+
+    handler = type('Handler', (QueryHandler,), {'point_query': PointQuery(stations), 'archive': store,
+                                                'log_message': lambda self, *args: None})
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/query'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(), method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_post_answers_a_list_of_points(server):
+    status, payload = post(server, {'lat': [22.30, 22.45], 'lon': [114.17, 114.00]})
+    assert status == 200
+    assert payload['datetime'] == '202503301110' and len(payload['values']) == 2
+
+
+@pytest.mark.parametrize('body', [
+    {'lat': 22.3, 'lon': 114.1},
+    {'lat': '22.3', 'lon': '114.1'},
+    {'lat': [22.3], 'lon': 114.1},
+    {'lat': ['22.3'], 'lon': [114.1]},
+    {'lat': [True], 'lon': [114.1]},
+    {'lat': [22.3]},
+    [22.3, 114.1],
+])
+def test_post_rejects_malformed_points(server, body):
+    status, payload = post(server, body)
+    assert status == 400 and 'error' in payload
@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+import pytest
+
+import raster_cache
+import terrain
+from interpolator import StationInterpolator
+from plotter import make_grid
+from terrain import LAPSE_RATE_LIMITS, STANDARD_LAPSE_RATE, TerrainModel, elevation_layers, fit_lapse_rate, read_dem
+
+
+@pytest.fixture
+def elevation():
+    return np.random.default_rng(6).uniform(0, 900, 12)
+
+
+def test_fit_lapse_rate_recovers_a_linear_profile(elevation):
+    values = 25 - 0.006 * elevation
+    assert fit_lapse_rate(elevation, values, np.ones(12, dtype=bool)) == pytest.approx(-0.006)
+
+
+def test_fit_lapse_rate_falls_back_to_the_standard_rate(elevation):
+    values = 25 - 0.002 * elevation
+    few = np.zeros(12, dtype=bool)
+    few[:4] = True
+    assert fit_lapse_rate(elevation, values, few) == STANDARD_LAPSE_RATE
+    # Plenty of stations, but all within a few metres of each other.
+    flat = 5 + np.linspace(0, 10, 12)
+    assert fit_lapse_rate(flat, 25 - 0.002 * flat, np.ones(12, dtype=bool)) == STANDARD_LAPSE_RATE
+
+
+@pytest.mark.parametrize('slope, expected', [(-0.03, LAPSE_RATE_LIMITS[0]), (0.05, LAPSE_RATE_LIMITS[1])])
+def test_fit_lapse_rate_is_clamped_to_the_limits(elevation, slope, expected):
+    assert fit_lapse_rate(elevation, 20 + slope * elevation, np.ones(12, dtype=bool)) == expected
+
+
+def test_lapse_term_equals_interpolating_the_detrended_readings(station_network):
+    # Plain field + rate * anomaly must be the field of the residuals v - rate * z, with the
+    # corner stations at the mean elevation of the valid stations, plus rate * z at each cell.
+    rng = np.random.default_rng(7)
+    stations = station_network(30, seed=5)
+    values = stations.get('temperature').copy()
+    values[[3, 11]] = np.nan
+    stations.set_values('temperature', values)
+    X, Y = make_grid(80, 60)
+    station_elevation = rng.uniform(0, 900, 30)
+    cell_elevation = rng.uniform(0, 900, X.size)
+
+    lon, lat, readings, valid = stations.with_virtual_stations('temperature')
+    interpolator = StationInterpolator(lon, lat, X, Y, 'terrain test 80x60')
+    model = TerrainModel(station_elevation, cell_elevation)
+    Z, rate = model.apply(interpolator.interpolate(readings, valid), interpolator, values, valid)
+    assert rate == fit_lapse_rate(station_elevation, values, np.isfinite(values))
+
+    mean_elevation = station_elevation[valid[:30]].mean()
+    elevations = np.concatenate([station_elevation, np.full(4, mean_elevation)])
+    expected = interpolator.interpolate(readings - rate * elevations, valid) + rate * cell_elevation
+    np.testing.assert_allclose(Z, expected, rtol=0, atol=1e-9)
+
+
+def write_asc(path, origin):
+    path.write_text(f'ncols 3\nnrows 2\n{origin}\ncellsize 0.5\nNODATA_value -9999\n'
+                    '1 2 -9999\n'
+                    '4 5 6\n')
+    return str(path)
+
+
+def test_read_dem_asc_rows_run_south_first(tmp_path):
+    elevation, lon, lat = read_dem(write_asc(tmp_path / 'dem.asc', 'xllcorner 114.0\nyllcorner 22.0'))
+    np.testing.assert_array_equal(elevation, [[4, 5, 6], [1, 2, np.nan]])
+    np.testing.assert_allclose(lon, [114.25, 114.75, 115.25])
+    np.testing.assert_allclose(lat, [22.25, 22.75])
+
+
+def test_read_dem_asc_centre_origin(tmp_path):
+    _, lon, lat = read_dem(write_asc(tmp_path / 'dem.asc', 'xllcenter 114.0\nyllcenter 22.0'))
+    np.testing.assert_allclose(lon, [114.0, 114.5, 115.0])
+    np.testing.assert_allclose(lat, [22.0, 22.5])
+
+
+
+def test_elevation_layers_are_keyed_by_the_dem_file_not_hashed(tmp_path, station_network, monkeypatch):
+    dem = write_asc(tmp_path / 'dem.asc', 'xllcorner 113.7\nyllcorner 22.0')
+    stations = station_network(5, seed=8)
+    X, Y = make_grid(20, 10)
+    cache_dir = str(tmp_path / 'cache')
+    reads, hashed = [], []
+    monkeypatch.setattr(terrain, 'read_dem', lambda path: reads.append(path) or read_dem(path))
+    hash_files = raster_cache.hash_files
+    monkeypatch.setattr(raster_cache, 'hash_files', lambda paths, digest=None: hashed.extend(paths) or hash_files(paths, digest))
+
+    first, _ = elevation_layers(dem, X, Y, stations, [], cache_dir)
+    np.testing.assert_array_equal(elevation_layers(dem, X, Y, stations, [], cache_dir)[0], first)
+    assert reads == [dem] and dem not in hashed
+
+    # A new modification time is a new DEM.
+    stat = os.stat(dem)
+    os.utime(dem, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    elevation_layers(dem, X, Y, stations, [], cache_dir)
+    assert reads == [dem, dem]
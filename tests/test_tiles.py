@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+import pytest
+
+from interpolator import IncrementalField, StationInterpolator
+from plotter import make_grid
+from tiles import TilePyramid
+
+ZOOMS = (8, 9, 10)
+
+
+def tree(directory):
+    """
+    Returns {relative path: bytes} of the PNG tiles under a directory.
+    """
+    files = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.endswith('.png'):
+                path = os.path.join(root, name)
+                with open(path, 'rb') as file:
+                    files[os.path.relpath(path, directory)] = file.read()
+    return files
+
+
+@pytest.fixture
+def frames(station_network):
+    """
+    Two frames of a field interpolated incrementally, the second with a few stations changed,
+    and the cells the second patched.
+    """
+    X, Y = make_grid(160, 100)
+    stations = station_network(25, seed=2, spread=3.0)
+    values = stations.get('temperature')
+    # Sea along the south of the map, as the ocean mask leaves it.
+    sea = Y < 22.2
+
+    def frame(field, interpolator, readings):
+        stations.set_values('temperature', readings)
+        lon, lat, v, valid = stations.with_virtual_stations('temperature')
+        Z = field.update(interpolator, v, valid).reshape(X.shape).copy()
+        Z[sea] = np.nan
+        return Z, field.changed
+
+    lon, lat, _, _ = stations.with_virtual_stations('temperature')
+    interpolator = StationInterpolator(lon, lat, X, Y, 'tiles test')
+    field = IncrementalField(max_fraction=1.0)
+    first, _ = frame(field, interpolator, values)
+    changed_values = values.copy()
+    changed_values[[4, 9]] += [2.0, -3.0]
+    second, changed = frame(field, interpolator, changed_values)
+    assert changed is not None and 0 < len(changed) < X.size
+    return X, Y, first, second, changed
+
+
+def test_incremental_pyramid_equals_one_built_from_scratch(tmp_path, frames):
+    X, Y, first, second, changed = frames
+    incremental = TilePyramid(str(tmp_path / 'incremental'), ZOOMS)
+    incremental.render(X, Y, first, 'temperature', '202503301110')
+    written = incremental.render(X, Y, second, 'temperature', '202503301111', changed=changed)
+    assert 0 < written < incremental.n_tiles
+
+    scratch = TilePyramid(str(tmp_path / 'scratch'), ZOOMS)
+    scratch.render(X, Y, second, 'temperature', '202503301111')
+    assert tree(tmp_path / 'incremental') == tree(tmp_path / 'scratch')
+
+
+def test_forgotten_frame_samples_every_tile(tmp_path, frames):
+    # The second frame failed before its tiles were written, and its retry finds nothing changed.
+    X, Y, first, second, _ = frames
+    pyramid = TilePyramid(str(tmp_path / 'retry'), ZOOMS)
+    pyramid.render(X, Y, first, 'temperature', '202503301110')
+    pyramid.forget('temperature')
+    assert pyramid.render(X, Y, second, 'temperature', '202503301111', changed=np.array([], dtype=int)) > 0
+
+    scratch = TilePyramid(str(tmp_path / 'scratch'), ZOOMS)
+    scratch.render(X, Y, second, 'temperature', '202503301111')
+    assert tree(tmp_path / 'retry') == tree(tmp_path / 'scratch')
+
+
+def test_unchanged_tiles_are_not_rewritten(tmp_path, frames):
+    X, Y, first, _, _ = frames
+    pyramid = TilePyramid(str(tmp_path), ZOOMS)
+    assert pyramid.render(X, Y, first, 'temperature') > 0
+    # A new process starts from the digests in index.json.
+    assert TilePyramid(str(tmp_path), ZOOMS).render(X, Y, first, 'temperature') == 0
+
+
+def test_tiles_turned_all_sea_are_removed(tmp_path, frames):
+    X, Y, first, _, _ = frames
+    pyramid = TilePyramid(str(tmp_path), ZOOMS)
+    pyramid.render(X, Y, first, 'temperature')
+    before = tree(tmp_path)
+
+    west = X < 114.0
+    sea = first.copy()
+    sea[west] = np.nan
+    pyramid.render(X, Y, sea, 'temperature', changed=np.flatnonzero(west))
+    after = tree(tmp_path)
+    assert set(after) < set(before)
+
+    scratch = TilePyramid(str(tmp_path / 'scratch'), ZOOMS)
+    scratch.render(X, Y, sea, 'temperature')
+    assert after == tree(tmp_path / 'scratch')
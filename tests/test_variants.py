@@ -0,0 +1,73 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import main
+from conftest import ROOT
+from plotter import make_grid
+
+SCRIPT = '''
+import os, sys, threading
+sys.path.insert(0, {root!r}); os.chdir({root!r})
+import numpy as np
+from plotter import make_grid
+from data_loader import load_station_data
+from variants import VariantPool, VARIANTS
+
+if __name__ == '__main__':
+    stations = load_station_data('input/station_location.csv')
+    stations.set_values('temperature', np.linspace(18, 24, len(stations)))
+    # A thread holding the stdout lock while the workers start, as the output writer may.
+    threading.Thread(target=lambda: [print('.', end='', flush=True) for _ in range(20000)], daemon=True).start()
+    pool = VariantPool([VARIANTS['thumbnail']], {output_dir!r}, ['input/station_location.csv'],
+                       'input/hk_coast_2022/Hong_Kong_18_Districts/reprojected_HKDistrict18.shp', 'input/mask_cache')
+    assert pool.pool._mp_context.get_start_method() in ('forkserver', 'spawn')
+    name = None
+    for minute, size in (('202503301110', 60), ('202503301111', 80)):
+        X, Y = make_grid(size, size)
+        paths = pool.wait(pool.submit(X, Y, 20 + X - X.mean(), stations, minute))
+        assert len(paths) == 1 and os.path.exists(paths[0]), paths
+    name = pool.field._block.name
+    pool.close()
+    assert not os.path.exists('/dev/shm/' + name.lstrip('/'))
+    print('done')
+'''
+
+
+def test_pool_renders_without_leaking_shared_memory(tmp_path):
+    script = tmp_path / 'pool.py'
+    script.write_text(SCRIPT.format(root=ROOT, output_dir=str(tmp_path / 'output')))
+    result = subprocess.run([sys.executable, str(script)], capture_output=True, text=True, timeout=600)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.rstrip().endswith('done')
+    # The resource tracker reports blocks it thinks leaked, and errors on a double unregister, on stderr.
+    assert 'leaked' not in result.stderr and 'Traceback' not in result.stderr, result.stderr
+    assert sorted(os.listdir(tmp_path / 'output' / 'thumbnail')) == [
+        'HK_temp_map_newcolor_202503301110.png', 'HK_temp_map_newcolor_202503301111.png', 'HK_temp_map_newcolor_latest.png']
+
+
+def test_variants_are_awaited_when_the_frame_fails(station_network):
+    class Pool:
+        def __init__(self):
+            self.waited = []
+
+        def submit(self, X, Y, Z, stations, datetime, variable):
+            return ['future']
+
+        def wait(self, futures):
+            self.waited.append(futures)
+            return []
+
+    class Store:
+        def append(self, *args):
+            raise OSError('No space left on device')
+
+    X, Y = make_grid(40, 30)
+    pool = Pool()
+    state = {'X': X, 'Y': Y, 'land_idx': np.arange(X.size), 'fields': {}, 'variants': pool, 'grid_store': Store()}
+    with pytest.raises(OSError):
+        main.render_frame(state, station_network(20, seed=3), '202503301110')
+    assert pool.waited == [['future']]
@@ -0,0 +1,127 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlparse
+import json
+import os
+import re
+
+TILE_PATH = re.compile(r'^/(?P<variable>[A-Za-z0-9_]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$')
+TILEJSON_PATH = re.compile(r'^/(?P<variable>[A-Za-z0-9_]+)\.json$')
+
+class TileHandler(BaseHTTPRequestHandler):
+    """
+    Serves the tile pyramids written by tiles.TilePyramid straight from disk.
+
+    GET /<variable>/<z>/<x>/<y>.png  One tile. 404 where the pyramid has no tile, e.g. over the sea.
+    GET /<variable>.json             TileJSON describing the variable's pyramid.
+
+    Tiles carry an ETag and Last-Modified taken from the file, which the pyramid only rewrites
+    when the tile's colours change, and a Cache-Control max-age of about the feed's update
+    interval. A client revalidating a tile that did not change gets 304 Not Modified.
+    """
+
+    # Set by serve.
+    tile_dir = None
+    max_age = 60
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        match = TILE_PATH.match(path)
+        if match is not None:
+            return self._send_tile(match['variable'], match['z'], match['x'], match['y'])
+        match = TILEJSON_PATH.match(path)
+        if match is not None:
+            return self._send_tilejson(match['variable'])
+        self._send(404, b'', 'text/plain')
+
+    def _send_tile(self, variable, z, x, y):
+        path = os.path.join(self.tile_dir, variable, z, x, f'{y}.png')
+        try:
+            with open(path, 'rb') as file:
+                stat = os.fstat(file.fileno())
+                etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+                if self._not_modified(etag, stat.st_mtime):
+                    return self._send(304, b'', 'image/png', etag, stat.st_mtime)
+                body = file.read()
+        except FileNotFoundError:
+            # Cached too, so clients do not ask again for sea tiles every time they pan.
+            return self._send(404, b'', 'text/plain')
+        self._send(200, body, 'image/png', etag, stat.st_mtime)
+
+    def _not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _send_tilejson(self, variable):
+        try:
+            with open(os.path.join(self.tile_dir, variable, 'index.json')) as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return self._send(404, b'', 'text/plain')
+        host = self.headers.get('Host', f'{self.server.server_address[0]}:{self.server.server_address[1]}')
+        tilejson = {
+            'tilejson': '2.2.0',
+            'name': variable,
+            'tiles': [f'http://{host}/{variable}/{{z}}/{{x}}/{{y}}.png'],
+            'minzoom': index['minzoom'],
+            'maxzoom': index['maxzoom'],
+            'bounds': index['bounds'],
+            'datetime': index['datetime'],
+        }
+        self._send(200, json.dumps(tilejson).encode(), 'application/json')
+
+    def _send(self, status, body, content_type, etag=None, mtime=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', f'public, max-age={self.max_age}')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', formatdate(mtime, usegmt=True))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+def serve(tile_dir, host='127.0.0.1', port=8081, max_age=60):
+    """
+    Serves the tile pyramids in tile_dir over HTTP until interrupted.
+
+    Parameters:
+    tile_dir (str): The directory TilePyramid writes to.
+    host (str): The address to listen on.
+    port (int): The port to listen on.
+    max_age (int): Seconds clients may use a tile before revalidating it.
+
+    Returns:
+    None
+    """
+    TileHandler.tile_dir = tile_dir
+    TileHandler.max_age = max_age
+    server = ThreadingHTTPServer((host, port), TileHandler)
+    print(f"Serving tiles from {tile_dir} on http://{host}:{port}/<variable>/{{z}}/{{x}}/{{y}}.png")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve the map tile pyramids written by main.py --tiles.')
+    parser.add_argument('--tiles', default='output/tiles', help='tile directory')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--max-age', type=int, default=60, help='seconds clients may cache a tile before revalidating it')
+    args = parser.parse_args()
+
+    serve(args.tiles, args.host, args.port, args.max_age)
@@ -0,0 +1,151 @@
+import numpy as np
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+from interpolator import barycentric
+from ocean_mask import dissolve_land
+from raster_cache import RasterCache, raster_key, shapefile_parts
+import constants as c
+import os
+
+# Default tile edge, in grid cells. Interpolating a full 512x512 tile of land needs about
+# 40 MB of scratch space per worker, whatever the size of the whole grid.
+TILE_SIZE = 512
+
+class Grid:
+    """
+    A regular longitude/latitude grid described by its two axes.
+
+    Nothing the size of the full grid is built here. Tiles compute the coordinates of their
+    own cells when they need them, so a 4000x4000 grid costs two 4000-element axes instead
+    of two 128 MB meshgrids.
+    """
+
+    def __init__(self, nx, ny, extent=None):
+        """
+        Parameters:
+        nx (int): Number of grid points along longitude.
+        ny (int): Number of grid points along latitude.
+        extent (tuple): (minlon, maxlon, minlat, maxlat). Defaults to the map extent.
+        """
+        minlon, maxlon, minlat, maxlat = extent if extent is not None else (c.MINLON, c.MAXLON, c.MINLAT, c.MAXLAT)
+        self.xi = np.linspace(minlon, maxlon, nx)
+        self.yi = np.linspace(minlat, maxlat, ny)
+
+    @property
+    def shape(self):
+        return len(self.yi), len(self.xi)
+
+    @property
+    def extent(self):
+        return self.xi[0], self.xi[-1], self.yi[0], self.yi[-1]
+
+    def tiles(self, tile_size=TILE_SIZE):
+        """
+        Splits the grid into square tiles.
+
+        Parameters:
+        tile_size (int): The edge of a tile in grid cells. Tiles on the last row and column may be smaller.
+
+        Returns:
+        list: (rows, cols) pairs of slices into the grid.
+        """
+        ny, nx = self.shape
+        return [(slice(r, min(r + tile_size, ny)), slice(q, min(q + tile_size, nx)))
+                for r in range(0, ny, tile_size) for q in range(0, nx, tile_size)]
+
+def _run_tiles(function, tiles, n_workers):
+    # scipy and shapely release the GIL in their heavy loops and each tile writes a disjoint
+    # block of the output, so threads work across cores without copying anything.
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers == 1 or len(tiles) == 1:
+        for tile in tiles:
+            function(tile)
+        return
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        list(pool.map(function, tiles))
+
+def tiled_ocean_mask(gdf, grid, shapefile_path, cache_dir, tile_size=TILE_SIZE, n_workers=None):
+    """
+    Generates the ocean mask of a grid tile by tile and stores it in the raster cache.
+
+    The cache key is the one generate_ocean_mask uses for the same extent and size, so
+    masks are shared between the two. Each tile is tested with its two axes broadcast
+    against each other, without building its meshgrid.
+
+    Parameters:
+    gdf (DistrictGeometry or GeoDataFrame): The polygons representing land areas.
+    grid (Grid): The grid.
+    shapefile_path (str): The shapefile gdf was read from.
+    cache_dir (str): The directory holding cached masks.
+    tile_size (int): The edge of a tile in grid cells.
+    n_workers (int): Number of threads. Defaults to the number of CPUs.
+
+    Returns:
+    numpy.ndarray: A uint8 mask array where ocean areas are marked with 1 and land areas with 0.
+    """
+    ny, nx = grid.shape
+    cache = RasterCache(cache_dir)
+    key = raster_key('ocean_mask', grid.extent, nx, ny, shapefile_parts(shapefile_path))
+
+    ocean_mask = cache.load(key, grid.shape)
+    if ocean_mask is not None:
+        print(f"Ocean mask {key[:12]} loaded from {cache_dir}")
+        return ocean_mask
+
+    print(f"No cached ocean mask for this {nx}x{ny} grid and shapefile. Generating a new one in tiles.")
+    land = dissolve_land(gdf)
+    ocean_mask = np.empty(grid.shape, dtype=np.uint8)
+
+    def test_tile(tile):
+        rows, cols = tile
+        ocean_mask[rows, cols] = ~shapely.contains_xy(land, grid.xi[cols][None, :], grid.yi[rows][:, None])
+
+    _run_tiles(test_tile, grid.tiles(tile_size), n_workers)
+    cache.store(key, ocean_mask, packed=True, kind='ocean_mask', extent=[float(v) for v in grid.extent], nx=nx, ny=ny)
+    print(f"Ocean mask {key[:12]} saved to {cache_dir}")
+    return ocean_mask
+
+def interpolate_tiled(stations, grid, ocean_mask, variable='temperature', tile_size=TILE_SIZE, n_workers=None, out=None):
+    """
+    Linearly interpolates station readings onto the land cells of a grid, tile by tile.
+
+    The stations, with the four virtual corner stations, are triangulated once. Each tile
+    then locates only its own land cells in the triangulation and writes float32 values
+    into its block of the output, so scratch memory is bounded by the tile size and tiles
+    that are all sea cost nothing. The result matches interpolate_land at the same cells.
+
+    Parameters:
+    stations (StationTable): The station table with readings for `variable`.
+    grid (Grid): The grid.
+    ocean_mask (numpy.ndarray): The mask from tiled_ocean_mask, 1 over the ocean.
+    variable (str): The variable to interpolate.
+    tile_size (int): The edge of a tile in grid cells.
+    n_workers (int): Number of threads. Defaults to the number of CPUs.
+    out (numpy.ndarray): A float32 array of the grid's shape to write into, e.g. a memmap.
+        Allocated if None.
+
+    Returns:
+    numpy.ndarray: The float32 field, NaN over the ocean and outside the stations' hull.
+    """
+    lon, lat, values, valid = stations.with_virtual_stations(variable)
+    if valid.sum() < 3:
+        raise ValueError(f"At least 3 valid stations are needed to triangulate, got {valid.sum()}")
+    from scipy.spatial import Delaunay
+    tri = Delaunay(np.column_stack([lon[valid], lat[valid]]))
+    values = values[valid]
+
+    Z = np.empty(grid.shape, dtype=np.float32) if out is None else out
+
+    def interpolate_tile(tile):
+        rows, cols = tile
+        block = np.full((rows.stop - rows.start, cols.stop - cols.start), np.nan, dtype=np.float32)
+        r, q = np.nonzero(ocean_mask[rows, cols] == 0)
+        if len(r):
+            points = np.column_stack([grid.xi[cols][q], grid.yi[rows][r]])
+            inside, vertices, bary = barycentric(tri, points)
+            block[r[inside], q[inside]] = np.einsum('ij,ij->i', bary, values[vertices])
+        Z[rows, cols] = block
+
+    _run_tiles(interpolate_tile, grid.tiles(tile_size), n_workers)
+    return Z
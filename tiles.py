@@ -0,0 +1,269 @@
+import numpy as np
+from PIL import Image
+from renderer import band_lut, colorize
+from variables import VARIABLES
+import constants as c
+import hashlib
+import json
+import os
+import io
+
+TILE_SIZE = 256
+ZOOMS = range(8, 13)
+
+def lon_to_tile_x(lon, zoom):
+    """
+    Returns the fractional XYZ (web Mercator) tile column of a longitude at a zoom level.
+    """
+    return (np.asarray(lon) + 180.0) / 360.0 * 2 ** zoom
+
+def lat_to_tile_y(lat, zoom):
+    """
+    Returns the fractional XYZ (web Mercator) tile row of a latitude at a zoom level. Rows
+    count down from the north.
+    """
+    lat = np.radians(np.asarray(lat))
+    return (1.0 - np.arcsinh(np.tan(lat)) / np.pi) / 2.0 * 2 ** zoom
+
+def tile_y_to_lat(y, zoom):
+    """
+    Returns the latitude of a fractional XYZ tile row at a zoom level.
+    """
+    return np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * np.asarray(y) / 2 ** zoom))))
+
+def tile_range(zoom, extent=None):
+    """
+    Returns the tiles covering an extent at a zoom level.
+
+    Parameters:
+    zoom (int): The zoom level.
+    extent (tuple): (minlon, maxlon, minlat, maxlat). Defaults to the map extent.
+
+    Returns:
+    tuple: (x0, x1, y0, y1), the first and last tile column and row, inclusive.
+    """
+    minlon, maxlon, minlat, maxlat = extent if extent is not None else (c.MINLON, c.MAXLON, c.MINLAT, c.MAXLAT)
+    x0, x1 = int(lon_to_tile_x(minlon, zoom)), int(lon_to_tile_x(maxlon, zoom))
+    y0, y1 = int(lat_to_tile_y(maxlat, zoom)), int(lat_to_tile_y(minlat, zoom))
+    return x0, x1, y0, y1
+
+class TilePyramid:
+    """
+    Writes the field of each frame as an XYZ tile pyramid of 256 px PNGs, laid out as
+    <tile_dir>/<variable>/<z>/<x>/<y>.png for web maps such as Leaflet or OpenLayers.
+
+    Every tile pixel takes the band colour of the grid cell under its centre, as the raster
+    product does, so the tiles show the same field as the PNG at every zoom level.
+    Only the tiles that changed are written:
+    - a tile's colours are compared with the previous frame's, by digest, before it is encoded;
+    - when the cells that changed since the previous frame are known (see
+      IncrementalField), the tiles none of them fall in are not even sampled.
+    Tiles that are all sea are not written, and removed if they were. Unchanged tiles keep their
+    modification time, so tile_server.py answers clients that already hold them with
+    304 Not Modified.
+
+    The pyramid covers only the zoom levels it is created with over the map extent, and
+    refuses to be created with more than max_tiles tiles per variable. On disk it holds one
+    PNG per tile, the latest frame only, so its size is bounded by that count.
+    """
+
+    def __init__(self, tile_dir, zooms=ZOOMS, alpha=0.8, max_tiles=4096, extent=None):
+        """
+        Parameters:
+        tile_dir (str): The directory the pyramid is written to, one subdirectory per variable.
+        zooms (iterable): The zoom levels to render.
+        alpha (float): Opacity of the field, so a base map shows through.
+        max_tiles (int): The largest number of tiles per variable.
+        extent (tuple): (minlon, maxlon, minlat, maxlat) covered. Defaults to the map extent.
+        """
+        self.tile_dir = tile_dir
+        self.zooms = sorted(zooms)
+        self.alpha = alpha
+        self.extent = extent if extent is not None else (c.MINLON, c.MAXLON, c.MINLAT, c.MAXLAT)
+        self.ranges = {zoom: tile_range(zoom, self.extent) for zoom in self.zooms}
+        n_tiles = sum((x1 - x0 + 1) * (y1 - y0 + 1) for x0, x1, y0, y1 in self.ranges.values())
+        if n_tiles > max_tiles:
+            raise ValueError(f"Zoom levels {self.zooms} need {n_tiles} tiles per variable, more than max_tiles={max_tiles}")
+        self.n_tiles = n_tiles
+        # variable -> {'z/x/y': digest of the tile's colours}, as on disk.
+        self._digests = {}
+        # The variables whose previous frame went through this pyramid.
+        self._rendered = set()
+        self._luts = {}
+        # The grid axes the pixel lookups below were built for, and the key of the tile
+        # digests on that grid.
+        self._axes = None
+        self._grid_key = b''
+        self._lookups = {}
+
+    def _variable_dir(self, variable):
+        return os.path.join(self.tile_dir, variable)
+
+    def _load_digests(self, variable):
+        if variable not in self._digests:
+            try:
+                with open(os.path.join(self._variable_dir(variable), 'index.json')) as file:
+                    self._digests[variable] = json.load(file)['tiles']
+            except (OSError, ValueError, KeyError):
+                self._digests[variable] = {}
+        return self._digests[variable]
+
+    def _pixel_lookup(self, xi, yi, zoom, x, y):
+        """
+        Returns which grid cells a tile's pixels fall in: the distinct grid columns under the
+        tile's pixel columns and, for each pixel column, its entry among them, and the same for
+        rows. Cells off the grid are -1.
+
+        A tile of the lowest zoom levels spans many cells per pixel, one of the highest many
+        pixels per cell, so colouring the distinct cells and then spreading them over the pixels
+        costs the smaller of the two counts.
+        """
+        key = (zoom, x, y)
+        if key not in self._lookups:
+            px = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+            lon = (x + px) / 2 ** zoom * 360.0 - 180.0
+            lat = tile_y_to_lat(y + px, zoom)
+            # The grid is regular, so the nearest cell is found arithmetically.
+            cols = np.round((lon - xi[0]) / (xi[1] - xi[0])).astype(np.intp)
+            rows = np.round((lat - yi[0]) / (yi[1] - yi[0])).astype(np.intp)
+            cols[(cols < 0) | (cols >= len(xi))] = -1
+            rows[(rows < 0) | (rows >= len(yi))] = -1
+            self._lookups[key] = np.unique(cols, return_inverse=True) + np.unique(rows, return_inverse=True)
+        return self._lookups[key]
+
+    def changed_tiles(self, xi, yi, changed):
+        """
+        Finds the tiles holding any of the given grid cells.
+
+        Parameters:
+        xi (numpy.ndarray): The longitude axis of the grid.
+        yi (numpy.ndarray): The latitude axis of the grid.
+        changed (numpy.ndarray): Flat indices of grid cells.
+
+        Returns:
+        set: (z, x, y) of every tile overlapping one of the cells.
+        """
+        rows, cols = np.divmod(np.asarray(changed), len(xi))
+        half_x, half_y = abs(xi[1] - xi[0]) / 2, abs(yi[1] - yi[0]) / 2
+        lon, lat = xi[cols], yi[rows]
+        tiles = set()
+        for zoom in self.zooms:
+            # A cell covers half a cell either side of its centre, and may straddle tiles.
+            x0 = lon_to_tile_x(lon - half_x, zoom).astype(np.intp)
+            x1 = lon_to_tile_x(lon + half_x, zoom).astype(np.intp)
+            y0 = lat_to_tile_y(lat + half_y, zoom).astype(np.intp)
+            y1 = lat_to_tile_y(lat - half_y, zoom).astype(np.intp)
+            for xs, ys in ((x0, y0), (x0, y1), (x1, y0), (x1, y1)):
+                tiles.update((zoom, int(x), int(y)) for x, y in set(zip(xs.tolist(), ys.tolist())))
+        return tiles
+
+    def forget(self, variable):
+        """
+        Forgets the variable's previous frame, e.g. after a frame failed before its tiles were
+        all written, so the next render samples every tile whatever cells it is told changed.
+        """
+        self._rendered.discard(variable)
+
+    def render(self, X, Y, Z, variable='temperature', datetime=None, changed=None):
+        """
+        Brings the variable's pyramid up to date with a frame.
+
+        Parameters:
+        X (array-like): Longitudes of the grid points, 2-D or the 1-D grid axis.
+        Y (array-like): Latitudes of the grid points, 2-D or the 1-D grid axis.
+        Z (array-like): The field, masked or NaN over the ocean.
+        variable (str): The variable of the frame, a key of variables.VARIABLES.
+        datetime (str): The observation time of the frame, as YYYYMMDDHHMM, recorded in the index.
+        changed (numpy.ndarray): Flat indices of the cells changed since the variable's previous
+            frame. None to sample every tile.
+
+        Returns:
+        int: The number of tiles written or removed.
+        """
+        xi = X[0] if np.ndim(X) == 2 else np.asarray(X)
+        yi = Y[:, 0] if np.ndim(Y) == 2 else np.asarray(Y)
+        axes = (xi[0], xi[-1], len(xi), yi[0], yi[-1], len(yi))
+        if axes != self._axes:
+            self._axes = axes
+            self._grid_key = repr(axes).encode()[:64]
+            self._lookups = {}
+            # The previous frame was on another grid, so its changed cells say nothing here.
+            self._rendered.clear()
+
+        if np.ma.isMaskedArray(Z):
+            Z = np.ma.filled(Z.astype(float), np.nan)
+
+        digests = self._load_digests(variable)
+        if variable not in self._rendered:
+            changed = None
+        if variable not in self._luts:
+            spec = VARIABLES[variable]
+            self._luts[variable] = band_lut(spec.levels, spec.cmap, self.alpha)
+        lut, levels = self._luts[variable], VARIABLES[variable].levels
+        candidates = None if changed is None else self.changed_tiles(xi, yi, changed)
+
+        written = 0
+        for zoom, (x0, x1, y0, y1) in self.ranges.items():
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    if candidates is not None and (zoom, x, y) not in candidates:
+                        continue
+                    written += self._render_tile(Z, xi, yi, zoom, x, y, lut, levels, digests, variable)
+
+        self._rendered.add(variable)
+        self._write_index(variable, datetime)
+        return written
+
+    def _render_tile(self, Z, xi, yi, zoom, x, y, lut, levels, digests, variable):
+        cols, col_idx, rows, row_idx = self._pixel_lookup(xi, yi, zoom, x, y)
+        cells = colorize(Z[np.ix_(rows, cols)], levels, lut)
+        cells[rows < 0] = 0
+        cells[:, cols < 0] = 0
+
+        name = f'{zoom}/{x}/{y}'
+        path = os.path.join(self._variable_dir(variable), str(zoom), str(x), f'{y}.png')
+        # Every cell of the block lies under some pixel, and the lookup is fixed for the grid,
+        # so the cells decide the tile and are all that needs comparing.
+        if not cells[..., 3].any():
+            if digests.pop(name, None) is None:
+                return 0
+            if os.path.exists(path):
+                os.remove(path)
+            return 1
+
+        digest = hashlib.blake2b(np.ascontiguousarray(cells).tobytes(), digest_size=16, key=self._grid_key).hexdigest()
+        if digests.get(name) == digest and os.path.exists(path):
+            return 0
+        # Spread the cells over the pixels, one 32-bit RGBA word at a time. Tile rows run
+        # north first, so row_idx takes the cells' rows in reverse.
+        words = np.ascontiguousarray(cells).view(np.uint32)[..., 0]
+        rgba = words.take(row_idx, axis=0).take(col_idx, axis=1)[..., None].view(np.uint8)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        buffer = io.BytesIO()
+        Image.fromarray(rgba, 'RGBA').save(buffer, format='PNG')
+        with open(path + '.tmp', 'wb') as file:
+            file.write(buffer.getvalue())
+        os.replace(path + '.tmp', path)
+        digests[name] = digest
+        return 1
+
+    def _write_index(self, variable, datetime):
+        """
+        Writes <variable>/index.json: the frame's time, the zoom levels and bounds for clients,
+        and the digest of every tile so that a later process can tell which tiles changed.
+        """
+        minlon, maxlon, minlat, maxlat = self.extent
+        index = {
+            'variable': variable,
+            'datetime': datetime,
+            'minzoom': self.zooms[0],
+            'maxzoom': self.zooms[-1],
+            'bounds': [minlon, minlat, maxlon, maxlat],
+            'tiles': self._digests[variable],
+        }
+        directory = self._variable_dir(variable)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'index.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(index, file)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,90 @@
+import numpy as np
+import constants as c
+
+# Threshold isolines drawn over the temperature field and marked on its colorbar.
+ISOLINES = [
+    (c.FRZE_LVL, 'magenta'),
+    (c.VCOLD_LVL, 'lightgrey'),
+    (c.COLD_LVL, 'white'),
+    (c.VHOT_LVL, 'white'),
+    (c.EHOT_LVL, 'fuchsia'),
+]
+
+FEED_ROOT = 'https://data.weather.gov.hk/weatherAPI/hko_data/regional-weather/'
+
+class Variable:
+    """
+    Everything that differs between the mapped variables: where the readings come from and
+    how they are drawn. The station table, ocean mask, interpolation weights and figure are
+    shared by all of them.
+    """
+
+    def __init__(self, name, feed, column, label, unit, levels, cmap, isolines=(), map_prefix=None, stats_prefix=None, terrain=False,
+                 station_list=None):
+        """
+        Parameters:
+        name (str): The key the readings are stored under in the station table and archive.
+        feed (str): The file name of the HKO regional-weather CSV feed.
+        column (str): The CSV column holding the readings.
+        label (str): The colorbar label.
+        unit (str): The unit appended to station labels and extremes.
+        levels (numpy.ndarray): The filled-contour levels.
+        cmap (str): The name of the colormap.
+        isolines (list): (level, colour) pairs drawn as lines and marked on the colorbar.
+        map_prefix (str): File name prefix of the rendered PNGs. Defaults to HK_<name>_map.
+        stats_prefix (str): File name prefix of the district statistics. Defaults to HK_district_<name>.
+        terrain (bool): Whether the readings change with height, and are interpolated with a
+            fitted lapse rate when an elevation layer is loaded, see terrain.TerrainModel.
+        station_list (str): A CSV of the feed's stations that are not in the temperature station
+            list, loaded into the station table as well. None if that list covers them.
+        """
+        self.name = name
+        self.feed = feed
+        self.column = column
+        self.label = label
+        self.unit = unit
+        self.levels = np.asarray(levels, dtype=float)
+        self.cmap = cmap
+        self.isolines = list(isolines)
+        self.map_prefix = map_prefix or f'HK_{name}_map'
+        self.stats_prefix = stats_prefix or f'HK_district_{name}'
+        self.terrain = terrain
+        self.station_list = station_list
+
+    @property
+    def feed_url(self):
+        return FEED_ROOT + self.feed
+
+    @property
+    def input_path(self):
+        """
+        Where the last downloaded feed is saved.
+        """
+        return f'input/{self.feed}'
+
+VARIABLES = {
+    'temperature': Variable(
+        'temperature', 'latest_1min_temperature.csv', 'Air Temperature(degree Celsius)',
+        '2m Temperature (°C)', '°C', np.linspace(c.MINTEMP, c.MAXTEMP, (c.MAXTEMP - c.MINTEMP + 1)),
+        'ChaseSpectral', ISOLINES, map_prefix='HK_temp_map_newcolor', stats_prefix='HK_district_temp', terrain=True),
+    'humidity': Variable(
+        'humidity', 'latest_1min_humidity.csv', 'Relative Humidity(percent)',
+        'Relative Humidity (%)', '%', np.linspace(0, 100, 21), 'YlGnBu'),
+    'wind': Variable(
+        'wind', 'latest_10min_wind.csv', '10-Minute Mean Speed(km/hour)',
+        '10-min Mean Wind Speed (km/h)', 'km/h', np.linspace(0, 100, 21), 'viridis'),
+    'pressure': Variable(
+        'pressure', 'latest_1min_pressure.csv', 'Mean Sea Level Pressure(hPa)',
+        'Mean Sea Level Pressure (hPa)', 'hPa', np.linspace(990, 1040, 51), 'RdBu_r'),
+}
+
+def station_lists(variables):
+    """
+    Returns the extra station CSVs the feeds of some variables need, each once, see Variable.station_list.
+    """
+    paths = []
+    for variable in variables:
+        path = VARIABLES[variable].station_list
+        if path is not None and path not in paths:
+            paths.append(path)
+    return paths
@@ -0,0 +1,254 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+import multiprocessing
+from output_writer import prune_frames, publish_latest
+import numpy as np
+import atexit
+import os
+
+class Variant:
+    """
+    One configured rendering of the map: its size, resolution, the part of the map it shows,
+    whether stations are labelled and the colormap. Every variant of a frame is drawn from
+    the same interpolated field.
+    """
+
+    def __init__(self, name, dpi=500, figsize=(12, 6), extent=None, labels=True, cmap=None, product='contour'):
+        """
+        Parameters:
+        name (str): The variant's name, also the subdirectory of the output directory its PNGs go to.
+        dpi (int): Resolution of the saved PNG. The PNG is figsize * dpi pixels.
+        figsize (tuple): Figure size in inches.
+        extent (tuple): (minlon, maxlon, minlat, maxlat) shown. Defaults to the whole map.
+        labels (bool): Whether stations are labelled with their name and reading.
+        cmap (str): A colormap used for every variable instead of its own.
+        product (str): 'contour' or 'raster', see renderer.MapRenderer.
+        """
+        self.name = name
+        self.dpi = dpi
+        self.figsize = tuple(figsize)
+        self.extent = extent
+        self.labels = labels
+        self.cmap = cmap
+        self.product = product
+
+VARIANTS = {
+    # 1080 x 540 px, for social media posts.
+    'social': Variant('social', dpi=90),
+    # 480 x 240 px, for the mobile app. Station labels would be unreadable at this size.
+    'thumbnail': Variant('thumbnail', dpi=80, figsize=(6, 3), labels=False, product='raster'),
+    # Kowloon and Hong Kong Island.
+    'urban': Variant('urban', dpi=200, extent=(114.1, 114.28, 22.24, 22.37)),
+}
+
+class SharedField:
+    """
+    A field in a shared memory block, written by the process that interpolates it and read
+    in place by the render workers.
+
+    The block is created on the first write and reused for every later frame of the same or
+    a smaller size, so a frame costs one copy into it rather than a pickle per worker.
+    """
+
+    def __init__(self):
+        self._block = None
+
+    def write(self, Z):
+        """
+        Copies a field into the block, with masked cells as NaN.
+
+        Parameters:
+        Z (array-like): The field, masked or NaN over the ocean.
+
+        Returns:
+        tuple: (block name, shape, dtype), which attach_field maps back to the array.
+        """
+        if np.ma.isMaskedArray(Z):
+            Z = np.ma.filled(Z.astype(float), np.nan)
+        Z = np.asarray(Z)
+        if self._block is None or self._block.size < Z.nbytes:
+            self.close()
+            self._block = shared_memory.SharedMemory(create=True, size=max(Z.nbytes, 1))
+        np.ndarray(Z.shape, Z.dtype, buffer=self._block.buf)[...] = Z
+        return self._block.name, Z.shape, Z.dtype.str
+
+    def close(self):
+        """
+        Frees the block. Workers still attached keep their mapping until they exit.
+        """
+        if self._block is not None:
+            self._block.close()
+            self._block.unlink()
+            self._block = None
+
+# State of the worker process, set up by init_worker.
+_WORKER = None
+
+def init_worker(output_dir, station_paths, shapefile_path, cache_dir, name_column, keep=None, max_age=None):
+    """
+    Loads the station table and district geometry once per worker process. The renderer of
+    each variant is built on its first frame and kept.
+
+    Parameters:
+    output_dir (str): The directory whose subdirectories the variants are written to.
+    station_paths (list): The station location CSVs, see data_loader.load_station_data.
+    shapefile_path (str): The district shapefile.
+    cache_dir (str): The cache holding the packed district geometry.
+    name_column (str): The column holding the district names.
+    keep (int): The number of newest frames kept per variant, see output_writer.prune_frames. None for all.
+    max_age (int): Minutes of frames kept per variant. None for all.
+    """
+    global _WORKER
+    from data_loader import load_station_data
+    from district_geometry import load_district_geometry
+    _WORKER = {
+        'output_dir': output_dir,
+        'stations': load_station_data(*station_paths),
+        'districts': load_district_geometry(shapefile_path, cache_dir, name_column),
+        'renderers': {},
+        'blocks': {},
+        'retention': (keep, max_age),
+    }
+
+def attach_block(name):
+    """
+    Opens a shared memory block created by another process without registering it with
+    the resource tracker: the creator owns the block and unlinks it, and a registration
+    from this process would have the block reported as leaked, or unlinked, when it exits.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching always registers. The workers share the parent's
+        # tracker, so unregistering afterwards would drop the parent's own registration;
+        # the registration is skipped instead. Workers attach on their main thread only.
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+def attach_field(field):
+    """
+    Maps a field written by SharedField.write into this process, without copying it.
+    """
+    name, shape, dtype = field
+    blocks = _WORKER['blocks']
+    # The parent only replaces its block when the field grows, so mappings are kept for
+    # the life of the worker; the figure's artists may still hold views of the last frame.
+    if name not in blocks:
+        blocks[name] = attach_block(name)
+    return np.ndarray(shape, np.dtype(dtype), buffer=blocks[name].buf)
+
+def render_variant(variant, field, xi, yi, values, datetime, variable):
+    """
+    Renders one variant of a frame in a worker process.
+
+    Parameters:
+    variant (Variant): The variant to render.
+    field (tuple): The field's shared memory block, from SharedField.write.
+    xi (numpy.ndarray): The longitude axis of the grid.
+    yi (numpy.ndarray): The latitude axis of the grid.
+    values (numpy.ndarray): The variable's reading at every station of the table, NaN where missing.
+    datetime (str): The observation time of the frame, as YYYYMMDDHHMM.
+    variable (str): The variable of the frame, a key of variables.VARIABLES.
+
+    Returns:
+    str: The path of the saved PNG.
+    """
+    renderers, stations = _WORKER['renderers'], _WORKER['stations']
+    if variant.name not in renderers:
+        from renderer import MapRenderer
+        output_dir = os.path.join(_WORKER['output_dir'], variant.name)
+        os.makedirs(output_dir, exist_ok=True)
+        renderers[variant.name] = MapRenderer(stations, _WORKER['districts'], figsize=variant.figsize, dpi=variant.dpi,
+                                              output_dir=output_dir, product=variant.product, variable=variable,
+                                              extent=variant.extent, labels=variant.labels, cmap=variant.cmap)
+    stations.set_values(variable, values)
+    renderer = renderers[variant.name]
+    path = renderer.render(xi, yi, attach_field(field), stations, datetime, variable)
+    # Published and pruned as the main map's writer does; the worker is off the critical path already.
+    publish_latest(path)
+    prune_frames(renderer.output_dir, *_WORKER['retention'])
+    return path
+
+class VariantPool:
+    """
+    Renders several variants of every frame in parallel, from one interpolation.
+
+    The field is handed to a pool of worker processes through shared memory; each worker
+    draws the variants it is given with renderers it keeps from frame to frame. submit
+    returns at once, so the caller can render its own map, tiles and statistics meanwhile,
+    and a frame takes about as long as its slowest variant.
+    """
+
+    def __init__(self, variants, output_dir, station_paths, shapefile_path, cache_dir, name_column='ENAME', n_workers=None,
+                 keep=None, max_age=None):
+        """
+        Parameters:
+        variants (list): The Variants drawn for every frame.
+        output_dir (str): The directory whose subdirectories the variants are written to.
+        station_paths (list): The station location CSVs the caller's station table was read from.
+        shapefile_path (str): The district shapefile.
+        cache_dir (str): The cache holding the packed district geometry.
+        name_column (str): The column holding the district names.
+        n_workers (int): Number of worker processes. Defaults to one per variant, at most the number of CPUs.
+        keep (int): The number of newest frames kept per variant, see output_writer.prune_frames. None for all.
+        max_age (int): Minutes of frames kept per variant. None for all.
+        """
+        self.variants = list(variants)
+        self.n_workers = n_workers if n_workers is not None else min(len(self.variants), os.cpu_count() or 1)
+        self.field = SharedField()
+        # Workers start on the first submit, when the output writer and fetch threads are
+        # running; a forked child could inherit a lock one of them holds, so they are started
+        # from a clean process instead.
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.pool = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=multiprocessing.get_context(method),
+                                        initializer=init_worker, initargs=(output_dir, list(station_paths), shapefile_path, cache_dir, name_column, keep, max_age))
+        # The daemon never returns, so the block is also freed at exit.
+        atexit.register(self.close)
+
+    def submit(self, X, Y, Z, stations, datetime, variable='temperature'):
+        """
+        Starts rendering every variant of a frame. The field is copied into shared memory, so
+        it may change once this returns; the next submit must wait for these results.
+
+        Parameters:
+        X (array-like): Longitudes of the grid points, 2-D or the 1-D grid axis.
+        Y (array-like): Latitudes of the grid points, 2-D or the 1-D grid axis.
+        Z (array-like): The field, masked or NaN over the ocean.
+        stations (StationTable): The station table holding the frame's readings.
+        datetime (str): The observation time of the frame, as YYYYMMDDHHMM.
+        variable (str): The variable of the frame, a key of variables.VARIABLES.
+
+        Returns:
+        list: One future per variant, resolving to the path of its PNG.
+        """
+        xi = np.asarray(X[0] if np.ndim(X) == 2 else X)
+        yi = np.asarray(Y[:, 0] if np.ndim(Y) == 2 else Y)
+        field = self.field.write(Z)
+        values = stations.get(variable)
+        return [self.pool.submit(render_variant, variant, field, xi, yi, values, datetime, variable) for variant in self.variants]
+
+    def wait(self, futures):
+        """
+        Waits for the variants of a frame, reporting the ones that failed.
+
+        Returns:
+        list: The paths of the PNGs written.
+        """
+        paths = []
+        for variant, future in zip(self.variants, futures):
+            try:
+                paths.append(future.result())
+            except Exception as e:
+                print(f"An error occurred while rendering the {variant.name} variant: {e}")
+        return paths
+
+    def close(self):
+        """
+        Stops the workers and frees the shared field. Safe to call more than once.
+        """
+        self.pool.shutdown()
+        self.field.close()